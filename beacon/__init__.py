@@ -0,0 +1 @@
+from .api import compile_source, CompileResult
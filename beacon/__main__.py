@@ -1,43 +1,307 @@
 import sys
+import os.path
+import time
 import argparse
+from io import StringIO
 
-def parse(filename):
+from .lex import parselines
+from .passes import PassManager, passnames, DEFAULT_LEVEL, MAX_LEVEL
+from .api import buildprogram, writecode
+from .cache import Cache
+
+def readfile(filename):
     fl = open(filename)
-    parsetrees, srclines = parselines(fl)
+    text = fl.read()
     fl.close()
+    return text
+
+def compileoptions():
+    # The command-line options, in compile_source() form.
+    enable = list(args.enable_pass)
+    if args.inline_root:
+        enable.append('inlineroot')
+    return {
+        'level': args.O,
+        'enable': enable,
+        'disable': args.disable_pass,
+        'gradient_lut': args.gradient_lut,
+        'gradient_lerp': args.gradient_lerp,
+        'source': args.source,
+    }
+
+def parse(text):
+    parsetrees, srclines = parselines(StringIO(text))
+    return build(parsetrees, srclines)
 
+def build(parsetrees, srclines):
     if args.showterms:
         for term in parsetrees:
             term.dump()
         
-    program = compileall(parsetrees, srclines=srclines)
-    program.post()
+    program, passes = buildprogram(parsetrees, srclines, compileoptions())
+    if args.show_passes:
+        passes.report(program, sys.stderr)
     return program
 
+def writebody(program, outfl):
+    # Everything after the first line, which names the file.
+    writecode(program, outfl, source=args.source)
 
-if __name__ == '__main__':
-    from .lex import parselines
-    from .compile import compileall
+def codeoptions():
+    # The options which change the generated code, for the cache key.
+    options = compileoptions()
+    passes = PassManager(level=options['level'], enable=options['enable'], disable=options['disable'])
+    return {
+        'passes': [ pss.name for pss in passes.passes if pss.enabled ],
+        'gradientlut': options['gradient_lut'],
+        'gradientlerp': options['gradient_lerp'],
+        'source': options['source'],
+    }
+
+def opencache():
+    # Skip the cache if we want to see anything but the code.
+    if args.no_cache or args.showterms or args.shownodes or args.show_passes:
+        return None
+    return Cache(args.cache_dir, maxsize=int(args.cache_size * 1024 * 1024))
+
+def generate(text, cache=None):
+    # The generated code, minus the first line.
+    if cache:
+        key = cache.key(text, codeoptions())
+        res = cache.get(key)
+        if res is not None:
+            return res
+    program = parse(text)
+    outfl = StringIO()
+    writebody(program, outfl)
+    res = outfl.getvalue()
+    if cache:
+        cache.put(key, res)
+    return res
+
+def watchfile(filename, outfilename):
+    from .watch import BlockParser, watch, writeatomic
+    blockparser = BlockParser()
+    
+    def rebuild():
+        start = time.perf_counter()
+        try:
+            parsetrees, srclines = blockparser.parse(readfile(filename))
+            program = build(parsetrees, srclines)
+            outfl = StringIO()
+            outfl.write('// ' + filename + '\n')
+            writebody(program, outfl)
+            writeatomic(outfilename, outfl.getvalue())
+        except Exception as ex:
+            sys.stderr.write(f'{filename}: {ex.__class__.__name__}: {ex}\n')
+            return
+        ms = 1000 * (time.perf_counter() - start)
+        sys.stderr.write(f'{outfilename}: written in {ms:.0f} ms ({blockparser.reparsed} of {blockparser.blockcount} blocks reparsed)\n')
+
+    try:
+        watch(filename, rebuild)
+    except KeyboardInterrupt:
+        pass
+
+def findinputs(filenames):
+    # Directory arguments stand for the .pbb files in them.
+    res = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            for subname in sorted(os.listdir(filename)):
+                if subname.endswith('.pbb'):
+                    res.append(os.path.join(filename, subname))
+        else:
+            res.append(filename)
+    return res
+
+def outputname(filename, outdir):
+    base, _ = os.path.splitext(os.path.basename(filename))
+    return os.path.join(outdir, base + '.pat')
 
+def setargs(val):
+    # Worker processes don't run the argument parsing below, so they
+    # get the options this way.
+    global args
+    args = val
+
+def compilefile(filename, outfilename):
+    # Compile one file for --out-dir. Returns None on success, or an
+    # error message.
+    try:
+        body = generate(readfile(filename), opencache())
+        fl = open(outfilename, 'w')
+        fl.write('// ' + filename + '\n')
+        fl.write(body)
+        fl.close()
+    except Exception as ex:
+        return f'{ex.__class__.__name__}: {ex}'
+    return None
+
+def compilebatch(filenames, outdir, jobs=None):
+    filenames = findinputs(filenames)
+    outfilenames = [ outputname(filename, outdir) for filename in filenames ]
+    seen = {}
+    for filename, outfilename in zip(filenames, outfilenames):
+        if outfilename in seen:
+            sys.stderr.write(f'{seen[outfilename]} and {filename} would both write {outfilename}\n')
+            sys.exit(1)
+        seen[outfilename] = filename
+    os.makedirs(outdir, exist_ok=True)
+
+    if jobs == 1 or len(filenames) <= 1:
+        results = [ compilefile(filename, outfilename) for filename, outfilename in zip(filenames, outfilenames) ]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=setargs, initargs=(args,)) as executor:
+            results = list(executor.map(compilefile, filenames, outfilenames))
+    cache = opencache()
+    if cache:
+        cache.evict()
+
+    failed = [ (filename, err) for filename, err in zip(filenames, results) if err ]
+    if failed:
+        sys.stderr.write(f'{len(failed)} of {len(filenames)} files failed:\n')
+        for filename, err in failed:
+            sys.stderr.write(f'  {filename}: {err}\n')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('filename')
+    parser.add_argument('filenames', nargs='*', metavar='filename')
+    parser.add_argument('--out-dir', metavar='DIR',
+                        help='compile every input (files, or directories of .pbb files) into a .pat file in DIR')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes for --out-dir (default one per CPU)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the output to FILE rather than stdout')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and rewrite the --output file whenever the script changes')
+    parser.add_argument('--serve', metavar='SOCK',
+                        help='run a compile server on the Unix socket SOCK, taking JSON requests; the other code options become its defaults')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='where to cache generated code (default $PBBEACON_CACHE or ~/.cache/pbbeacon)')
+    parser.add_argument('--cache-size', type=float, default=32, metavar='MB',
+                        help='evict the least recently used cache entries beyond this size (default 32)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always compile; don\'t read or write the cache')
     parser.add_argument('--showterms', action='store_true')
     parser.add_argument('--shownodes', action='store_true')
     parser.add_argument('--source', action='store_true')
+    parser.add_argument('-O', type=int, default=DEFAULT_LEVEL, choices=range(MAX_LEVEL+1),
+                        help=f'optimization level (default {DEFAULT_LEVEL})')
+    parser.add_argument('--enable-pass', action='append', default=[], choices=passnames, metavar='PASS',
+                        help='turn on an optimization pass: '+', '.join(passnames))
+    parser.add_argument('--disable-pass', action='append', default=[], choices=passnames, metavar='PASS',
+                        help='turn off an optimization pass')
+    parser.add_argument('--show-passes', action='store_true',
+                        help='report what each pass changed (on stderr)')
+    parser.add_argument('--inline-root', action='store_true',
+                        help='compute the final value in render() rather than buffering it (same as --enable-pass inlineroot)')
+    parser.add_argument('--gradient-lut', type=int, default=0, metavar='SIZE',
+                        help='bake gradients into lookup tables of this size')
+    parser.add_argument('--gradient-lerp', action='store_true',
+                        help='interpolate between gradient table entries')
+    parser.add_argument('--cost', action='store_true',
+                        help='print an estimate of the per-frame cost instead of the code')
+    parser.add_argument('--pixels', type=int, default=240,
+                        help='pixel count for --cost, --profile, and --record (default 240)')
+    parser.add_argument('--ops-per-sec', type=float, default=None,
+                        help='device speed for --cost, in simple ops per second')
+    parser.add_argument('--json', action='store_true',
+                        help='print the --cost report as JSON')
+    parser.add_argument('--min-fps', type=float, default=None,
+                        help='with --cost, exit with an error if the estimate is below this')
+    parser.add_argument('--profile', type=int, default=None, metavar='FRAMES',
+                        help='run the generated code for this many frames and count the operations (the input may also be a .pat file)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='render frames into a .npy file (frames x pixels x 3) instead of printing the code')
+    parser.add_argument('--frames', type=int, default=400,
+                        help='frame count for --record (default 400)')
+    parser.add_argument('--fps', type=float, default=40,
+                        help='frame rate for --record (default 40)')
+    parser.add_argument('--record-dtype', choices=['uint8', 'float32'], default='uint8',
+                        help='--record values as 0-255 bytes or 0-1 floats (default uint8)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for --record')
     
     args = parser.parse_args()
 
-    program = parse(args.filename)
+    if args.serve:
+        if args.filenames or args.out_dir or args.output or args.watch:
+            parser.error('--serve takes no files')
+        from .serve import serve
+        serve(args.serve, defaults=compileoptions())
+        sys.exit(0)
+    if not args.filenames:
+        parser.error('no filename')
+    if args.out_dir:
+        if args.record or args.profile is not None or args.cost:
+            parser.error('--out-dir only writes code')
+        if args.output or args.watch:
+            parser.error('--out-dir cannot be used with -o or --watch')
+        compilebatch(args.filenames, args.out_dir, jobs=args.jobs)
+        sys.exit(0)
+    if len(args.filenames) > 1:
+        parser.error('more than one filename requires --out-dir')
+    args.filename = args.filenames[0]
+
+    if args.watch:
+        if not args.output:
+            parser.error('--watch requires -o')
+        watchfile(args.filename, args.output)
+        sys.exit(0)
+    if args.output:
+        sys.stdout = open(args.output, 'w')
+
+    if args.profile is not None and args.filename.endswith('.pat'):
+        from .interp import Interpreter
+        fl = open(args.filename)
+        interp = Interpreter(fl.read(), pixels=args.pixels)
+        fl.close()
+        for ix in range(args.profile):
+            interp.frame(1/40)
+        interp.write()
+        sys.exit(0)
+
+    text = readfile(args.filename)
+    cache = opencache()
+    if cache and not (args.record or args.profile is not None or args.cost):
+        sys.stdout.write('// ' + args.filename + '\n')
+        sys.stdout.write(generate(text, cache))
+        if cache.stored:
+            cache.evict()
+        sys.exit(0)
+
+    program = parse(text)
     if args.shownodes:
         program.dump()
     
-    if not args.showterms and not args.shownodes:
+    if args.record:
+        from .sim import record
+        record(program, args.record, args.frames, fps=args.fps, pixels=args.pixels, dtype=args.record_dtype, seed=args.seed)
+    elif args.profile is not None:
+        from .interp import Interpreter
+        outfl = StringIO()
+        program.write(outfl)
+        interp = Interpreter(outfl.getvalue(), pixels=args.pixels)
+        for ix in range(args.profile):
+            interp.frame(1/40)
+        interp.write()
+    elif args.cost:
+        from .cost import estimate, OPS_PER_SECOND
+        opspersec = args.ops_per_sec or OPS_PER_SECOND
+        report = estimate(program, pixels=args.pixels, opspersec=opspersec)
+        if args.json:
+            import json
+            print(json.dumps(report.asdict(), indent=2))
+        else:
+            print(args.filename)
+            report.write(sys.stdout)
+        if args.min_fps is not None and report.fps() < args.min_fps:
+            sys.exit(1)
+    elif not args.showterms and not args.shownodes:
         print('// ' + args.filename)
-        print('// code generated by pbbeacon: https://github.com/erkyrath/pbbeacon')
-        if args.source:
-            print()
-            for ln in program.srclines:
-                print('/// ' + ln)
-            print()
-        program.write()
+        writebody(program, sys.stdout)
@@ -0,0 +1,81 @@
+import contextvars
+from io import StringIO
+
+from .lex import parselines
+from .compile import compileall
+from .passes import PassManager, DEFAULT_LEVEL
+
+# The compiler as a library call:
+#
+#   res = compile_source(text, level=1, gradient_lut=64)
+#   res.code      # the generated Pixelblaze code
+#
+# Everything a compile touches (the node id counter, the pass manager,
+# the program) belongs to that compile, so several can run at once in
+# different threads. Errors in the script raise an exception, as they do
+# for the command line.
+
+DEFAULT_OPTIONS = {
+    'level': DEFAULT_LEVEL,
+    'enable': (),
+    'disable': (),
+    'gradient_lut': 0,
+    'gradient_lerp': False,
+    'source': False,
+}
+
+HEADER = '// code generated by pbbeacon: https://github.com/erkyrath/pbbeacon\n'
+
+class CompileResult:
+    def __init__(self, code, program, passes):
+        self.code = code
+        self.program = program
+        self.passes = passes
+
+    def __repr__(self):
+        return '<CompileResult %d lines>' % (self.code.count('\n'),)
+
+def checkoptions(options):
+    # Fill in the defaults. Returns a new dict.
+    for key in options:
+        if key not in DEFAULT_OPTIONS:
+            raise Exception(f'unknown option: {key}')
+    res = dict(DEFAULT_OPTIONS)
+    res.update(options)
+    return res
+
+def buildprogram(parsetrees, srclines, options):
+    # Compile and optimize. Returns (program, passes). This uses the
+    # caller's context for the id counter; compile_source() gives each
+    # compile its own.
+    options = checkoptions(options)
+    passes = PassManager(level=options['level'], enable=options['enable'], disable=options['disable'])
+    program = compileall(parsetrees, srclines=srclines)
+    program.gradientlut = options['gradient_lut']
+    program.gradientlerp = options['gradient_lerp']
+    passes.run(program)
+    return (program, passes)
+
+def writecode(program, outfl, source=False):
+    # The generated code, minus the line which names the file.
+    outfl.write(HEADER)
+    if source:
+        outfl.write('\n')
+        for ln in program.srclines:
+            outfl.write('/// ' + ln + '\n')
+        outfl.write('\n')
+    program.write(outfl)
+
+def compile_source(text, filename=None, **options):
+    # If filename is given, the code starts with a comment naming it.
+    options = checkoptions(options)
+    return contextvars.copy_context().run(compileinner, text, filename, options)
+
+def compileinner(text, filename, options):
+    parsetrees, srclines = parselines(StringIO(text))
+    program, passes = buildprogram(parsetrees, srclines, options)
+    outfl = StringIO()
+    if filename is not None:
+        outfl.write('// ' + filename + '\n')
+    writecode(program, outfl, source=options['source'])
+    return CompileResult(outfl.getvalue(), program, passes)
@@ -0,0 +1,209 @@
+import sys
+import os.path
+import time
+import tracemalloc
+import argparse
+from io import StringIO
+
+from .lex import parselines
+from .compile import compileall
+from .passes import PassManager
+
+# Compile-time benchmarks: each stage of the compiler, timed separately,
+# over the sample scripts and some large generated ones. Run as
+#
+#   python -m beacon.bench
+#
+# to compare against the baseline file, or with --write to update it
+# (so that changes show up in the diff). Besides the stage timings, each
+# case records the peak memory allocated during one compile.
+
+STAGES = [ 'lex', 'compile', 'optimize', 'post', 'write' ]
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.txt')
+
+def synth_wide(count):
+    # Many independent defs, all summed at the root.
+    ls = []
+    for ix in range(count):
+        period = 0.5 + (ix % 7) / 10
+        ls.append(f'd{ix}=wave: triangle, period={period}, shift=time: wave: sawtooth, period={1 + ix % 5}')
+    ls.append('mean')
+    for ix in range(count):
+        ls.append(f'  d{ix}')
+    return '\n'.join(ls) + '\n'
+
+def synth_chain(count):
+    # Each def uses the one before it.
+    ls = [ 'd0=wave: sine, period=time: wave: triangle, min=0.5, max=2' ]
+    for ix in range(1, count):
+        ls.append(f'd{ix}=mul: d{ix-1}, wave: triangle, period={0.5 + (ix % 7) / 10}')
+    ls.append(f'd{count-1}')
+    return '\n'.join(ls) + '\n'
+
+def synth_deep(depth):
+    # One expression, nested by indentation.
+    ls = []
+    for ix in range(depth):
+        indent = '  ' * ix
+        ls.append(f'{indent}{"sum" if ix % 2 else "mul"}')
+        ls.append(f'{indent}  {0.5 + (ix % 5) / 10}')
+    ls.append(f'{"  " * depth}wave: sine, period=time: wave: triangle, min=0.5, max=2')
+    return '\n'.join(ls) + '\n'
+
+def synth_longline(count):
+    # A single line with a very long argument list.
+    args = ', '.join([ str(0.001 * (ix+1)) for ix in range(count) ])
+    return f'a=wave: triangle, shift=time: wave: sawtooth\nsum: a, {args}\n'
+
+SYNTHETIC = [
+    ('synth/wide-1000', synth_wide, 1000),
+    ('synth/wide-5000', synth_wide, 5000),
+    ('synth/chain-500', synth_chain, 500),
+    ('synth/chain-5000', synth_chain, 5000),
+    ('synth/deep-200', synth_deep, 200),
+    ('synth/deep-2000', synth_deep, 2000),
+    ('synth/longline-5000', synth_longline, 5000),
+]
+
+def timestages(text):
+    # Run the compiler once, returning a map from stage to seconds.
+    res = {}
+    start = time.perf_counter()
+    fl = StringIO(text)
+    parsetrees, srclines = parselines(fl)
+    res['lex'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    program = compileall(parsetrees, srclines=srclines)
+    res['compile'] = time.perf_counter() - start
+
+    passes = PassManager()
+    start = time.perf_counter()
+    passes.prepare(program)
+    res['optimize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    program.post()
+    res['post'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    program.write(StringIO())
+    res['write'] = time.perf_counter() - start
+    return res
+
+def peakmemory(text):
+    # Peak traced allocation over one compile, in KB. This is a separate
+    # run, since tracing slows everything down.
+    tracemalloc.start()
+    try:
+        timestages(text)
+        (cur, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+def bench(text, repeat=3):
+    # The best time for each stage over several runs, in milliseconds,
+    # plus the peak memory in KB (as 'peak'); or an error string.
+    best = None
+    for ix in range(repeat):
+        try:
+            res = timestages(text)
+        except RecursionError:
+            return 'RecursionError'
+        if best is None:
+            best = res
+        else:
+            best = { key: min(best[key], res[key]) for key in STAGES }
+    res = { key: 1000 * val for key, val in best.items() }
+    res['peak'] = peakmemory(text)
+    return res
+
+def cases():
+    scriptdir = os.path.join(basedir, 'scripts')
+    if os.path.isdir(scriptdir):
+        for filename in sorted(os.listdir(scriptdir)):
+            if filename.endswith('.pbb'):
+                fl = open(os.path.join(scriptdir, filename))
+                text = fl.read()
+                fl.close()
+                yield ('scripts/'+filename, text)
+    for name, func, size in SYNTHETIC:
+        yield (name, func(size))
+
+def formatline(name, res):
+    if isinstance(res, str):
+        return f'{name:24} {res}'
+    vals = ' '.join([ f'{res[key]:9.2f}' for key in STAGES ])
+    total = sum([ res[key] for key in STAGES ])
+    return f'{name:24} {vals} {total:9.2f} {res["peak"]:9.0f}'
+
+def header():
+    vals = ' '.join([ f'{key:>9}' for key in STAGES ])
+    return f'{"# ms":24} {vals} {"total":>9} {"peak KB":>9}'
+
+def readbaseline(filename):
+    res = {}
+    if not os.path.exists(filename):
+        return res
+    fl = open(filename)
+    for ln in fl.readlines():
+        ls = ln.split()
+        if not ls or ls[0].startswith('#'):
+            continue
+        res[ls[0]] = ls[1:]
+    fl.close()
+    return res
+
+def compare(res, old):
+    # A short note on how a result compares to its baseline line.
+    if old is None:
+        return 'new'
+    oldok = (len(old) == len(STAGES)+2)
+    if isinstance(res, str) or not oldok:
+        if not oldok and old[0] == res:
+            return ''
+        return 'was ' + (old[0] if not oldok else 'ok')
+    oldtotal = float(old[len(STAGES)])
+    oldpeak = float(old[len(STAGES)+1])
+    total = sum([ res[key] for key in STAGES ])
+    if oldtotal <= 0 or oldpeak <= 0:
+        return ''
+    return f'x{total/oldtotal:.2f} mem x{res["peak"]/oldpeak:.2f}'
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m beacon.bench')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default beacon/bench_baseline.txt)')
+    parser.add_argument('--write', action='store_true',
+                        help='write the results to the baseline file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case; the best time is kept (default 3)')
+    parser.add_argument('--filter', default=None,
+                        help='only run cases whose name contains this')
+    args = parser.parse_args()
+    if args.write and args.filter:
+        parser.error('--write needs every case; don\'t use --filter')
+
+    baseline = readbaseline(args.baseline)
+    lines = [ header() ]
+    print(lines[0])
+    for name, text in cases():
+        if args.filter and args.filter not in name:
+            continue
+        res = bench(text, repeat=args.repeat)
+        ln = formatline(name, res)
+        lines.append(ln)
+        print(f'{ln}  {compare(res, baseline.get(name))}')
+        sys.stdout.flush()
+
+    if args.write:
+        fl = open(args.baseline, 'w')
+        for ln in lines:
+            fl.write(ln.rstrip() + '\n')
+        fl.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import os.path
+import hashlib
+import json
+
+# An on-disk cache of generated code. Each entry is one file, named by a
+# hash of the source text, the compiler version (a hash of the compiler's
+# own source files), and the options which change the output. A hit
+# costs a stat and a read. We touch an entry's mtime when it's used, so
+# eviction can throw out the least recently used entries first.
+
+MAX_SIZE = 32 * 1024 * 1024
+
+def defaultdir():
+    val = os.environ.get('PBBEACON_CACHE')
+    if val:
+        return val
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pbbeacon')
+
+_version = None
+
+def compilerversion():
+    # Any change to the package (not just the code generator) counts as
+    # a new version. That's cheap, and it's never wrong.
+    global _version
+    if _version is None:
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        hasher = hashlib.sha256()
+        for filename in sorted(os.listdir(dirname)):
+            if filename.endswith('.py'):
+                hasher.update(filename.encode())
+                fl = open(os.path.join(dirname, filename), 'rb')
+                hasher.update(fl.read())
+                fl.close()
+        _version = hasher.hexdigest()
+    return _version
+
+class Cache:
+    def __init__(self, dirname=None, maxsize=MAX_SIZE):
+        if dirname is None:
+            dirname = defaultdir()
+        self.dirname = dirname
+        self.maxsize = maxsize
+        self.stored = False
+
+    def key(self, text, options):
+        hasher = hashlib.sha256()
+        hasher.update(compilerversion().encode())
+        hasher.update(json.dumps(options, sort_keys=True).encode())
+        hasher.update(text.encode())
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, key + '.pat')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            fl = open(path)
+            res = fl.read()
+            fl.close()
+            os.utime(path)
+        except OSError:
+            return None
+        return res
+
+    def put(self, key, value):
+        # Write to a temporary file and rename, so that a concurrent
+        # reader never sees a partial entry.
+        path = self.path(key)
+        tmppath = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            fl = open(tmppath, 'w')
+            fl.write(value)
+            fl.close()
+            os.replace(tmppath, path)
+            self.stored = True
+        except OSError:
+            pass
+
+    def entries(self):
+        # (mtime, size, path) for each entry, oldest first.
+        res = []
+        try:
+            ls = os.scandir(self.dirname)
+        except OSError:
+            return res
+        for ent in ls:
+            if not ent.name.endswith('.pat'):
+                continue
+            try:
+                stat = ent.stat()
+            except OSError:
+                continue
+            res.append( (stat.st_mtime, stat.st_size, ent.path) )
+        ls.close()
+        res.sort()
+        return res
+
+    def evict(self):
+        # Delete the least recently used entries until the total size is
+        # under the limit.
+        entries = self.entries()
+        total = sum([ size for (mtime, size, path) in entries ])
+        for (mtime, size, path) in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
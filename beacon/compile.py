@@ -1,31 +1,35 @@
+import math
+import itertools
+import contextvars
 from collections import namedtuple
 
 from .defs import Implicit, Dim, Color, WaveShape, AxisDep, axisdepname
 from .lex import Term, TokType
+from .ir import Num, Name, Index, Call, Op, Cond, Paren, IX, PIXELCOUNT
 
 def wave_sample(shape, var):
     # We can assume var is between 0 and 1
     match shape:
         case WaveShape.FLAT:
-            return '1'
+            return Num(1)
         case WaveShape.SQUARE:
-            return '1'
+            return Num(1)
         case WaveShape.HALFSQUARE:
-            return '(%s < 0.5 ? 1 : 0)' % (var,)
+            return Paren(Cond(Op('<', [ var, Num(0.5) ], spaced=True), Num(1), Num(0)))
         case WaveShape.SAWTOOTH:
-            return '%s' % (var,)
+            return var
         case WaveShape.SAWDECAY:
-            return '(1-%s)' % (var,)
+            return Paren(Op('-', [ Num(1), var ]))
         case WaveShape.SQRTOOTH:
-            return '%s*%s' % (var, var,)
+            return Op('*', [ var, var ])
         case WaveShape.SQRDECAY:
-            return '(1-%s)*(1-%s)' % (var, var,)
+            return Op('*', [ Paren(Op('-', [ Num(1), var ])), Paren(Op('-', [ Num(1), var ])) ])
         case WaveShape.TRIANGLE:
-            return 'triangle(%s)' % (var,)
+            return Call('triangle', [ var ])
         case WaveShape.TRAPEZOID:
-            return 'min(1, 2*triangle(%s))' % (var,)
+            return Call('min', [ Num(1), Op('*', [ Num(2), Call('triangle', [ var ]) ]) ])
         case WaveShape.SINE:
-            return 'sin(%s*PI)' % (var,)
+            return Call('sin', [ Op('*', [ var, Name('PI') ]) ])
         case _:
             raise NotImplementedError('wave_sample: %s' % (shape,))
     
@@ -42,9 +46,17 @@ class ArgFormat:
         defaultstr = ' = %s' if self.default else ''
         return '<ArgFormat "%s" %s%s>' % (self.name, self.typ, defaultstr,)
     
+# Node ids are numbered from zero in each compile. compileall() starts a
+# new counter in a context variable, so compiles running in different
+# threads (or contexts) don't share one.
+idcounter = contextvars.ContextVar('idcounter', default=itertools.count())
+
 class Node:
     classname = '???'
-    idcount = 0
+
+    # Scripts can have many thousands of nodes, so no per-node dict.
+    # Subclasses must declare __slots__ too (usually empty).
+    __slots__ = ('id', 'implicit', 'depend', 'dim', 'buffered', 'bounds', 'args', 'fusecolor')
 
     argformat = None
     argformatmap = None
@@ -52,32 +64,39 @@ class Node:
 
     usesimplicit = False
 
+    # Nodes whose values are random must not be merged by share().
+    shareable = True
+
+    # Filled in by prepclasses() when nodes.py is imported, so it's
+    # complete before any compile can start.
     allclassmap = {}
 
     @staticmethod
-    def prepclasses():
-        if Node.allclassmap:
-            return
-        from .nodes import nodeclasses
+    def prepclasses(nodeclasses):
         for cla in nodeclasses:
             Node.allclassmap[cla.classname] = cla
             cla.argformatmap = dict([(argf.name, argf) for argf in cla.argformat])
             cla.argclass = namedtuple('Args_'+cla.classname, [ argf.name for argf in cla.argformat ])
     
     def __init__(self, ctx):
-        self.id = '%s_%d' % (self.classname, Node.idcount,)
-        Node.idcount += 1
+        self.id = '%s_%d' % (self.classname, next(idcounter.get()),)
 
         self.implicit = ctx
         self.depend = AxisDep.NONE
         self.dim = Dim.NONE
         self.buffered = False
+        self.bounds = None
+        # Set by Program.post(): scalar inputs of a color node are
+        # computed once per pixel, not once per component.
+        self.fusecolor = False
 
     def __repr__(self):
         return '<%s>' % (self.id,)
 
-    def parseargs(self, args, defmap):
-        map = {}
+    def matchargs(self, args):
+        # Pair each arg term with the ArgFormat it fills.
+        res = []
+        seen = set()
         for arg in args:
             if arg.name:
                 argf = self.argformatmap[arg.name]
@@ -86,7 +105,7 @@ class Node:
                 lastmultiple = None
                 while pos < len(self.argformat):
                     argf = self.argformat[pos]
-                    if argf.name not in map:
+                    if argf.name not in seen:
                         break
                     if argf.multiple:
                         lastmultiple = pos
@@ -96,9 +115,26 @@ class Node:
                         raise Exception('%s: too many arguments' % (self.classname,))
                     pos = lastmultiple
                 argf = self.argformat[pos]
-            if not argf.multiple and argf.name in map:
+            if not argf.multiple and argf.name in seen:
                 raise Exception('%s: duplicate arg: %s' % (self.classname, argf.name))
+            seen.add(argf.name)
+            res.append( (argf, arg) )
+        return res
 
+    def argimplicits(self, args):
+        # The arg terms which parseargs() will compile into nodes, in
+        # order, with the implicit axis of each.
+        res = []
+        for (argf, arg) in self.matchargs(args):
+            if argf.typ is Node:
+                res.append( (arg, self.implicit) )
+            elif argf.typ is Implicit.TIME or argf.typ is Implicit.SPACE:
+                res.append( (arg, argf.typ) )
+        return res
+
+    def parseargs(self, args, defmap, memo=None):
+        map = {}
+        for (argf, arg) in self.matchargs(args):
             argval = None
             
             if argf.typ is float:
@@ -118,11 +154,11 @@ class Node:
                     raise Exception('%s: unrecognized waveshape' % (argf.name,))
                 argval = WaveShape.__members__[arg.tok.val.upper()]
             elif argf.typ is Node:
-                argval = compile(arg, implicit=self.implicit, defmap=defmap)
+                argval = compile(arg, implicit=self.implicit, defmap=defmap, memo=memo)
             elif argf.typ is Implicit.TIME:
-                argval = compile(arg, implicit=Implicit.TIME, defmap=defmap)
+                argval = compile(arg, implicit=Implicit.TIME, defmap=defmap, memo=memo)
             elif argf.typ is Implicit.SPACE:
-                argval = compile(arg, implicit=Implicit.SPACE, defmap=defmap)
+                argval = compile(arg, implicit=Implicit.SPACE, defmap=defmap, memo=memo)
             else:
                 raise Exception('%s: unimplemented arg type: %s (%s)' % (self.classname, argf.typ, argf.name))
 
@@ -163,17 +199,67 @@ class Node:
         else:
             return arg
 
+    def argnodes(self):
+        # The Node arguments, in argformat order.
+        res = []
+        for argf in self.argformat:
+            val = getattr(self.args, argf.name)
+            if argf.multiple:
+                res.extend([ arg for arg in val if isinstance(arg, Node) ])
+            elif isinstance(val, Node):
+                res.append(val)
+        return res
+
+    def mapargs(self, func):
+        # Replace every Node argument with func(arg). Other argument
+        # values (floats, shapes, gradient stops) are left alone.
+        map = {}
+        for argf in self.argformat:
+            val = getattr(self.args, argf.name)
+            if argf.multiple:
+                map[argf.name] = [ (func(arg) if isinstance(arg, Node) else arg) for arg in val ]
+            elif isinstance(val, Node):
+                map[argf.name] = func(val)
+        self.args = self.args._replace(**map)
+
     def finddim(self):
         raise NotImplementedError('finddim: ' + self.__class__.__name__)
 
     def isconstant(self):
         return False
 
+    def foldconst(self):
+        # If this node's inputs are all constants, return a constant node
+        # with the same value. Otherwise return None.
+        return None
+
+    def sharekey(self):
+        # A structural key: two nodes with the same key always generate the
+        # same values, so one can stand in for the other. Returns None for
+        # nodes which must not be merged.
+        if not self.shareable:
+            return None
+        ls = [ self.classname, self.implicit ]
+        for argf in self.argformat:
+            ls.append(argkey(getattr(self.args, argf.name)))
+        return tuple(ls)
+
+    def findbounds(self):
+        # The (lo, hi) range of this node's values; for a color, the range
+        # covering all three components. Program.post() computes this
+        # bottom-up and caches it in self.bounds.
+        return UNBOUNDED
+
+    def getbounds(self):
+        if self.bounds is None:
+            self.bounds = self.findbounds()
+        return self.bounds
+    
     def iszpositive(self):
-        return False
+        return self.getbounds()[0] >= 0
     
     def isznegative(self):
-        return False
+        return self.getbounds()[1] <= 0
     
     def isnondecreasing(self):
         return False
@@ -182,21 +268,24 @@ class Node:
         return False
 
     def isclamped(self):
-        return False
+        (lo, hi) = self.getbounds()
+        return lo >= 0 and hi <= 1
     
-    def printstaticvars(self, outfl, first=False):
-        pass
+    def generatestaticvars(self, first=False):
+        # Statements for the top of the program. first is set for the
+        # first node of each class.
+        return []
     
     def generateimplicit(self, ctx):
         if not self.usesimplicit:
             raise Exception('usesimplicit not set')
         if self.implicit is Implicit.TIME:
             if not ctx.timebase:
-                return 'clock'
+                return Name('clock')
             else:
-                return ctx.timebase
+                return Name(ctx.timebase)
         if self.implicit is Implicit.SPACE:
-            return '(ix/pixelCount)'
+            return Paren(Op('/', [ IX, PIXELCOUNT ]))
         raise Exception('implicit not set')
 
     def generatedata(self, ctx, component=None):
@@ -206,22 +295,23 @@ class Node:
             if self.isconstant():
                 return self.generateexpr(ctx, component=None)
             if not isinstance(self, NodeQuote):
-                return f'{ctx.quoteparent.id}_{ctx.quotekey}_{id}[px]'
+                return Index(Name(f'{ctx.quoteparent.id}_{ctx.quotekey}_{id}'), Name('px'))
             nod = self.args.arg
             assert not nod.buffered
             return nod.generateexpr(ctx, component=None)
         if self.buffered:
+            ctx.note_read(self)
             if self.dim is Dim.ONE:
                 if not (self.depend & AxisDep.SPACE):
-                    return f'{id}_scalar'
+                    return Name(f'{id}_scalar')
                 else:
-                    return f'{id}_vector[ix]'
+                    return Index(Name(f'{id}_vector'), IX)
             elif self.dim is Dim.THREE:
                 cstr = '_'+component if component else ''
                 if not (self.depend & AxisDep.SPACE):
-                    return f'{id}_scalar{cstr}'
+                    return Name(f'{id}_scalar{cstr}')
                 else:
-                    return f'{id}_vector{cstr}[ix]'
+                    return Index(Name(f'{id}_vector{cstr}'), IX)
             else:
                 raise Exception('bad dim')
         return self.generateexpr(ctx, component=component)
@@ -238,20 +328,48 @@ class Node:
                 comkey = 'common'
                 if count > 1:
                     comkey += str(count)
-                if arg.isconstant():
-                    argval = arg.generatedata(ctx=ctx)
-                else:
-                    argval = ctx.find_val(self, comkey)
-                    if argval is None:
-                        argval = ctx.store_val(self, comkey, arg.generatedata(ctx=ctx))
-                ls.append(argval)
+                ls.append(self.generateshared(arg, ctx, key=comkey))
             elif arg.dim is Dim.THREE:
                 ls.append(arg.generatedata(ctx=ctx, component=component))
             else:
                 raise Exception('bad dim')
         return ls
         
+    def generateshared(self, arg, ctx, key='common'):
+        # A scalar arg which all three components use. It's stored once
+        # per pixel, unless it's already a constant (or, when fusing
+        # colors, a buffer reference).
+        if arg.isconstant():
+            return arg.generatedata(ctx=ctx)
+        if self.fusecolor and arg.buffered:
+            ctx.note_fused(self)
+            return arg.generatedata(ctx=ctx)
+        argval = ctx.find_val(self, key)
+        if argval is None:
+            argval = ctx.store_val(self, key, arg.generatedata(ctx=ctx), depend=arg.depend)
+        return argval
+        
     def dump(self, indent=0, name=None):
+        # An explicit stack rather than recursion, since graphs can be
+        # deep. A string entry is a line already formatted.
+        stack = [ (self, indent, name) ]
+        while stack:
+            (nod, indent, name) = stack.pop()
+            if isinstance(nod, str):
+                print(nod)
+                continue
+            print(nod.dumpline(indent, name))
+            ls = []
+            for argf in nod.argformat:
+                argls = nod.getargls(argf.name, argf.multiple)
+                for arg in argls:
+                    if isinstance(arg, Node):
+                        ls.append( (arg, indent+1, argf.name) )
+                    else:
+                        ls.append( (f'{"  "*indent}  {argf.name}={arg}', None, None) )
+            stack.extend(reversed(ls))
+
+    def dumpline(self, indent, name):
         indentstr = '  '*indent
         namestr = name+'=' if name else ''
         impstr = str(self.implicit)[0]
@@ -270,36 +388,137 @@ class Node:
         if self.isnonincreasing():
             ls.append('dec')
         flagstr = ' (' + ' '.join(ls) + ')' if ls else ''
-        print(f'{indentstr}{namestr}<{self.id}> ({impstr}:{dimstr}){flagstr} dep={depstr}{bufstr}')
-        for argf in self.argformat:
-            argls = self.getargls(argf.name, argf.multiple)
-            for arg in argls:
-                if isinstance(arg, Node):
-                    arg.dump(indent+1, name=argf.name)
-                else:
-                    print(f'{indentstr}  {argf.name}={arg}')
+        return f'{indentstr}{namestr}<{self.id}> ({impstr}:{dimstr}){flagstr} dep={depstr}{bufstr}'
+
+def postorder(root, done, argsof=None, previsit=None):
+    # Yield root and the nodes under it, each after its args, in the same
+    # order as a recursive walk. Nodes whose ids are in done are skipped;
+    # the caller must add each node to done as it's yielded. argsof(nod)
+    # gives the args to walk, in order (default: nod.argnodes()).
+    # previsit(nod) is called when a node is first reached.
+    if argsof is None:
+        argsof = Node.argnodes
+    stack = [ (root, False) ]
+    while stack:
+        (nod, ready) = stack.pop()
+        if ready:
+            yield nod
+            continue
+        if nod.id in done:
+            continue
+        if previsit:
+            previsit(nod)
+        stack.append( (nod, True) )
+        for arg in reversed(argsof(nod)):
+            if arg.id not in done:
+                stack.append( (arg, False) )
             
 def find_unquoted_children(nod, res=None):
     if res is None:
         res = []
-    if isinstance(nod, NodeConstant):
-        pass
-    elif not isinstance(nod, NodeQuote):
-        res.append(nod)
-    else:
-        qnod = nod.args.arg
-        for argf in qnod.argformat:
-            argls = qnod.getargls(argf.name, argf.multiple)
-            for arg in argls:
-                if isinstance(arg, Node):
-                    find_unquoted_children(arg, res)
+    stack = [ nod ]
+    while stack:
+        nod = stack.pop()
+        if isinstance(nod, NodeConstant):
+            pass
+        elif not isinstance(nod, NodeQuote):
+            if nod not in res:
+                res.append(nod)
+        else:
+            stack.extend(reversed(nod.args.arg.argnodes()))
     return res
 
+def argkey(val):
+    # Hashable form of an argument value, for Node.sharekey().
+    if isinstance(val, Node):
+        cval = constvalue(val)
+        if cval is not None:
+            return argkey(cval)
+        return ('node', val.id)
+    if isinstance(val, Color):
+        return ('color', val.red, val.green, val.blue)
+    if isinstance(val, list) or isinstance(val, tuple):
+        return tuple([ argkey(subval) for subval in val ])
+    return val
+
+UNBOUNDED = (-math.inf, math.inf)
+
+def bounds_hull(ls):
+    # The smallest interval containing all of ls.
+    return (min([ lo for lo, hi in ls ]), max([ hi for lo, hi in ls ]))
+
+def bounds_add(bounds1, bounds2):
+    return (bounds1[0]+bounds2[0], bounds1[1]+bounds2[1])
+
+def bounds_neg(bounds):
+    return (-bounds[1], -bounds[0])
+
+def bounds_mul(bounds1, bounds2):
+    # Interval product. We take 0*inf to be 0, since the infinities here
+    # stand for "no known bound" rather than actual values.
+    ls = [ (0 if (val1 == 0 or val2 == 0) else val1*val2) for val1 in bounds1 for val2 in bounds2 ]
+    return (min(ls), max(ls))
+
+def constvalue(nod):
+    # The value of a literal constant node (a float or a Color), or None.
+    if isinstance(nod, NodeConstant) or isinstance(nod, NodeColor):
+        return nod.args.value
+    return None
+
+def makeconst(implicit, val):
+    if isinstance(val, Color):
+        return NodeColor(implicit, ascol=val)
+    # Rounding is far below the 16.16 fixed-point resolution, but keeps
+    # the generated code readable.
+    return NodeConstant(implicit, asnum=round(val, 9))
+
+def foldvalues(nod, args, func):
+    # If all args are literal constants, apply func (a function of a list
+    # of floats) to their values and return a new constant node. If any
+    # arg is a color, func is applied componentwise.
+    vals = [ constvalue(arg) for arg in args ]
+    if None in vals:
+        return None
+    if not any([ isinstance(val, Color) for val in vals ]):
+        return makeconst(nod.implicit, func(vals))
+    comps = []
+    for key in ('red', 'green', 'blue'):
+        ls = [ (getattr(val, key) if isinstance(val, Color) else val) for val in vals ]
+        comps.append(round(func(ls), 9))
+    return makeconst(nod.implicit, Color(tuple(comps)))
+
+def foldassociative(nod, func, identity=None):
+    # For an operator whose args can be combined in any order (sum, mul,
+    # max, min), merge all the constant args into one; drop it entirely
+    # if it's the identity value. Returns a replacement node, or None if
+    # nothing changed.
+    args = nod.args.arg
+    consts = [ arg for arg in args if constvalue(arg) is not None ]
+    if len(consts) == len(args):
+        return foldvalues(nod, args, func)
+    if not consts:
+        return None
+    merged = consts[0]
+    if len(consts) > 1:
+        merged = foldvalues(nod, consts, func)
+    dropmerged = (identity is not None and constvalue(merged) == identity)
+    if len(consts) == 1 and not dropmerged:
+        return None
+    newargs = []
+    for arg in args:
+        if arg is consts[0]:
+            if not dropmerged:
+                newargs.append(merged)
+        elif arg not in consts:
+            newargs.append(arg)
+    if len(newargs) == 1:
+        return newargs[0]
+    nod.args = nod.args._replace(arg=newargs)
+    return nod
 
 
 def compileall(trees, srclines=None):
-    Node.prepclasses()
-    Node.idcount = 0
+    idcounter.set(itertools.count())
     
     roots = []
     defmap = {}
@@ -319,28 +538,57 @@ def compileall(trees, srclines=None):
             startnod = nod
     return Program(startnod, defmap, srclines=srclines)
 
-def compile(term, implicit, defmap):
+def compile(term, implicit, defmap, memo=None):
+    # Terms can nest deeply, so rather than recursing through
+    # parseargs(), we walk the term tree with an explicit stack. A node's
+    # args are all compiled (into memo) before its parseargs() call, which
+    # then finds them there. Nodes are created in the same order as a
+    # recursive walk would, so the ids come out the same.
+    if memo is not None and id(term) in memo:
+        return memo.pop(id(term))
+    memo = {}
+    nod, fresh = compilehead(term, implicit, defmap)
+    if not fresh:
+        return nod
+    stack = [ (term, nod, iter(nod.argimplicits(term.args))) ]
+    while stack:
+        (curterm, curnod, todo) = stack[-1]
+        child = next(todo, None)
+        if child is not None:
+            (argterm, argimplicit) = child
+            subnod, fresh = compilehead(argterm, argimplicit, defmap)
+            if fresh:
+                stack.append( (argterm, subnod, iter(subnod.argimplicits(argterm.args))) )
+            else:
+                memo[id(argterm)] = subnod
+            continue
+        del stack[-1]
+        curnod.parseargs(curterm.args, defmap=defmap, memo=memo)
+        memo[id(curterm)] = curnod
+    return nod
+
+def compilehead(term, implicit, defmap):
+    # Returns (nod, fresh). A fresh node still needs parseargs(); the
+    # others (constants and def references) are complete.
     if term.tok.typ == TokType.NUM:
         if term.args:
             raise Exception('number cannot have args')
-        return NodeConstant(implicit, asnum=term.tok.val)
+        return (NodeConstant(implicit, asnum=term.tok.val), False)
     if term.tok.typ == TokType.COLOR:
         if term.args:
             raise Exception('color cannot have args')
-        return NodeColor(implicit, ascol=term.tok.val)
+        return (NodeColor(implicit, ascol=term.tok.val), False)
     if term.tok.typ != TokType.SYMBOL:
         raise Exception('non-symbol')
     key = term.tok.val.lower()
     if key in defmap:
         if term.args:
             raise Exception('variable name cannot have args: %s' % (key,))
-        return defmap[key]
+        return (defmap[key], False)
     cla = Node.allclassmap.get(key)
     if not cla:
         raise Exception('unknown term: %s' % (key,))
-    nod = cla(implicit)
-    nod.parseargs(term.args, defmap=defmap)
-    return nod
+    return (cla(implicit), True)
 
 # Late imports
 from .program import Program, Stanza
@@ -0,0 +1,222 @@
+import math
+
+from .ir import Num, Name, Index, Call, Op, Unary, Cond, Paren, ArrayLit
+from .ir import Decl, Assign, ExprStmt, If, For, Function, exprnames
+
+# A rough static cost model for the generated Pixelblaze code. We walk
+# the statements that Program.generate() builds, tracking how many times
+# each one runs per frame (loop nesting, render() per pixel), and count
+# operations and calls. The weights are in "simple op" units; the
+# ops-per-second figure is a ballpark for a Pixelblaze 3 and can be
+# overridden.
+
+OPS_PER_SECOND = 4000000
+
+# Calls which dominate the run time. Everything else counts as CALL_COST.
+CALL_COSTS = {
+    'sin': 12,
+    'cos': 12,
+    'pow': 20,
+    'sqrt': 8,
+    'random': 6,
+    'perlinTurbulence': 60,
+    'evalGradient': 16,
+    'gradientPos': 16,
+}
+TRANSCENDENTALS = [ 'sin', 'cos', 'pow', 'perlinTurbulence', 'evalGradient', 'gradientPos' ]
+CALL_COST = 2
+
+class CostReport:
+    def __init__(self, pixels, opspersec=OPS_PER_SECOND):
+        self.pixels = pixels
+        self.opspersec = opspersec
+        self.startupops = 0
+        self.scalarops = 0      # per frame, outside pixel loops
+        self.pixelops = 0       # per frame, inside pixel loops (total)
+        self.calls = {}         # transcendental calls per frame
+        self.pixelarrays = 0
+        self.otherarrays = 0
+        self.arrayelements = 0
+
+    def frameops(self):
+        return self.scalarops + self.pixelops
+
+    def fps(self):
+        ops = self.frameops()
+        if not ops:
+            return math.inf
+        return self.opspersec / ops
+
+    def asdict(self):
+        fps = self.fps()
+        return {
+            'pixels': self.pixels,
+            'startup_ops': round(self.startupops),
+            'scalar_ops_per_frame': round(self.scalarops),
+            'pixel_ops_per_frame': round(self.pixelops),
+            'pixel_ops_per_pixel': round(self.pixelops / self.pixels, 1) if self.pixels else 0,
+            'calls_per_frame': { key: round(val) for key, val in self.calls.items() },
+            'pixel_arrays': self.pixelarrays,
+            'other_arrays': self.otherarrays,
+            'array_elements': self.arrayelements,
+            'ops_per_second': self.opspersec,
+            'fps': (round(fps, 1) if fps != math.inf else None),
+        }
+
+    def write(self, outfl):
+        fps = self.fps()
+        fpsstr = ('%.1f' % (fps,)) if fps != math.inf else 'unlimited'
+        outfl.write(f'pixels: {self.pixels}\n')
+        outfl.write(f'startup: {round(self.startupops)} ops\n')
+        outfl.write(f'per frame: {round(self.scalarops)} scalar ops, {round(self.pixelops)} pixel ops ({self.pixelops/max(1, self.pixels):.1f} per pixel)\n')
+        for key, val in self.calls.items():
+            outfl.write(f'  {key}: {round(val)} calls per frame\n')
+        outfl.write(f'arrays: {self.pixelarrays} pixel arrays, {self.otherarrays} others ({self.arrayelements} elements)\n')
+        outfl.write(f'estimated: {fpsstr} fps (at {self.opspersec} ops/sec)\n')
+
+def exprcost(expr, report, mult):
+    # Count the weighted cost of one evaluation of an expression, and
+    # tally its expensive calls (mult times, if report is given).
+    cost = 0
+    stack = [ expr ]
+    while stack:
+        val = stack.pop()
+        if isinstance(val, Call):
+            cost += CALL_COSTS.get(val.func, CALL_COST)
+            if val.func in TRANSCENDENTALS and report is not None:
+                report.calls[val.func] = report.calls.get(val.func, 0) + mult
+            stack.extend(val.args)
+        elif isinstance(val, Op):
+            cost += len(val.args) - 1
+            stack.extend(val.args)
+        elif isinstance(val, Unary):
+            cost += 1
+            stack.append(val.arg)
+        elif isinstance(val, Cond):
+            cost += 1
+            stack.extend([ val.test, val.iftrue, val.iffalse ])
+        elif isinstance(val, Index):
+            stack.extend([ val.base, val.index ])
+        elif isinstance(val, Paren):
+            stack.append(val.arg)
+        elif isinstance(val, ArrayLit):
+            stack.extend(val.items)
+    return cost
+
+def constexpr(expr, pixels):
+    # The value of a loop bound, or None if it's only known at run time.
+    if isinstance(expr, Num):
+        return expr.value
+    if isinstance(expr, Name):
+        return pixels if expr.name == 'pixelCount' else None
+    if isinstance(expr, Paren):
+        return constexpr(expr.arg, pixels)
+    if isinstance(expr, Op) and expr.op in ('+', '-', '*'):
+        vals = [ constexpr(arg, pixels) for arg in expr.args ]
+        if None in vals:
+            return None
+        res = vals[0]
+        for val in vals[1:]:
+            if expr.op == '+':
+                res += val
+            elif expr.op == '-':
+                res -= val
+            else:
+                res *= val
+        return res
+    return None
+
+def loopcount(stmt, pixels):
+    # How many times a for loop's body runs.
+    if stmt.trips is not None:
+        trips = constexpr(stmt.trips, pixels)
+        return trips if trips is not None else 1
+    start = constexpr(stmt.start, pixels)
+    end = constexpr(stmt.end, pixels)
+    if start is None or end is None:
+        return 1
+    return max(0, end - start)
+
+def isperpixel(stmt):
+    # A loop over the pixels (or some of them).
+    names = exprnames(stmt.end)
+    if stmt.trips is not None:
+        names.update(exprnames(stmt.trips))
+    return 'pixelCount' in names
+
+class CostWalker:
+    # Tallies a list of statements into a report. mult is how many times
+    # per frame the statements run; perpixel says whether they count as
+    # pixel work. If startup is set, everything goes into startupops
+    # (and calls aren't tallied).
+    def __init__(self, report, startup=False):
+        self.report = report
+        self.startup = startup
+
+    def add(self, cost, perpixel):
+        if self.startup:
+            self.report.startupops += cost
+        elif perpixel:
+            self.report.pixelops += cost
+        else:
+            self.report.scalarops += cost
+
+    def expr(self, expr, mult, perpixel):
+        report = None if self.startup else self.report
+        self.add(exprcost(expr, report, mult) * mult, perpixel)
+
+    def walk(self, stmts, mult, perpixel):
+        for stmt in stmts:
+            if isinstance(stmt, Decl):
+                if stmt.expr is not None:
+                    self.expr(stmt.expr, mult, perpixel)
+            elif isinstance(stmt, Assign):
+                # The assignment itself is free, unless it's "+=" or the
+                # like.
+                self.expr(stmt.target, mult, perpixel)
+                self.expr(stmt.expr, mult, perpixel)
+                if stmt.op != '=':
+                    self.add(mult, perpixel)
+            elif isinstance(stmt, ExprStmt):
+                self.expr(stmt.expr, mult, perpixel)
+            elif isinstance(stmt, If):
+                # Assume every branch runs, which errs on the slow side.
+                self.expr(stmt.cond, mult, perpixel)
+                self.walk(stmt.body, mult, perpixel)
+                if stmt.orelse:
+                    self.walk(stmt.orelse, mult, perpixel)
+            elif isinstance(stmt, For):
+                # Loop headers cost a compare and an increment per pass.
+                newmult = mult * loopcount(stmt, self.report.pixels)
+                newperpixel = perpixel or isperpixel(stmt)
+                self.add(2 * newmult, newperpixel)
+                self.walk(stmt.body, newmult, newperpixel)
+
+def estimate(program, pixels=240, opspersec=OPS_PER_SECOND):
+    report = CostReport(pixels, opspersec=opspersec)
+    startup = CostWalker(report, startup=True)
+    frame = CostWalker(report)
+
+    for stmt in program.generate():
+        if isinstance(stmt, Function):
+            # Helper functions aren't counted directly.
+            if stmt.name == 'beforeRender':
+                frame.walk(stmt.body, 1, False)
+            elif stmt.name == 'render':
+                frame.walk(stmt.body, pixels, True)
+            continue
+        if isinstance(stmt, Decl) and isinstance(stmt.expr, Call) and stmt.expr.func == 'array':
+            size = stmt.expr.args[0]
+            if isinstance(size, Name) and size.name == 'pixelCount':
+                report.pixelarrays += 1
+                report.arrayelements += pixels
+            else:
+                report.otherarrays += 1
+                if isinstance(size, Num):
+                    report.arrayelements += int(size.value)
+            continue
+        # Top level: startup code. (Raw text, such as a helper function,
+        # isn't counted.)
+        startup.walk([ stmt ], 1, False)
+
+    return report
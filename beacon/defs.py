@@ -42,6 +42,10 @@ def axisdepname(dep):
 
 class Color:
     def __init__(self, val):
+        if isinstance(val, tuple):
+            # Already-computed components, as produced by constant-folding
+            (self.red, self.green, self.blue) = val
+            return
         assert val.startswith('$') and len(val) in (4, 7)
         val = val[ 1 : ]
         if len(val) == 3:
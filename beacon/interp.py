@@ -0,0 +1,755 @@
+import re
+import math
+import random
+import sys
+
+# An interpreter for the subset of Pixelblaze JS that Program.write()
+# emits. It runs the startup code, then beforeRender() and render() for
+# each frame, and counts the operations it executes: per function, and
+# per stanza (the node whose buffers or stored values a statement
+# touches).
+#
+# An "operation" is one arithmetic, comparison, or logical operator, one
+# function call, or one array access. Values are floats rather than 16.16
+# fixed point. Reading a variable which was never assigned gives 0, as
+# does an out-of-range array index.
+
+pat_token = re.compile(r'''[ \t\r]*(?:
+    (?P<comment>//[^\n]*)
+  | (?P<newline>\n)
+  | (?P<num>(?:[0-9]+[.]?[0-9]*|[.][0-9]+)(?:[eE][-+]?[0-9]+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>\+\+|--|\+=|-=|\*=|/=|==|!=|<=|>=|&&|\|\||[-+*/%<>=!?:,;()\[\]{}])
+)''', re.VERBOSE)
+
+KEYWORDS = set([ 'var', 'function', 'export', 'for', 'if', 'else', 'break', 'continue', 'return' ])
+
+BINARY_PRECEDENCE = {
+    '||': 1,
+    '&&': 2,
+    '==': 3, '!=': 3,
+    '<': 4, '>': 4, '<=': 4, '>=': 4,
+    '+': 5, '-': 5,
+    '*': 6, '/': 6, '%': 6,
+}
+
+BREAK = 'break'
+CONTINUE = 'continue'
+
+class Return:
+    def __init__(self, value):
+        self.value = value
+
+def tokenize(text):
+    res = []
+    pos = 0
+    line = 1
+    while pos < len(text):
+        match = pat_token.match(text, pos)
+        if not match or match.end() == pos:
+            if not text[pos:].strip(' \t\r'):
+                break
+            raise Exception(f'line {line}: invalid character: {text[pos]!r}')
+        pos = match.end()
+        typ = match.lastgroup
+        if typ == 'comment':
+            continue
+        if typ == 'newline':
+            res.append( ('newline', '\n', line) )
+            line += 1
+            continue
+        val = match.group(typ)
+        if typ == 'num':
+            val = float(val)
+        elif typ == 'name' and val in KEYWORDS:
+            typ = 'keyword'
+        res.append( (typ, val, line) )
+    res.append( ('end', None, line) )
+    return res
+
+class Parser:
+    # Recursive descent, producing statement and expression tuples:
+    #   ('var', name, expr), ('assign', target, op, expr), ('expr', expr),
+    #   ('for', init, cond, update, body), ('if', cond, body, elsebody),
+    #   ('break',), ('continue',), ('return', expr),
+    #   ('function', name, params, body)
+    # and
+    #   ('num', val), ('name', name), ('index', expr, expr),
+    #   ('call', name, args), ('array', elems), ('unop', op, expr),
+    #   ('binop', op, expr, expr), ('cond', expr, expr, expr)
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def error(self, msg):
+        raise Exception(f'line {self.peek()[2]}: {msg}')
+
+    def isop(self, val):
+        tok = self.peek()
+        return tok[0] in ('op', 'keyword') and tok[1] == val
+
+    def expect(self, val):
+        if not self.isop(val):
+            self.error(f'expected {val!r}, got {self.peek()[1]!r}')
+        self.next()
+
+    def expectname(self):
+        tok = self.next()
+        if tok[0] != 'name':
+            self.error(f'expected a name, got {tok[1]!r}')
+        return tok[1]
+
+    def skipnewlines(self):
+        while self.peek()[0] == 'newline' or self.isop(';'):
+            self.next()
+
+    def parseprogram(self):
+        res = []
+        self.skipnewlines()
+        while self.peek()[0] != 'end':
+            res.append(self.parsestatement())
+            self.skipnewlines()
+        return res
+
+    def parseblock(self):
+        self.skipnewlines()
+        self.expect('{')
+        res = []
+        self.skipnewlines()
+        while not self.isop('}'):
+            if self.peek()[0] == 'end':
+                self.error('unterminated block')
+            res.append(self.parsestatement())
+            self.skipnewlines()
+        self.expect('}')
+        return res
+
+    def parsestatement(self):
+        tok = self.peek()
+        if tok[0] == 'keyword':
+            match tok[1]:
+                case 'export':
+                    self.next()
+                    return self.parsestatement()
+                case 'function':
+                    self.next()
+                    name = self.expectname()
+                    self.expect('(')
+                    params = []
+                    while not self.isop(')'):
+                        params.append(self.expectname())
+                        if not self.isop(')'):
+                            self.expect(',')
+                    self.expect(')')
+                    body = self.parseblock()
+                    return ('function', name, params, body)
+                case 'var':
+                    self.next()
+                    name = self.expectname()
+                    expr = None
+                    if self.isop('='):
+                        self.next()
+                        expr = self.parseexpr()
+                    return ('var', name, expr)
+                case 'for':
+                    self.next()
+                    self.expect('(')
+                    init = self.parsestatement()
+                    self.expect(';')
+                    cond = self.parseexpr()
+                    self.expect(';')
+                    update = self.parsesimple()
+                    self.expect(')')
+                    body = self.parseblock()
+                    return ('for', init, cond, update, body)
+                case 'if':
+                    self.next()
+                    self.expect('(')
+                    cond = self.parseexpr()
+                    self.expect(')')
+                    body = self.parseblock()
+                    elsebody = None
+                    if self.isop('else'):
+                        self.next()
+                        if self.isop('if'):
+                            elsebody = [ self.parsestatement() ]
+                        else:
+                            elsebody = self.parseblock()
+                    return ('if', cond, body, elsebody)
+                case 'break':
+                    self.next()
+                    return ('break',)
+                case 'continue':
+                    self.next()
+                    return ('continue',)
+                case 'return':
+                    self.next()
+                    expr = None
+                    if self.peek()[0] != 'newline' and not self.isop('}'):
+                        expr = self.parseexpr()
+                    return ('return', expr)
+                case _:
+                    self.error(f'unexpected {tok[1]!r}')
+        return self.parsesimple()
+
+    def parsesimple(self):
+        # An assignment, increment, or bare expression
+        expr = self.parseexpr()
+        if self.isop('++') or self.isop('--'):
+            op = self.next()[1]
+            return ('assign', self.checktarget(expr), op[0]+'=', ('num', 1.0))
+        for op in ('=', '+=', '-=', '*=', '/='):
+            if self.isop(op):
+                self.next()
+                val = self.parseexpr()
+                return ('assign', self.checktarget(expr), op, val)
+        return ('expr', expr)
+
+    def checktarget(self, expr):
+        if expr[0] not in ('name', 'index'):
+            self.error('cannot assign to this')
+        return expr
+
+    def parseexpr(self):
+        expr = self.parsebinary(1)
+        if self.isop('?'):
+            self.next()
+            val1 = self.parseexpr()
+            self.expect(':')
+            val2 = self.parseexpr()
+            return ('cond', expr, val1, val2)
+        return expr
+
+    def parsebinary(self, minprec):
+        expr = self.parseunary()
+        while True:
+            tok = self.peek()
+            prec = BINARY_PRECEDENCE.get(tok[1]) if tok[0] == 'op' else None
+            if prec is None or prec < minprec:
+                return expr
+            self.next()
+            rhs = self.parsebinary(prec+1)
+            expr = ('binop', tok[1], expr, rhs)
+
+    def parseunary(self):
+        if self.isop('-') or self.isop('!'):
+            op = self.next()[1]
+            return ('unop', op, self.parseunary())
+        return self.parsepostfix(self.parseprimary())
+
+    def parsepostfix(self, expr):
+        while self.isop('['):
+            self.next()
+            index = self.parseexpr()
+            self.expect(']')
+            expr = ('index', expr, index)
+        return expr
+
+    def parseprimary(self):
+        tok = self.next()
+        if tok[0] == 'num':
+            return ('num', tok[1])
+        if tok[0] == 'name':
+            if self.isop('('):
+                self.next()
+                args = []
+                while not self.isop(')'):
+                    args.append(self.parseexpr())
+                    if not self.isop(')'):
+                        self.expect(',')
+                self.expect(')')
+                return ('call', tok[1], args)
+            return ('name', tok[1])
+        if tok[0] == 'op' and tok[1] == '(':
+            expr = self.parseexpr()
+            self.expect(')')
+            return expr
+        if tok[0] == 'op' and tok[1] == '[':
+            elems = []
+            while not self.isop(']'):
+                elems.append(self.parseexpr())
+                if not self.isop(']'):
+                    self.expect(',')
+            self.expect(']')
+            return ('array', elems)
+        self.pos -= 1
+        self.error(f'unexpected {tok[1]!r}')
+
+def stmtnames(stmt, res=None, header=False):
+    # All the names a statement mentions, in order. With header set, a
+    # compound statement contributes only its header.
+    if res is None:
+        res = []
+    if not isinstance(stmt, tuple):
+        return res
+    match stmt[0]:
+        case 'name':
+            res.append(stmt[1])
+            return res
+        case 'var':
+            res.append(stmt[1])
+        case 'for':
+            for sub in stmt[1:4]:
+                stmtnames(sub, res)
+            if not header:
+                for sub in stmt[4]:
+                    stmtnames(sub, res)
+            return res
+        case 'if':
+            stmtnames(stmt[1], res)
+            if not header:
+                for sub in stmt[2] + (stmt[3] or []):
+                    stmtnames(sub, res)
+            return res
+    for sub in stmt[1:]:
+        if isinstance(sub, list):
+            for val in sub:
+                stmtnames(val, res)
+        else:
+            stmtnames(sub, res)
+    return res
+
+def js_div(a, b):
+    if b == 0:
+        return 0.0
+    return a / b
+
+def js_mod(a, b):
+    # Pixelblaze's mod() takes the sign of the divisor, like Python's %.
+    if b == 0:
+        return 0.0
+    return a % b
+
+def js_frac(a):
+    return a - math.trunc(a)
+
+def js_triangle(a):
+    return 1 - abs(2*(a % 1) - 1)
+
+BINARY_FUNCS = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': js_div,
+    '%': lambda a, b: math.fmod(a, b) if b else 0.0,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+
+class Interpreter:
+    def __init__(self, text, pixels=240, seed=None):
+        names = '|'.join(sorted(Node.allclassmap, key=len, reverse=True))
+        self.pat_nodeid = re.compile(f'^((?:{names})_[0-9]+)(?:_|$)')
+
+        self.pixels = pixels
+        self.random = random.Random(seed)
+        self.perlinwrap = 0
+        self.globals = { 'PI': math.pi, 'PI2': 2*math.pi, 'pixelCount': pixels }
+        self.functions = {}
+        self.output = [ (0.0, 0.0, 0.0) ] * pixels
+        self.curpixel = 0
+
+        # Operation counts. The counter is a one-element list so that
+        # the compiled closures can bump it cheaply; it's attributed to
+        # the current function and stanza whenever either changes.
+        self.counter = [0]
+        self.mark = 0
+        self.curfunc = '(startup)'
+        self.curlabel = None
+        self.funcops = {}
+        self.stanzaops = {}
+        self.calls = {}
+        self.frames = 0
+
+        self.builtins = {
+            'abs': abs,
+            'floor': lambda a: float(math.floor(a)),
+            'ceil': lambda a: float(math.ceil(a)),
+            'round': lambda a: float(math.floor(a+0.5)),
+            'frac': js_frac,
+            'sqrt': lambda a: math.sqrt(a) if a > 0 else 0.0,
+            'sin': math.sin,
+            'cos': math.cos,
+            'pow': self.builtin_pow,
+            'min': min,
+            'max': max,
+            'clamp': lambda a, lo, hi: min(max(a, lo), hi),
+            'mix': lambda a, b, w: a + (b-a) * w,
+            'mod': js_mod,
+            'triangle': js_triangle,
+            'square': lambda a, duty: (1.0 if (a % 1) < duty else 0.0),
+            'random': lambda a: self.random.random() * a,
+            'array': lambda count: [ 0.0 ] * int(count),
+            'perlinTurbulence': self.builtin_perlinturbulence,
+            'setPerlinWrap': self.builtin_setperlinwrap,
+            'rgb': self.builtin_rgb,
+        }
+
+        prog = Parser(text).parseprogram()
+        startup = []
+        for stmt in prog:
+            if stmt[0] == 'function':
+                self.functions[stmt[1]] = self.compilefunction(stmt)
+            else:
+                startup.append(stmt)
+        if 'render' not in self.functions:
+            raise Exception('no render function')
+        run = self.compileblock(startup, scope=None)
+        run(None)
+        self.flush()
+        self.startupops = self.counter[0]
+        self.resetcounts()
+
+    def builtin_pow(self, a, b):
+        try:
+            return math.pow(a, b)
+        except (ValueError, ZeroDivisionError, OverflowError):
+            return 0.0
+
+    def builtin_perlinturbulence(self, x, y, z, lacunarity, gain, octaves):
+        # perlin.py needs numpy, so only noise scripts import it
+        from .perlin import perlin_turbulence
+        return float(perlin_turbulence(x, y, z, lacunarity, gain, octaves, self.perlinwrap))
+
+    def builtin_setperlinwrap(self, x, y, z):
+        self.perlinwrap = int(x)
+        return 0.0
+
+    def builtin_rgb(self, r, g, b):
+        self.output[self.curpixel] = (r, g, b)
+        return 0.0
+
+    def flush(self):
+        # Attribute the operations since the last flush.
+        count = self.counter[0] - self.mark
+        if count:
+            self.funcops[self.curfunc] = self.funcops.get(self.curfunc, 0) + count
+            self.stanzaops[self.curlabel] = self.stanzaops.get(self.curlabel, 0) + count
+            self.mark = self.counter[0]
+
+    def frame(self, delta):
+        # Run beforeRender() for delta seconds, then render() for every
+        # pixel. Returns a list of (r, g, b) values.
+        self.callfunction('beforeRender', [ delta * 1000 ])
+        for ix in range(self.pixels):
+            self.curpixel = ix
+            self.callfunction('render', [ float(ix) ])
+        self.frames += 1
+        return list(self.output)
+
+    def callfunction(self, name, args):
+        func = self.functions.get(name)
+        if func is None:
+            return 0.0
+        return func(args)
+
+    def labelfor(self, names):
+        for name in names:
+            match = self.pat_nodeid.match(name)
+            if match:
+                return match.group(1)
+        return None
+
+    def stmtlabel(self, stmt):
+        # The stanza a statement belongs to: the first node id in the
+        # statement (or in a compound statement's header), or else the
+        # one node id its body uses throughout.
+        label = self.labelfor(stmtnames(stmt, header=True))
+        if label or stmt[0] not in ('for', 'if'):
+            return label
+        sublabels = set()
+        body = stmt[4] if stmt[0] == 'for' else stmt[2] + (stmt[3] or [])
+        for sub in body:
+            sublabels.add(self.stmtlabel(sub))
+        sublabels.discard(None)
+        if len(sublabels) == 1:
+            return sublabels.pop()
+        return None
+
+    def compilefunction(self, stmt):
+        (_, name, params, body) = stmt
+        scope = set(params)
+        findlocals(body, scope)
+        run = self.compileblock(body, scope)
+        def func(args):
+            self.flush()
+            prevfunc = self.curfunc
+            self.curfunc = name
+            frame = dict(zip(params, args))
+            sig = run(frame)
+            self.flush()
+            self.curfunc = prevfunc
+            if isinstance(sig, Return):
+                return sig.value
+            return 0.0
+        return func
+
+    def compileblock(self, stmts, scope):
+        funcs = [ self.compilelabeled(stmt, scope) for stmt in stmts ]
+        if len(funcs) == 1:
+            return funcs[0]
+        def run(frame):
+            for func in funcs:
+                sig = func(frame)
+                if sig is not None:
+                    return sig
+        return run
+
+    def compilelabeled(self, stmt, scope):
+        run = self.compilestatement(stmt, scope)
+        label = self.stmtlabel(stmt)
+        if label is None:
+            return run
+        def labeled(frame):
+            if self.curlabel == label:
+                return run(frame)
+            self.flush()
+            prevlabel = self.curlabel
+            self.curlabel = label
+            sig = run(frame)
+            self.flush()
+            self.curlabel = prevlabel
+            return sig
+        return labeled
+
+    def compilestatement(self, stmt, scope):
+        match stmt[0]:
+            case 'var':
+                (_, name, expr) = stmt
+                if expr is None:
+                    expr = ('num', 0.0)
+                return self.compileassign(('name', name), '=', expr, scope)
+            case 'assign':
+                (_, target, op, expr) = stmt
+                return self.compileassign(target, op, expr, scope)
+            case 'expr':
+                evalexpr = self.compileexpr(stmt[1], scope)
+                def run(frame):
+                    evalexpr(frame)
+                return run
+            case 'for':
+                (_, init, cond, update, body) = stmt
+                runinit = self.compilestatement(init, scope)
+                evalcond = self.compileexpr(cond, scope)
+                runupdate = self.compilestatement(update, scope)
+                runbody = self.compileblock(body, scope)
+                def run(frame):
+                    runinit(frame)
+                    while evalcond(frame):
+                        sig = runbody(frame)
+                        if sig is not None:
+                            if sig is BREAK:
+                                break
+                            if sig is not CONTINUE:
+                                return sig
+                        runupdate(frame)
+                return run
+            case 'if':
+                (_, cond, body, elsebody) = stmt
+                evalcond = self.compileexpr(cond, scope)
+                runbody = self.compileblock(body, scope)
+                runelse = self.compileblock(elsebody, scope) if elsebody else None
+                def run(frame):
+                    if evalcond(frame):
+                        return runbody(frame)
+                    elif runelse is not None:
+                        return runelse(frame)
+                return run
+            case 'break':
+                return lambda frame: BREAK
+            case 'continue':
+                return lambda frame: CONTINUE
+            case 'return':
+                if stmt[1] is None:
+                    return lambda frame: Return(0.0)
+                evalexpr = self.compileexpr(stmt[1], scope)
+                return lambda frame: Return(evalexpr(frame))
+            case 'function':
+                raise Exception('nested functions are not supported')
+            case _:
+                raise Exception(f'unknown statement: {stmt[0]}')
+
+    def compileassign(self, target, op, expr, scope):
+        evalexpr = self.compileexpr(expr, scope)
+        combine = BINARY_FUNCS[op[0]] if op != '=' else None
+        counter = self.counter
+        if target[0] == 'name':
+            name = target[1]
+            if scope is not None and name in scope:
+                if combine is None:
+                    def run(frame):
+                        frame[name] = evalexpr(frame)
+                else:
+                    def run(frame):
+                        val = evalexpr(frame)
+                        counter[0] += 1
+                        frame[name] = combine(frame.get(name, 0.0), val)
+            else:
+                glob = self.globals
+                if combine is None:
+                    def run(frame):
+                        glob[name] = evalexpr(frame)
+                else:
+                    def run(frame):
+                        val = evalexpr(frame)
+                        counter[0] += 1
+                        glob[name] = combine(glob.get(name, 0.0), val)
+            return run
+        (_, arrexpr, indexexpr) = target
+        evalarr = self.compileexpr(arrexpr, scope)
+        evalindex = self.compileexpr(indexexpr, scope)
+        def run(frame):
+            arr = evalarr(frame)
+            index = int(evalindex(frame))
+            val = evalexpr(frame)
+            counter[0] += 1
+            if 0 <= index < len(arr):
+                if combine is None:
+                    arr[index] = val
+                else:
+                    counter[0] += 1
+                    arr[index] = combine(arr[index], val)
+        return run
+
+    def compileexpr(self, expr, scope):
+        counter = self.counter
+        match expr[0]:
+            case 'num':
+                val = expr[1]
+                return lambda frame: val
+            case 'name':
+                name = expr[1]
+                if scope is not None and name in scope:
+                    return lambda frame: frame.get(name, 0.0)
+                glob = self.globals
+                return lambda frame: glob.get(name, 0.0)
+            case 'array':
+                evalelems = [ self.compileexpr(elem, scope) for elem in expr[1] ]
+                return lambda frame: [ evalelem(frame) for evalelem in evalelems ]
+            case 'index':
+                evalarr = self.compileexpr(expr[1], scope)
+                evalindex = self.compileexpr(expr[2], scope)
+                def evalfunc(frame):
+                    arr = evalarr(frame)
+                    index = int(evalindex(frame))
+                    counter[0] += 1
+                    if 0 <= index < len(arr):
+                        return arr[index]
+                    return 0.0
+                return evalfunc
+            case 'unop':
+                evalarg = self.compileexpr(expr[2], scope)
+                if expr[1] == '-':
+                    def evalfunc(frame):
+                        counter[0] += 1
+                        return -evalarg(frame)
+                else:
+                    def evalfunc(frame):
+                        counter[0] += 1
+                        return 0.0 if evalarg(frame) else 1.0
+                return evalfunc
+            case 'binop':
+                op = expr[1]
+                evalarg1 = self.compileexpr(expr[2], scope)
+                evalarg2 = self.compileexpr(expr[3], scope)
+                if op == '&&':
+                    def evalfunc(frame):
+                        counter[0] += 1
+                        return evalarg1(frame) and evalarg2(frame)
+                elif op == '||':
+                    def evalfunc(frame):
+                        counter[0] += 1
+                        return evalarg1(frame) or evalarg2(frame)
+                else:
+                    func = BINARY_FUNCS[op]
+                    def evalfunc(frame):
+                        counter[0] += 1
+                        return func(evalarg1(frame), evalarg2(frame))
+                return evalfunc
+            case 'cond':
+                evaltest = self.compileexpr(expr[1], scope)
+                evalarg1 = self.compileexpr(expr[2], scope)
+                evalarg2 = self.compileexpr(expr[3], scope)
+                def evalfunc(frame):
+                    counter[0] += 1
+                    return evalarg1(frame) if evaltest(frame) else evalarg2(frame)
+                return evalfunc
+            case 'call':
+                name = expr[1]
+                evalargs = [ self.compileexpr(arg, scope) for arg in expr[2] ]
+                calls = self.calls
+                if name in self.builtins:
+                    func = self.builtins[name]
+                    def evalfunc(frame):
+                        args = [ evalarg(frame) for evalarg in evalargs ]
+                        counter[0] += 1
+                        calls[name] = calls.get(name, 0) + 1
+                        return func(*args)
+                else:
+                    functions = self.functions
+                    def evalfunc(frame):
+                        args = [ evalarg(frame) for evalarg in evalargs ]
+                        counter[0] += 1
+                        calls[name] = calls.get(name, 0) + 1
+                        func = functions.get(name)
+                        if func is None:
+                            raise Exception(f'unknown function: {name}')
+                        return func(args)
+                return evalfunc
+            case _:
+                raise Exception(f'unknown expression: {expr[0]}')
+
+    def resetcounts(self):
+        # Forget the counts so far.
+        self.flush()
+        self.funcops.clear()
+        self.stanzaops.clear()
+        self.calls.clear()
+        self.frames = 0
+
+    def write(self, outfl=None):
+        # Print the counts, per frame.
+        if outfl is None:
+            outfl = sys.stdout
+        frames = max(1, self.frames)
+        outfl.write(f'frames: {self.frames}, pixels: {self.pixels}\n')
+        outfl.write(f'startup: {self.startupops} ops\n')
+        outfl.write('ops per frame, by function:\n')
+        for name, count in sorted(self.funcops.items(), key=lambda ent: -ent[1]):
+            outfl.write(f'  {name}: {count/frames:.1f}\n')
+        outfl.write('ops per frame, by stanza:\n')
+        for label, count in sorted(self.stanzaops.items(), key=lambda ent: -ent[1]):
+            outfl.write(f'  {label or "(other)"}: {count/frames:.1f}\n')
+        outfl.write('calls per frame:\n')
+        for name, count in sorted(self.calls.items(), key=lambda ent: -ent[1]):
+            outfl.write(f'  {name}: {count/frames:.1f}\n')
+
+def findlocals(stmts, scope):
+    # JS var declarations are function-scoped.
+    for stmt in stmts:
+        match stmt[0]:
+            case 'var':
+                scope.add(stmt[1])
+            case 'for':
+                findlocals([ stmt[1] ], scope)
+                findlocals(stmt[4], scope)
+            case 'if':
+                findlocals(stmt[2], scope)
+                if stmt[3]:
+                    findlocals(stmt[3], scope)
+
+# Late imports
+from .compile import Node
@@ -0,0 +1,349 @@
+# The generated code, as a tree of expressions and statements. Nodes build
+# these rather than strings, so that later stages can look inside what
+# was generated (see exprnames()). formatstmts() turns a list of
+# statements (or any iterable, so they can be generated as they're
+# printed) into Pixelblaze source.
+#
+# There's no operator precedence here: an expression prints exactly as it
+# was built, so a Paren goes wherever parentheses are wanted. Printing
+# walks an explicit stack, since a sum or a chain of max() calls can have
+# thousands of terms.
+
+class Expr:
+    __slots__ = ()
+
+    def pieces(self):
+        # The strings and subexpressions which make up the printed form,
+        # in order.
+        raise NotImplementedError('pieces: %s' % (self.__class__.__name__,))
+
+    def push(self, stack, res):
+        # Used by formatexpr(): push the pieces onto the stack, last
+        # first. (Leaves can append their text straight to res.)
+        stack.extend(reversed(self.pieces()))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, formatexpr(self),)
+
+class Num(Expr):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def pieces(self):
+        return [ str(self.value) ]
+
+    def push(self, stack, res):
+        res.append(str(self.value))
+
+class Name(Expr):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def pieces(self):
+        return [ self.name ]
+
+    def push(self, stack, res):
+        res.append(self.name)
+
+class Index(Expr):
+    __slots__ = ('base', 'index')
+
+    def __init__(self, base, index):
+        self.base = base
+        self.index = index
+
+    def pieces(self):
+        return [ self.base, '[', self.index, ']' ]
+
+class Call(Expr):
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def pieces(self):
+        res = [ self.func+'(' ]
+        for ix, arg in enumerate(self.args):
+            if ix:
+                res.append(', ')
+            res.append(arg)
+        res.append(')')
+        return res
+
+    def push(self, stack, res):
+        res.append(self.func+'(')
+        stack.append(')')
+        args = self.args
+        for ix in range(len(args)-1, 0, -1):
+            stack.append(args[ix])
+            stack.append(', ')
+        if args:
+            stack.append(args[0])
+
+class Op(Expr):
+    # A binary operator applied across two or more operands, as in
+    # "a + b + c". The operator is written with spaces around it if
+    # spaced is set.
+    __slots__ = ('op', 'args', 'spaced')
+
+    def __init__(self, op, args, spaced=False):
+        self.op = op
+        self.args = args
+        self.spaced = spaced
+
+    def pieces(self):
+        sep = f' {self.op} ' if self.spaced else self.op
+        res = []
+        for ix, arg in enumerate(self.args):
+            if ix:
+                res.append(sep)
+            res.append(arg)
+        return res
+
+    def push(self, stack, res):
+        sep = f' {self.op} ' if self.spaced else self.op
+        args = self.args
+        for ix in range(len(args)-1, 0, -1):
+            stack.append(args[ix])
+            stack.append(sep)
+        stack.append(args[0])
+
+class Unary(Expr):
+    __slots__ = ('op', 'arg')
+
+    def __init__(self, op, arg):
+        self.op = op
+        self.arg = arg
+
+    def pieces(self):
+        return [ self.op, self.arg ]
+
+class Cond(Expr):
+    __slots__ = ('test', 'iftrue', 'iffalse')
+
+    def __init__(self, test, iftrue, iffalse):
+        self.test = test
+        self.iftrue = iftrue
+        self.iffalse = iffalse
+
+    def pieces(self):
+        return [ self.test, ' ? ', self.iftrue, ' : ', self.iffalse ]
+
+class Paren(Expr):
+    __slots__ = ('arg',)
+
+    def __init__(self, arg):
+        self.arg = arg
+
+    def pieces(self):
+        return [ '(', self.arg, ')' ]
+
+    def push(self, stack, res):
+        res.append('(')
+        stack.append(')')
+        stack.append(self.arg)
+
+class ArrayLit(Expr):
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def pieces(self):
+        res = [ '[' ]
+        for ix, item in enumerate(self.items):
+            if ix:
+                res.append(', ')
+            res.append(item)
+        res.append(']')
+        return res
+
+# Expressions are never modified once built, so they can be shared. These
+# two turn up everywhere.
+IX = Name('ix')
+PIXELCOUNT = Name('pixelCount')
+
+def formatexpr(expr):
+    res = []
+    stack = [ expr ]
+    while stack:
+        val = stack.pop()
+        if type(val) is str:
+            res.append(val)
+        else:
+            val.push(stack, res)
+    return ''.join(res)
+
+def exprnames(expr):
+    # The variable names which an expression refers to.
+    res = set()
+    stack = [ expr ]
+    while stack:
+        val = stack.pop()
+        if isinstance(val, Name):
+            res.add(val.name)
+        elif isinstance(val, Expr):
+            stack.extend(val.pieces())
+    return res
+
+class Stmt:
+    __slots__ = ()
+
+    def emit(self, out, indent):
+        # Append the printed lines to out.
+        raise NotImplementedError('emit: %s' % (self.__class__.__name__,))
+
+class Raw(Stmt):
+    # Literal source text, printed as is (with no indentation).
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def emit(self, out, indent):
+        out.append(self.text)
+
+class Blank(Stmt):
+    __slots__ = ()
+
+    def emit(self, out, indent):
+        out.append('\n')
+
+class Comment(Stmt):
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def emit(self, out, indent):
+        out.append(f'{"  "*indent}// {self.text}\n')
+
+class Decl(Stmt):
+    __slots__ = ('name', 'expr', 'comment')
+
+    def __init__(self, name, expr=None, comment=None):
+        self.name = name
+        self.expr = expr
+        self.comment = comment
+
+    def emit(self, out, indent):
+        ln = f'{"  "*indent}var {self.name}'
+        if self.expr is not None:
+            ln += ' = ' + formatexpr(self.expr)
+        if self.comment:
+            ln += '  // ' + self.comment
+        out.append(ln+'\n')
+
+class Assign(Stmt):
+    __slots__ = ('target', 'expr', 'op')
+
+    def __init__(self, target, expr, op='='):
+        self.target = target
+        self.expr = expr
+        self.op = op
+
+    def emit(self, out, indent):
+        out.append(f'{"  "*indent}{formatexpr(self.target)} {self.op} {formatexpr(self.expr)}\n')
+
+class ExprStmt(Stmt):
+    __slots__ = ('expr',)
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def emit(self, out, indent):
+        out.append(f'{"  "*indent}{formatexpr(self.expr)}\n')
+
+class Break(Stmt):
+    __slots__ = ()
+
+    def emit(self, out, indent):
+        out.append(f'{"  "*indent}break\n')
+
+class Continue(Stmt):
+    __slots__ = ()
+
+    def emit(self, out, indent):
+        out.append(f'{"  "*indent}continue\n')
+
+class If(Stmt):
+    # If orelse is a single If, it prints as "else if". An inline If puts
+    # its (one) statement on the same line.
+    __slots__ = ('cond', 'body', 'orelse', 'inline')
+
+    def __init__(self, cond, body, orelse=None, inline=False):
+        self.cond = cond
+        self.body = body
+        self.orelse = orelse
+        self.inline = inline
+
+    def emit(self, out, indent):
+        indentstr = '  '*indent
+        if self.inline:
+            assert len(self.body) == 1 and not self.orelse
+            out.append(f'{indentstr}if ({formatexpr(self.cond)}) {{ {formatstmts(self.body).strip()} }}\n')
+            return
+        out.append(f'{indentstr}if ({formatexpr(self.cond)}) {{\n')
+        emitbody(self.body, out, indent+1)
+        orelse = self.orelse
+        while orelse:
+            if len(orelse) == 1 and isinstance(orelse[0], If) and not orelse[0].inline:
+                out.append(f'{indentstr}}} else if ({formatexpr(orelse[0].cond)}) {{\n')
+                emitbody(orelse[0].body, out, indent+1)
+                orelse = orelse[0].orelse
+            else:
+                out.append(f'{indentstr}}} else {{\n')
+                emitbody(orelse, out, indent+1)
+                orelse = None
+        out.append(f'{indentstr}}}\n')
+
+class For(Stmt):
+    # for (var VAR=START; VAR<END; VAR++) { BODY }
+    # If the bounds are only known at run time, trips may give a typical
+    # number of passes (as an expression) for the cost model.
+    __slots__ = ('var', 'start', 'end', 'body', 'trips')
+
+    def __init__(self, var, start, end, body, trips=None):
+        self.var = var
+        self.start = start
+        self.end = end
+        self.body = body
+        self.trips = trips
+
+    def emit(self, out, indent):
+        indentstr = '  '*indent
+        var = self.var
+        out.append(f'{indentstr}for (var {var}={formatexpr(self.start)}; {var}<{formatexpr(self.end)}; {var}++) {{\n')
+        emitbody(self.body, out, indent+1)
+        out.append(f'{indentstr}}}\n')
+
+class Function(Stmt):
+    # The body may be a generator, which is consumed when printed.
+    __slots__ = ('name', 'params', 'body', 'export')
+
+    def __init__(self, name, params, body, export=False):
+        self.name = name
+        self.params = params
+        self.body = body
+        self.export = export
+
+    def emit(self, out, indent):
+        indentstr = '  '*indent
+        prefix = 'export ' if self.export else ''
+        out.append(f'{indentstr}{prefix}function {self.name}({", ".join(self.params)}) {{\n')
+        emitbody(self.body, out, indent+1)
+        out.append(f'{indentstr}}}\n')
+
+def emitbody(body, out, indent):
+    for stmt in body:
+        stmt.emit(out, indent)
+
+def formatstmts(stmts, indent=0):
+    out = []
+    emitbody(stmts, out, indent)
+    return ''.join(out)
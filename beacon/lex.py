@@ -1,32 +1,31 @@
+import sys
 import re
 from enum import StrEnum
 
-pat_white = re.compile('^[ \t]+')
-pat_symbol = re.compile('^[a-zA-Z_][a-zA-Z_0-9]*')
-pat_number = re.compile('^[-]?[0-9]*[.]?[0-9]+')
-pat_color = re.compile('^[$][0-9a-fA-F]+')
-
-def parselines(fl):
-    lines = []
+# One pattern for every token (and the whitespace before it). The lexer
+# walks an index through the whole file, matching this at each position.
+pat_token = re.compile(r'''[ \t]*(?:
+    (?P<symbol>[a-zA-Z_][a-zA-Z_0-9]*)
+  | (?P<num>[-]?[0-9]*[.]?[0-9]+)
+  | (?P<color>[$][0-9a-fA-F]+)
+  | (?P<colon>:)
+  | (?P<comma>,)
+  | (?P<equals>=)
+)''', re.VERBOSE)
+
+pat_indent = re.compile('[ \t]*')
+
+def parselines(fl, firstline=1):
+    text = fl.read()
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    lines = [ ln.rstrip() for ln in lines ]
+    
     trees = []
     stack = [ (0, trees ) ]
     
-    for ln in fl.readlines():
-        ln = ln.rstrip()
-        lines.append(ln)
-        
-        match = pat_white.match(ln)
-        if not match:
-            indent = 0
-        else:
-            val = match.group(0)
-            indent = len(val.replace('\t', '    '))
-            cut = len(val)
-            ln = ln[ cut : ]
-        if not ln or ln.startswith('#'):
-            continue
-        ls = lex(ln)
-
+    for (lineno, indent, ls) in lexlines(text, firstline):
         lnterms = parseline(ls)
 
         (curindent, curls) = stack[-1]
@@ -35,16 +34,16 @@ def parselines(fl):
             del stack[-1]
             curindent, curls = stack[-1]
             if indent > curindent:
-                raise Exception('indent mismatch')
+                raise Exception(f'line {lineno}: indent mismatch')
 
         if indent > curindent:
             lastindent, lastls = stack[-1]
             if not lastls:
-                raise Exception('indenting on nothing')
+                raise Exception(f'line {lineno}: indenting on nothing')
             lastitem = lastls[-1]
             if lnterms:
                 if lastitem.tok.typ != TokType.SYMBOL:
-                    raise Exception('only symbols can have args')
+                    raise Exception(f'line {lineno}: only symbols can have args')
                 lastitem.args.extend(lnterms)
             stack.append( (indent, lastitem.args) )
             continue
@@ -64,9 +63,13 @@ class TokType(StrEnum):
     QUOTE = 'QUOTE'
 
 class Token:
-    def __init__(self, typ, val=None):
+    __slots__ = ('typ', 'val', 'line', 'col')
+
+    def __init__(self, typ, val=None, line=None, col=None):
         self.typ = typ
         self.val = val
+        self.line = line
+        self.col = col
 
     def __repr__(self):
         if self.val is None:
@@ -87,67 +90,66 @@ class Token:
             case _:
                 return str(self.val)
 
-def lex(ln):
+def lexlines(text, firstline=1):
+    # Lex a whole file. Yields (lineno, indent, tokens) for each line
+    # which has tokens; blank lines and comment lines are skipped.
+    pos = 0
+    lineno = firstline-1
+    while pos < len(text):
+        lineno += 1
+        eol = text.find('\n', pos)
+        if eol < 0:
+            eol = len(text)
+        match = pat_indent.match(text, pos, eol)
+        start = match.end()
+        if start < eol and text[start] != '#':
+            indent = len(match.group().replace('\t', '    '))
+            ls = lexspan(text, start, eol, lineno, pos)
+            if ls:
+                yield (lineno, indent, ls)
+        pos = eol+1
+
+def lexspan(text, pos, end, lineno, linestart):
+    # Lex text[pos:end], which is all on one line (beginning at
+    # linestart).
     res = []
-    while ln:
-        match = pat_white.match(ln)
-        if match:
-            val = match.group(0)
-            ln = ln[ len(val) : ]
-        if not ln:
-            break
-
-        if ln.startswith(':'):
-            tok = Token(TokType.COLON)
-            res.append(tok)
-            ln = ln[ 1 : ]
-            continue
-            
-        if ln.startswith(','):
-            tok = Token(TokType.COMMA)
-            res.append(tok)
-            ln = ln[ 1 : ]
-            continue
-            
-        if ln.startswith('='):
-            tok = Token(TokType.EQUALS)
-            res.append(tok)
-            ln = ln[ 1 : ]
-            continue
-            
-        match = pat_symbol.match(ln)
-        if match:
-            val = match.group(0)
-            tok = Token(TokType.SYMBOL, val)
-            res.append(tok)
-            ln = ln[ len(val) : ]
-            continue
-
-        match = pat_number.match(ln)
-        if match:
-            val = match.group(0)
-            fval = float(val)
-            tok = Token(TokType.NUM, fval)
-            res.append(tok)
-            ln = ln[ len(val) : ]
-            continue
-
-        match = pat_color.match(ln)
-        if match:
-            val = match.group(0)
+    while pos < end:
+        match = pat_token.match(text, pos, end)
+        if not match:
+            pos = pat_indent.match(text, pos, end).end()
+            rest = text[ pos : end ].rstrip()
+            if not rest:
+                break
+            raise Exception(f'line {lineno}, col {pos-linestart+1}: invalid character: {rest}')
+        typ = match.lastgroup
+        col = match.start(typ)-linestart+1
+        pos = match.end()
+        if typ == 'symbol':
+            # Scripts use the same few symbols over and over.
+            tok = Token(TokType.SYMBOL, sys.intern(match.group(typ)), lineno, col)
+        elif typ == 'num':
+            tok = Token(TokType.NUM, float(match.group(typ)), lineno, col)
+        elif typ == 'color':
+            val = match.group(typ)
             if len(val) not in [ 4, 7 ]:
-                raise Exception('invalid color length: ' + val)
-            tok = Token(TokType.COLOR, val)
-            res.append(tok)
-            ln = ln[ len(val) : ]
-            continue
-
-        raise Exception('invalid character: ' + ln)
-        
+                raise Exception(f'line {lineno}, col {col}: invalid color length: {val}')
+            tok = Token(TokType.COLOR, val, lineno, col)
+        elif typ == 'colon':
+            tok = Token(TokType.COLON, None, lineno, col)
+        elif typ == 'comma':
+            tok = Token(TokType.COMMA, None, lineno, col)
+        else:
+            tok = Token(TokType.EQUALS, None, lineno, col)
+        res.append(tok)
     return res
 
+def lex(ln):
+    return lexspan(ln, 0, len(ln), 1, 0)
+
 
 class Term:
+    __slots__ = ('tok', 'name', 'args')
+
     def __init__(self, tok, name=None):
         self.tok = tok
         self.name = name
@@ -164,51 +166,38 @@ class Term:
         return '<Term %s%s%s>' % (namestr, self.tok, argstr)
 
     def dump(self, indent=0):
-        namestr = ''
-        if self.name:
-            namestr = self.name+'='
-        colon = ':' if self.args else ''
-        print('%s%s%s%s' % ('  '*indent, namestr, self.tok, colon))
-        if self.args:
-            for arg in self.args:
-                arg.dump(indent+1)
+        stack = [ (self, indent) ]
+        while stack:
+            (term, indent) = stack.pop()
+            namestr = ''
+            if term.name:
+                namestr = term.name+'='
+            colon = ':' if term.args else ''
+            print('%s%s%s%s' % ('  '*indent, namestr, term.tok, colon))
+            stack.extend(reversed([ (arg, indent+1) for arg in term.args ]))
         
 
 def parseline(ln):
+    # A comma ends a term; a colon ends a term and makes everything after
+    # it (to the end of the line) that term's args. So "a: b, c: d, e"
+    # is a(b, c(d, e)).
     res = []
-    
-    pos = comma_or_colon(ln)
-    if pos is not None and ln[pos].typ is TokType.COMMA:
-        head = ln[ : pos ]
-        ln = ln[ pos+1 : ]
-        term = bareterm(head)
-        res.append(term)
-        restls = parseline(ln)
-        res.extend(restls)
-        return res
-
-    argterms = None
-    if pos is not None and ln[pos].typ is TokType.COLON:
-        args = ln[ pos+1 : ]
-        ln = ln[ : pos ]
-        if args:
-            argterms = parseline(args)
-        
-    term = bareterm(ln)
-    if argterms:
-        if term.tok.typ != TokType.SYMBOL:
-            raise Exception('only symbols can have args')
-        term.args.extend(argterms)
-    res.append(term)
-    return res
-
-def comma_or_colon(ln):
+    cur = res
+    start = 0
     for ix, tok in enumerate(ln):
         if tok.typ is TokType.COMMA:
-            return ix
-        if tok.typ is TokType.COLON:
-            return ix
-    return None
+            cur.append(bareterm(ln[ start : ix ]))
+            start = ix+1
+        elif tok.typ is TokType.COLON:
+            term = bareterm(ln[ start : ix ])
+            if ix+1 < len(ln) and term.tok.typ != TokType.SYMBOL:
+                raise Exception('only symbols can have args')
+            cur.append(term)
+            cur = term.args
+            start = ix+1
+    if start < len(ln) or start == 0 or ln[start-1].typ is not TokType.COLON:
+        cur.append(bareterm(ln[ start : ]))
+    return res
 
 def bareterm(ln):
     nodname = None
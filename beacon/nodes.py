@@ -1,9 +1,19 @@
+import math
+
 from .defs import Implicit, Dim, Color, WaveShape, AxisDep
 from .compile import Node, ArgFormat, wave_sample, compile, find_unquoted_children
+from .compile import constvalue, makeconst, foldvalues, foldassociative
+from .compile import UNBOUNDED, bounds_hull, bounds_add, bounds_neg, bounds_mul
 from .program import Stanza
+from .ir import Num, Name, Index, Call, Op, Unary, Paren, ArrayLit, IX, PIXELCOUNT
+from .ir import Raw, Decl, Assign, ExprStmt, Break, Continue, If, For
 
 class NodeConstant(Node):
     classname = 'constant'
+    __slots__ = ()
+
+    # Constants are always inlined, so there's nothing to gain by merging.
+    shareable = False
 
     argformat = [
         ArgFormat('value', float)
@@ -16,30 +26,27 @@ class NodeConstant(Node):
 
     def finddim(self):
         return Dim.ONE
+
+    def findbounds(self):
+        return (self.args.value, self.args.value)
     
     def isconstant(self):
         return True
     
-    def iszpositive(self):
-        return (self.args.value >= 0)
-    
-    def isznegative(self):
-        return (self.args.value <= 0)
-    
     def isnondecreasing(self):
         return True
     
     def isnonincreasing(self):
         return True
 
-    def isclamped(self):
-        return (self.args.value >= 0 and self.args.value <= 1)
-    
     def generateexpr(self, ctx, component=None):
-        return str(self.args.value)
+        return Num(self.args.value)
 
 class NodeColor(Node):
     classname = 'color'
+    __slots__ = ()
+
+    shareable = False
 
     argformat = [
         ArgFormat('value', Color)
@@ -48,30 +55,32 @@ class NodeColor(Node):
     def __init__(self, ctx, ascol=None):
         Node.__init__(self, ctx)
         if ascol is not None:
-            self.args = self.argclass(value=Color(ascol))
+            if not isinstance(ascol, Color):
+                ascol = Color(ascol)
+            self.args = self.argclass(value=ascol)
 
     def finddim(self):
         return Dim.THREE
+
+    def findbounds(self):
+        col = self.args.value
+        return bounds_hull([ (val, val) for val in (col.red, col.green, col.blue) ])
     
     def isconstant(self):
         return True
     
-    def isclamped(self):
-        return (self.args.value.red >= 0 and self.args.value.red <= 1
-                and self.args.value.green >= 0 and self.args.value.green <= 1
-                and self.args.value.blue >= 0 and self.args.value.blue <= 1)
-    
     def generateexpr(self, ctx, component):
         if component == 'r':
-            return str(self.args.value.red)
+            return Num(self.args.value.red)
         if component == 'g':
-            return str(self.args.value.green)
+            return Num(self.args.value.green)
         if component == 'b':
-            return str(self.args.value.blue)
+            return Num(self.args.value.blue)
         raise Exception('color: no component')
 
 class NodeQuote(Node):
     classname = 'quote'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -80,12 +89,16 @@ class NodeQuote(Node):
 
     def finddim(self):
         return self.args.arg.dim
+
+    def findbounds(self):
+        return self.args.arg.getbounds()
     
     def generateexpr(self, ctx, component=None):
         raise Exception('cannot use quote directly')
 
 class NodeTime(Node):
     classname = 'time'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -95,8 +108,12 @@ class NodeTime(Node):
     def finddim(self):
         return self.args.arg.dim
 
-    def isclamped(self):
-        return self.args.arg.isclamped()
+    def findbounds(self):
+        return self.args.arg.getbounds()
+
+    def foldconst(self):
+        if self.args.arg.isconstant():
+            return self.args.arg
     
     def generateexpr(self, ctx, component=None):
         argdata = self.args.arg.generatedata(ctx=ctx, component=component)
@@ -104,6 +121,7 @@ class NodeTime(Node):
 
 class NodeSpace(Node):
     classname = 'space'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -112,9 +130,13 @@ class NodeSpace(Node):
 
     def finddim(self):
         return self.args.arg.dim
+
+    def findbounds(self):
+        return self.args.arg.getbounds()
     
-    def isclamped(self):
-        return self.args.arg.isclamped()
+    def foldconst(self):
+        if self.args.arg.isconstant():
+            return self.args.arg
     
     def generateexpr(self, ctx, component=None):
         argdata = self.args.arg.generatedata(ctx=ctx, component=component)
@@ -122,6 +144,7 @@ class NodeSpace(Node):
 
 class NodeLinear(Node):
     classname = 'linear'
+    __slots__ = ()
 
     usesimplicit = True
     argformat = [
@@ -131,12 +154,13 @@ class NodeLinear(Node):
 
     def finddim(self):
         return Dim.ONE
-    
-    def iszpositive(self):
-        return self.args.start.iszpositive() and self.args.velocity.iszpositive()
-    
-    def isznegative(self):
-        return self.args.start.isznegative() and self.args.velocity.isznegative()
+
+    def findbounds(self):
+        if self.implicit is Implicit.SPACE:
+            param = (0, 1)
+        else:
+            param = (0, math.inf)
+        return bounds_add(self.args.start.getbounds(), bounds_mul(param, self.args.velocity.getbounds()))
     
     def isnondecreasing(self):
         return self.args.velocity.iszpositive()
@@ -144,14 +168,19 @@ class NodeLinear(Node):
     def isnonincreasing(self):
         return self.args.velocity.isznegative()
 
+    def foldconst(self):
+        if constvalue(self.args.velocity) == 0:
+            return self.args.start
+
     def generateexpr(self, ctx, component=None):
         param = self.generateimplicit(ctx)
         startdata = self.args.start.generatedata(ctx=ctx)
         veldata = self.args.velocity.generatedata(ctx=ctx)
-        return f'({startdata} + {param} * {veldata})'
+        return Paren(Op('+', [ startdata, Op('*', [ param, veldata ], spaced=True) ], spaced=True))
 
 class NodeChanging(Node):
     classname = 'changing'
+    __slots__ = ()
 
     usesimplicit = True
     argformat = [
@@ -163,12 +192,9 @@ class NodeChanging(Node):
 
     def finddim(self):
         return Dim.ONE
-    
-    def iszpositive(self):
-        return self.args.start.iszpositive() and self.args.velocity.iszpositive()
-    
-    def isznegative(self):
-        return self.args.start.isznegative() and self.args.velocity.isznegative()
+
+    def findbounds(self):
+        return bounds_add(self.args.start.getbounds(), bounds_mul((0, math.inf), self.args.velocity.getbounds()))
     
     def isnondecreasing(self):
         return self.args.velocity.iszpositive()
@@ -176,9 +202,9 @@ class NodeChanging(Node):
     def isnonincreasing(self):
         return self.args.velocity.isznegative()
 
-    def printstaticvars(self, outfl, first=False):
+    def generatestaticvars(self, first=False):
         id = self.id
-        outfl.write(f'var {id}_val_accum = 0\n')
+        return [ Decl(f'{id}_val_accum', Num(0)) ]
         
     def generateexpr(self, ctx, component=None):
         if self.implicit is Implicit.SPACE:
@@ -188,16 +214,19 @@ class NodeChanging(Node):
         startdata = self.args.start.generatedata(ctx=ctx)
         veldata = self.args.velocity.generatedata(ctx=ctx)
         # hacky: "accum" lines up with our staticvar
-        ctx.store_val(self, 'accum', f'({id}_val_accum + (delta/1000)*{veldata})')
-        return f'({startdata} + {id}_val_accum)'
+        frametime = Paren(Op('/', [ Name('delta'), Num(1000) ]))
+        ctx.store_val(self, 'accum', Paren(Op('+', [ Name(f'{id}_val_accum'), Op('*', [ frametime, veldata ]) ], spaced=True)), depend=AxisDep.TIME)
+        return Paren(Op('+', [ startdata, Name(f'{id}_val_accum') ], spaced=True))
 
 class NodeRandFlat(Node):
     classname = 'randflat'
+    __slots__ = ()
 
     # We set usesimplicit because the value will vary across time or space;
     # we don't want the compiler to precompute a single "random" value.
     
     usesimplicit = True
+    shareable = False
     argformat = [
         ArgFormat('min', Implicit.TIME),
         ArgFormat('max', Implicit.TIME),
@@ -206,27 +235,27 @@ class NodeRandFlat(Node):
     def finddim(self):
         return Dim.ONE
 
-    def iszpositive(self):
-        return self.args.min.iszpositive() and self.args.max.iszpositive()
-    
-    def isznegative(self):
-        return self.args.min.isznegative() and self.args.max.isznegative()
-    
+    def findbounds(self):
+        return bounds_hull([ self.args.min.getbounds(), self.args.max.getbounds() ])
+
     def generateexpr(self, ctx, component=None):
         # Don't actually use generateimplicit
         mindata = self.args.min.generatedata(ctx=ctx)
         maxdata = self.args.max.generatedata(ctx=ctx)
-        minval = ctx.store_val(self, 'min', mindata)
-        diffval = ctx.store_val(self, 'diff', f'({maxdata}-{minval})')
-        return f'(random({diffval})+{minval})'
+        rangedep = self.args.min.depend | self.args.max.depend
+        minval = ctx.store_val(self, 'min', mindata, depend=rangedep)
+        diffval = ctx.store_val(self, 'diff', Paren(Op('-', [ maxdata, minval ])), depend=rangedep)
+        return Paren(Op('+', [ Call('random', [ diffval ]), minval ]))
     
 class NodeRandNorm(Node):
     classname = 'randnorm'
+    __slots__ = ()
 
     # We set usesimplicit because the value will vary across time or space;
     # we don't want the compiler to precompute a single "random" value.
     
     usesimplicit = True
+    shareable = False
     argformat = [
         ArgFormat('mean', Implicit.TIME, default=0.5),
         ArgFormat('stdev', Implicit.TIME, default=0.25),
@@ -234,16 +263,27 @@ class NodeRandNorm(Node):
 
     def finddim(self):
         return Dim.ONE
+
+    def findbounds(self):
+        # The sum of three random(1) calls is in [0, 3].
+        scale = bounds_mul((-1.5/0.522, 1.5/0.522), self.args.stdev.getbounds())
+        return bounds_add(scale, self.args.mean.getbounds())
     
     def generateexpr(self, ctx, component=None):
         # Don't actually use generateimplicit
         meandata = self.args.mean.generatedata(ctx=ctx)
-        stdevdata = self.args.stdev.generatedata(ctx=ctx)
-        ### constant-fold the stdev/0.522 part if possible?
-        return f'(((random(1)+random(1)+random(1)-1.5)*{stdevdata}/0.522)+{meandata})'
+        stdev = constvalue(self.args.stdev)
+        if stdev is not None:
+            scaledata = Num(round(stdev/0.522, 9))
+        else:
+            stdevdata = self.args.stdev.generatedata(ctx=ctx)
+            scaledata = Op('/', [ stdevdata, Num(0.522) ])
+        rand = Op('-', [ Op('+', [ Call('random', [ Num(1) ]) for ix in range(3) ]), Num(1.5) ])
+        return Paren(Op('+', [ Paren(Op('*', [ Paren(rand), scaledata ])), meandata ]))
     
 class NodeClamp(Node):
     classname = 'clamp'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -256,18 +296,38 @@ class NodeClamp(Node):
         assert self.args.arg.dim is self.args.min.dim
         assert self.args.arg.dim is self.args.max.dim
         return self.args.arg.dim
+
+    def findbounds(self):
+        (arglo, arghi) = self.args.arg.getbounds()
+        (minlo, minhi) = self.args.min.getbounds()
+        (maxlo, maxhi) = self.args.max.getbounds()
+        return (min(max(arglo, minlo), maxlo), min(max(arghi, minhi), maxhi))
     
-    def isclamped(self):
-        return self.args.min.isclamped() and self.args.max.isclamped()
+    def foldconst(self):
+        args = [ self.args.arg, self.args.min, self.args.max ]
+        return foldvalues(self, args, lambda ls: min(max(ls[0], ls[1]), ls[2]))
     
     def generateexpr(self, ctx, component=None):
         argdata = self.args.arg.generatedata(ctx=ctx, component=component)
-        mindata = self.args.min.generatedata(ctx=ctx, component=component)
-        maxdata = self.args.max.generatedata(ctx=ctx, component=component)
-        return 'clamp(%s, %s, %s)' % (argdata, mindata, maxdata,)
+        (arglo, arghi) = self.args.arg.getbounds()
+        # Skip either end that the arg can never pass.
+        needmin = (arglo < self.args.min.getbounds()[1])
+        needmax = (arghi > self.args.max.getbounds()[0])
+        if needmin:
+            mindata = self.args.min.generatedata(ctx=ctx, component=component)
+        if needmax:
+            maxdata = self.args.max.generatedata(ctx=ctx, component=component)
+        if needmin and needmax:
+            return Call('clamp', [ argdata, mindata, maxdata ])
+        if needmin:
+            return Call('max', [ argdata, mindata ])
+        if needmax:
+            return Call('min', [ argdata, maxdata ])
+        return argdata
 
 class NodeLerp(Node):
     classname = 'lerp'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -281,36 +341,45 @@ class NodeLerp(Node):
         assert self.args.arg1.dim is self.args.arg2.dim
         return self.args.arg1.dim
 
-    def isclamped(self):
-        return all([ self.args.weight.isclamped(), self.args.arg1.isclamped(), self.args.arg2.isclamped() ])
+    def findbounds(self):
+        weight = self.args.weight.getbounds()
+        arg1 = self.args.arg1.getbounds()
+        arg2 = self.args.arg2.getbounds()
+        if weight[0] >= 0 and weight[1] <= 1:
+            return bounds_hull([ arg1, arg2 ])
+        # arg1 + (arg2-arg1) * weight
+        return bounds_add(arg1, bounds_mul(bounds_add(arg2, bounds_neg(arg1)), weight))
+
+    def foldconst(self):
+        args = [ self.args.arg1, self.args.arg2, self.args.weight ]
+        return foldvalues(self, args, lambda ls: ls[0] + (ls[1]-ls[0]) * ls[2])
     
     def generateexpr(self, ctx, component=None):
-        weightdata = self.args.weight.generatedata(ctx=ctx)
+        if self.dim is Dim.THREE and self.fusecolor:
+            ctx.note_fused(self)
+            weightdata = self.generateshared(self.args.weight, ctx, key='weight')
+        else:
+            weightdata = self.args.weight.generatedata(ctx=ctx)
         if self.dim is Dim.ONE:
             arg1data = self.args.arg1.generatedata(ctx=ctx)
             arg2data = self.args.arg2.generatedata(ctx=ctx)
-            return f'mix({arg1data}, {arg2data}, {weightdata})'
+            return Call('mix', [ arg1data, arg2data, weightdata ])
         elif self.dim is Dim.THREE:
             argdata = []
             for arg in [self.args.arg1, self.args.arg2]:
                 if arg.dim is Dim.ONE:
-                    if arg.isconstant():
-                        argval = arg.generatedata(ctx=ctx)
-                    else:
-                        argval = ctx.find_val(self, 'common')
-                        if argval is None:
-                            argval = ctx.store_val(self, 'common', arg.generatedata(ctx=ctx))
-                    argdata.append(argval)
+                    argdata.append(self.generateshared(arg, ctx))
                 elif arg.dim is Dim.THREE:
                     argdata.append(arg.generatedata(ctx=ctx, component=component))
                 else:
                     raise Exception('bad dim')
-            return f'mix({argdata[0]}, {argdata[1]}, {weightdata})'
+            return Call('mix', [ argdata[0], argdata[1], weightdata ])
         else:
             raise Exception('bad dim')
 
 class NodeSum(Node):
     classname = 'sum'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -319,6 +388,15 @@ class NodeSum(Node):
 
     def finddim(self):
         return max([ arg.dim for arg in self.args.arg ])
+
+    def findbounds(self):
+        res = (0, 0)
+        for arg in self.args.arg:
+            res = bounds_add(res, arg.getbounds())
+        return res
+
+    def foldconst(self):
+        return foldassociative(self, lambda ls: sum(ls), identity=0)
         
     def generateexpr(self, ctx, component=None):
         argdata = []
@@ -331,11 +409,11 @@ class NodeSum(Node):
             raise Exception('bad dim')
         if len(argdata) == 1:
             return argdata[0]
-        argls = ' + '.join(argdata)
-        return f'({argls})'
+        return Paren(Op('+', argdata, spaced=True))
     
 class NodeMean(Node):
     classname = 'mean'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -344,9 +422,12 @@ class NodeMean(Node):
 
     def finddim(self):
         return max([ arg.dim for arg in self.args.arg ])
-        
-    def isclamped(self):
-        return all([ arg.isclamped() for arg in self.args.arg ])
+
+    def findbounds(self):
+        return bounds_hull([ arg.getbounds() for arg in self.args.arg ])
+
+    def foldconst(self):
+        return foldvalues(self, self.args.arg, lambda ls: sum(ls) / len(ls))
         
     def generateexpr(self, ctx, component=None):
         argdata = []
@@ -359,11 +440,11 @@ class NodeMean(Node):
             raise Exception('bad dim')
         if len(argdata) == 1:
             return argdata[0]
-        argls = ' + '.join(argdata)
-        return f'({argls}) / {len(argdata)}'
+        return Op('/', [ Paren(Op('+', argdata, spaced=True)), Num(len(argdata)) ], spaced=True)
     
 class NodeMul(Node):
     classname = 'mul'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -372,9 +453,15 @@ class NodeMul(Node):
 
     def finddim(self):
         return max([ arg.dim for arg in self.args.arg ])
-        
-    def isclamped(self):
-        return all([ arg.isclamped() for arg in self.args.arg ])
+
+    def findbounds(self):
+        res = (1, 1)
+        for arg in self.args.arg:
+            res = bounds_mul(res, arg.getbounds())
+        return res
+
+    def foldconst(self):
+        return foldassociative(self, lambda ls: math.prod(ls), identity=1)
         
     def generateexpr(self, ctx, component=None):
         argdata = []
@@ -387,11 +474,11 @@ class NodeMul(Node):
             raise Exception('bad dim')
         if len(argdata) == 1:
             return argdata[0]
-        argls = ' * '.join(argdata)
-        return f'({argls})'
+        return Paren(Op('*', argdata, spaced=True))
     
 class NodeMax(Node):
     classname = 'max'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -401,25 +488,35 @@ class NodeMax(Node):
     def finddim(self):
         return max([ arg.dim for arg in self.args.arg ])
 
-    def isclamped(self):
-        return all([ arg.isclamped() for arg in self.args.arg ])
-        
+    def findbounds(self):
+        ls = [ arg.getbounds() for arg in self.args.arg ]
+        return (max([ lo for lo, hi in ls ]), max([ hi for lo, hi in ls ]))
+
+    def foldconst(self):
+        return foldassociative(self, lambda ls: max(ls))
+
     def generateexpr(self, ctx, component=None):
+        # An arg which never exceeds the largest lower bound can be
+        # skipped.
+        args = self.args.arg
+        best = max(args, key=lambda arg: arg.getbounds()[0])
+        args = [ arg for arg in args if arg is best or arg.getbounds()[1] > best.getbounds()[0] ]
         argdata = []
         if self.dim is Dim.ONE:
-            for arg in self.args.arg:
+            for arg in args:
                 argdata.append(arg.generatedata(ctx=ctx))
         elif self.dim is Dim.THREE:
-            argdata = self.generatelistas3(self.args.arg, ctx, component=component)
+            argdata = self.generatelistas3(args, ctx, component=component)
         else:
             raise Exception('bad dim')
         res = argdata[0]
         for dat in argdata[ 1 : ]:
-            res = f'max({res}, {dat})'
+            res = Call('max', [ res, dat ])
         return res
     
 class NodeMin(Node):
     classname = 'min'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -428,26 +525,36 @@ class NodeMin(Node):
 
     def finddim(self):
         return max([ arg.dim for arg in self.args.arg ])
-        
-    def isclamped(self):
-        return all([ arg.isclamped() for arg in self.args.arg ])
+
+    def findbounds(self):
+        ls = [ arg.getbounds() for arg in self.args.arg ]
+        return (min([ lo for lo, hi in ls ]), min([ hi for lo, hi in ls ]))
+
+    def foldconst(self):
+        return foldassociative(self, lambda ls: min(ls))
         
     def generateexpr(self, ctx, component=None):
+        # An arg which never goes below the smallest upper bound can be
+        # skipped.
+        args = self.args.arg
+        best = min(args, key=lambda arg: arg.getbounds()[1])
+        args = [ arg for arg in args if arg is best or arg.getbounds()[0] < best.getbounds()[1] ]
         argdata = []
         if self.dim is Dim.ONE:
-            for arg in self.args.arg:
+            for arg in args:
                 argdata.append(arg.generatedata(ctx=ctx))
         elif self.dim is Dim.THREE:
-            argdata = self.generatelistas3(self.args.arg, ctx, component=component)
+            argdata = self.generatelistas3(args, ctx, component=component)
         else:
             raise Exception('bad dim')
         res = argdata[0]
         for dat in argdata[ 1 : ]:
-            res = f'min({res}, {dat})'
+            res = Call('min', [ res, dat ])
         return res
     
 class NodeMod(Node):
     classname = 'mod'
+    __slots__ = ()
     
     usesimplicit = False
     argformat = [
@@ -458,8 +565,25 @@ class NodeMod(Node):
     def finddim(self):
         return max([ self.args.arg1.dim, self.args.arg2.dim ])
         
-    def isclamped(self):
-        return self.args.arg2.isclamped()
+
+    def findbounds(self):
+        # The result has the sign of the divisor.
+        (lo, hi) = self.args.arg2.getbounds()
+        if lo > 0:
+            return (0, hi)
+        if hi < 0:
+            return (lo, 0)
+        return UNBOUNDED
+
+    def foldconst(self):
+        divisor = constvalue(self.args.arg2)
+        if divisor is None or divisor == 0:
+            return None
+        if isinstance(divisor, Color) and 0 in (divisor.red, divisor.green, divisor.blue):
+            return None
+        # Python's % has the same sign behavior as Pixelblaze's mod()
+        args = [ self.args.arg1, self.args.arg2 ]
+        return foldvalues(self, args, lambda ls: ls[0] % ls[1])
         
     def generateexpr(self, ctx, component=None):
         argdata = []
@@ -471,10 +595,11 @@ class NodeMod(Node):
         else:
             raise Exception('bad dim')
         assert len(argdata) == 2
-        return f'mod({argdata[0]}, {argdata[1]})'
+        return Call('mod', [ argdata[0], argdata[1] ])
     
 class NodeWave(Node):
     classname = 'wave'
+    __slots__ = ()
 
     usesimplicit = True
     argformat = [
@@ -488,70 +613,78 @@ class NodeWave(Node):
     def finddim(self):
         return Dim.ONE
 
-    def iszpositive(self):
-        return self.args.min.iszpositive() and self.args.max.iszpositive()
-    
-    def isznegative(self):
-        return self.args.min.isznegative() and self.args.max.isznegative()
+    def findbounds(self):
+        return bounds_hull([ self.args.min.getbounds(), self.args.max.getbounds() ])
 
-    def isclamped(self):
-        return self.args.min.isclamped() and self.args.max.isclamped()
+    def foldconst(self):
+        # Both of these are constant at max (see wave_sample)
+        if self.args.shape in (WaveShape.FLAT, WaveShape.SQUARE):
+            return self.args.max
     
     def generateexpr(self, ctx, component=None):
         param = self.generateimplicit(ctx)
         mindata = self.args.min.generatedata(ctx=ctx)
         maxdata = self.args.max.generatedata(ctx=ctx)
-        perioddata = self.args.period.generatedata(ctx=ctx)
-        shiftdata = self.args.shift.generatedata(ctx=ctx)
-        hasshift = (shiftdata not in ('0', '0.0'))   # hacky
-        if self.implicit is Implicit.SPACE:
-            if not hasshift:
-                theta = f'(({param}-0.5)/{perioddata}+0.5)'
+        rangedep = self.args.min.depend | self.args.max.depend
+        period = constvalue(self.args.period)
+        shift = constvalue(self.args.shift)
+        if period is not None and shift is not None and period != 0:
+            # Fold the shift and centering into a single offset.
+            if self.implicit is Implicit.SPACE:
+                offset = round(0.5 - (0.5+shift)/period, 9)
             else:
-                ### could constant-fold if shiftdata is constant
-                theta = f'(({param}-(0.5+{shiftdata}))/{perioddata}+0.5)'
+                offset = round(-shift/period, 9)
+            theta = param if period == 1 else Op('/', [ param, Num(period) ])
+            if offset > 0:
+                theta = Paren(Op('+', [ theta, Num(offset) ]))
+            elif offset < 0:
+                theta = Paren(Op('-', [ theta, Num(-offset) ]))
         else:
-            if not hasshift:
-                theta = f'{param}/{perioddata}'
+            perioddata = self.args.period.generatedata(ctx=ctx)
+            shiftdata = self.args.shift.generatedata(ctx=ctx)
+            hasshift = (shift != 0)
+            if self.implicit is Implicit.SPACE:
+                if not hasshift:
+                    centered = Paren(Op('-', [ param, Num(0.5) ]))
+                else:
+                    centered = Paren(Op('-', [ param, Paren(Op('+', [ Num(0.5), shiftdata ])) ]))
+                theta = Paren(Op('+', [ Op('/', [ centered, perioddata ]), Num(0.5) ]))
             else:
-                theta = f'({param} - {shiftdata})/{perioddata}'
+                if not hasshift:
+                    theta = Op('/', [ param, perioddata ])
+                else:
+                    theta = Op('/', [ Paren(Op('-', [ param, shiftdata ], spaced=True)), perioddata ])
             
         match self.args.shape:
-            case WaveShape.FLAT:
+            case WaveShape.FLAT | WaveShape.SQUARE:
                 return maxdata
             case WaveShape.SAWTOOTH:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(mod(%s, 1)))' % (minval, diffval, theta)
+                wave = Call('mod', [ theta, Num(1) ])
             case WaveShape.SAWDECAY:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(1-mod(%s, 1)))' % (minval, diffval, theta)
+                wave = Op('-', [ Num(1), Call('mod', [ theta, Num(1) ]) ])
             case WaveShape.SQRTOOTH:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(pow(mod(%s, 1), 2)))' % (minval, diffval, theta)
+                wave = Call('pow', [ Call('mod', [ theta, Num(1) ]), Num(2) ])
             case WaveShape.SQRDECAY:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(pow(1-mod(%s, 1), 2)))' % (minval, diffval, theta)
+                wave = Call('pow', [ Op('-', [ Num(1), Call('mod', [ theta, Num(1) ]) ]), Num(2) ])
             case WaveShape.TRIANGLE:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(triangle(%s)))' % (minval, diffval, theta)
+                wave = Call('triangle', [ theta ])
             case WaveShape.HALFSQUARE:
-                minval = ctx.store_val(self, 'min', mindata)
-                diffval = ctx.store_val(self, 'diff', '(%s-%s)' % (maxdata, minval,))
-                return '(%s+%s*(square(%s, 0.5)))' % (minval, diffval, theta)
+                wave = Call('square', [ theta, Num(0.5) ])
             case WaveShape.SINE:
-                minval = ctx.store_val(self, 'min', mindata)
-                hdiffval = ctx.store_val(self, 'hdiff', '((%s-%s)*0.5)' % (maxdata, minval,))
-                return '(%s+%s*(1-cos(PI2*%s)))' % (minval, hdiffval, theta)
+                wave = Op('-', [ Num(1), Call('cos', [ Op('*', [ Name('PI2'), theta ]) ]) ])
             case _:
                 raise Exception('unimplemented WaveShape')
+        minval = ctx.store_val(self, 'min', mindata, depend=rangedep)
+        if self.args.shape is WaveShape.SINE:
+            # 1-cos() runs from 0 to 2, so it's scaled by half the range.
+            diffval = ctx.store_val(self, 'hdiff', Paren(Op('*', [ Paren(Op('-', [ maxdata, minval ])), Num(0.5) ])), depend=rangedep)
+        else:
+            diffval = ctx.store_val(self, 'diff', Paren(Op('-', [ maxdata, minval ])), depend=rangedep)
+        return Paren(Op('+', [ minval, Op('*', [ diffval, Paren(wave) ]) ]))
 
 class NodeRGB(Node):
     classname = 'rgb'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -566,6 +699,15 @@ class NodeRGB(Node):
         assert self.args.b.dim is Dim.ONE
         return Dim.THREE
 
+    def findbounds(self):
+        return bounds_hull([ self.args.r.getbounds(), self.args.g.getbounds(), self.args.b.getbounds() ])
+
+    def foldconst(self):
+        vals = [ constvalue(arg) for arg in (self.args.r, self.args.g, self.args.b) ]
+        if None in vals or any([ isinstance(val, Color) for val in vals ]):
+            return None
+        return makeconst(self.implicit, Color(tuple(vals)))
+
     def generateexpr(self, ctx, component=None):
         if component == 'r':
             return self.args.r.generatedata(ctx=ctx, component=None)
@@ -576,6 +718,7 @@ class NodeRGB(Node):
 
 class NodeBrightness(Node):
     classname = 'brightness'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -586,14 +729,25 @@ class NodeBrightness(Node):
         assert self.args.value.dim is Dim.THREE
         return Dim.ONE
 
+    def findbounds(self):
+        # A weighted average of the components
+        return self.args.value.getbounds()
+
+    def foldconst(self):
+        col = constvalue(self.args.value)
+        if col is not None:
+            return makeconst(self.implicit, 0.299 * col.red + 0.587 * col.green + 0.114 * col.blue)
+
     def generateexpr(self, ctx, component=None):
         argdatar = self.args.value.generatedata(ctx=ctx, component='r')
         argdatag = self.args.value.generatedata(ctx=ctx, component='g')
         argdatab = self.args.value.generatedata(ctx=ctx, component='b')
-        return f'(0.299 * {argdatar} + 0.587 * {argdatag} + 0.114 * {argdatab})'
+        terms = [ Op('*', [ Num(0.299), argdatar ], spaced=True), Op('*', [ Num(0.587), argdatag ], spaced=True), Op('*', [ Num(0.114), argdatab ], spaced=True) ]
+        return Paren(Op('+', terms, spaced=True))
 
 class NodeRed(Node):
     classname = 'red'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -604,12 +758,21 @@ class NodeRed(Node):
         assert self.args.value.dim is Dim.THREE
         return Dim.ONE
 
+    def findbounds(self):
+        return self.args.value.getbounds()
+
+    def foldconst(self):
+        col = constvalue(self.args.value)
+        if col is not None:
+            return makeconst(self.implicit, col.red)
+
     def generateexpr(self, ctx, component=None):
         argdatar = self.args.value.generatedata(ctx=ctx, component='r')
         return argdatar
 
 class NodeGreen(Node):
     classname = 'green'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -620,12 +783,21 @@ class NodeGreen(Node):
         assert self.args.value.dim is Dim.THREE
         return Dim.ONE
 
+    def findbounds(self):
+        return self.args.value.getbounds()
+
+    def foldconst(self):
+        col = constvalue(self.args.value)
+        if col is not None:
+            return makeconst(self.implicit, col.green)
+
     def generateexpr(self, ctx, component=None):
         argdatag = self.args.value.generatedata(ctx=ctx, component='g')
         return argdatag
 
 class NodeBlue(Node):
     classname = 'blue'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -636,6 +808,14 @@ class NodeBlue(Node):
         assert self.args.value.dim is Dim.THREE
         return Dim.ONE
 
+    def findbounds(self):
+        return self.args.value.getbounds()
+
+    def foldconst(self):
+        col = constvalue(self.args.value)
+        if col is not None:
+            return makeconst(self.implicit, col.blue)
+
     def generateexpr(self, ctx, component=None):
         argdatab = self.args.value.generatedata(ctx=ctx, component='b')
         return argdatab
@@ -657,9 +837,103 @@ function evalGradient(val, posls, colls, count)
   return colls[count-1]
 }
 '''
+
+def eval_gradient(val, stops):
+    # The compile-time equivalent of evalGradient(). The stop values may
+    # be floats or Colors.
+    def mix(val1, val2, weight):
+        if isinstance(val1, Color):
+            return Color(tuple([ mix(getattr(val1, key), getattr(val2, key), weight) for key in ('red', 'green', 'blue') ]))
+        return round(val1 + (val2-val1) * weight, 9)
+    if val <= stops[0][0]:
+        return stops[0][1]
+    if val >= stops[-1][0]:
+        return stops[-1][1]
+    for ix in range(len(stops)-1):
+        (pos1, stopval1) = stops[ix]
+        (pos2, stopval2) = stops[ix+1]
+        if val < pos2:
+            return mix(stopval1, stopval2, (val-pos1)/(pos2-pos1))
+    return stops[-1][1]
+
+gradient_pos_func = '''
+function gradientPos(val, posls, count)
+{
+  if (val <= posls[0]) {
+    return 0
+  }
+  if (val >= posls[count-1]) {
+    return count-1
+  }
+  for (var ix=0; ix<count-1; ix++) {
+    if (val < posls[ix+1]) {
+      return ix + (val-posls[ix])/(posls[ix+1]-posls[ix])
+    }
+  }
+  return count-1
+}
+'''
+
+def gradient_lut_range(nod, stops):
+    # The (start, scale) which maps a gradient value to a lookup-table
+    # index, or None if the node isn't using a table.
+    if nod.lutsize < 2:
+        return None
+    start = stops[0][0]
+    end = stops[-1][0]
+    if end <= start:
+        return None
+    return (start, round((nod.lutsize-1) / (end-start), 9))
+
+def gradient_lut_statics(nod, stops, comps):
+    # Bake the gradient into a table at startup.
+    res = gradient_lut_range(nod, stops)
+    if res is None:
+        return []
+    start, scale = res
+    id = nod.id
+    size = nod.lutsize
+    count = len(stops)
+    stmts = []
+    for comp in comps:
+        stmts.append(Decl(f'{id}_lut_{comp}', Call('array', [ Num(size) ])))
+    lutpos = Op('/', [ IX, Num(scale) ])
+    if start == 0:
+        body = [ Decl('lutval', lutpos) ]
+    else:
+        body = [ Decl('lutval', Op('+', [ Num(start), lutpos ], spaced=True)) ]
+    for comp in comps:
+        evalexpr = Call('evalGradient', [ Name('lutval'), Name(f'{id}_grad_pos'), Name(f'{id}_grad_{comp}'), Num(count) ])
+        body.append(Assign(Index(Name(f'{id}_lut_{comp}'), IX), evalexpr))
+    stmts.append(For('ix', Num(0), Num(size), body))
+    return stmts
+
+def generate_gradient_lut(nod, ctx, stops, comp):
+    # A table lookup for the gradient value, or None if the node isn't
+    # using a table.
+    res = gradient_lut_range(nod, stops)
+    if res is None:
+        return None
+    start, scale = res
+    id = nod.id
+    argdata = nod.args.arg.generatedata(ctx=ctx)
+    if start == 0:
+        posexpr = Op('*', [ argdata, Num(scale) ])
+    else:
+        posexpr = Op('*', [ Paren(Op('-', [ argdata, Num(start) ])), Num(scale) ])
+    posval = ctx.store_val(nod, 'lutpos', Call('clamp', [ posexpr, Num(0), Num(nod.lutsize-1) ]), depend=nod.args.arg.depend)
+    lut = Name(f'{id}_lut_{comp}')
+    if nod.lutlerp:
+        return mixindexed(lut, posval)
+    return Index(lut, Call('round', [ posval ]))
+
+def mixindexed(arr, pos):
+    # Interpolate between the entries of arr on either side of pos.
+    return Call('mix', [ Index(arr, Call('floor', [ pos ])), Index(arr, Call('ceil', [ pos ])), Call('frac', [ pos ]) ])
     
 class NodeGradient(Node):
     classname = 'gradient'
+    __slots__ = ('lutsize', 'lutlerp')
 
     usesimplicit = False
     argformat = [
@@ -667,17 +941,26 @@ class NodeGradient(Node):
         ArgFormat('arg', Node),
     ]
 
-    def parseargs(self, args, defmap):
+    def __init__(self, ctx):
+        Node.__init__(self, ctx)
+        # Set by Program.post() when gradients are baked into tables
+        self.lutsize = 0
+        self.lutlerp = False
+
+    def argimplicits(self, args):
+        return [ (arg, self.implicit) for arg in args ]
+
+    def parseargs(self, args, defmap, memo=None):
         stops = []
         mainval = None
         for arg in args:
             if arg.tok.val == 'stop':
-                stop = compile(arg, implicit=self.implicit, defmap=defmap)
+                stop = compile(arg, implicit=self.implicit, defmap=defmap, memo=memo)
                 stops.append( (stop.args.pos, stop.args.color) )
                 continue
             if mainval is not None:
                 raise Exception('%s: duplicate arg' % (self.classname,))
-            mainval = compile(arg, implicit=self.implicit, defmap=defmap)
+            mainval = compile(arg, implicit=self.implicit, defmap=defmap, memo=memo)
         if not stops:
             raise Exception('%s: missing stops' % (self.classname,))
         stops.sort()
@@ -687,19 +970,24 @@ class NodeGradient(Node):
         assert self.args.arg.dim is Dim.ONE
         return Dim.THREE
 
-    def isclamped(self):
+    def findbounds(self):
+        ls = []
         for pos, col in self.args.stops:
-            if col.red < 0 or col.red > 1:
-                return False
-            if col.green < 0 or col.green > 1:
-                return False
-            if col.blue < 0 or col.blue > 1:
-                return False
-        return True
+            ls.extend([ (val, val) for val in (col.red, col.green, col.blue) ])
+        return bounds_hull(ls)
+
+    def foldconst(self):
+        val = constvalue(self.args.arg)
+        if val is not None:
+            return makeconst(self.implicit, eval_gradient(val, self.args.stops))
 
-    def printstaticvars(self, outfl, first=False):
+    def generatestaticvars(self, first=False):
+        stmts = []
         if first:
-            outfl.write(eval_gradient_func)
+            if self.fusecolor and not self.lutsize:
+                stmts.append(Raw(gradient_pos_func))
+            else:
+                stmts.append(Raw(eval_gradient_func))
         id = self.id
         posls = []
         colrs = []
@@ -710,23 +998,34 @@ class NodeGradient(Node):
             colrs.append(col.red)
             colgs.append(col.green)
             colbs.append(col.blue)
-        ls = ', '.join([ str(val) for val in posls ])
-        outfl.write(f'var {id}_grad_pos = [{ls}]\n')
-        ls = ', '.join([ str(val) for val in colrs ])
-        outfl.write(f'var {id}_grad_r = [{ls}]\n')
-        ls = ', '.join([ str(val) for val in colgs ])
-        outfl.write(f'var {id}_grad_g = [{ls}]\n')
-        ls = ', '.join([ str(val) for val in colbs ])
-        outfl.write(f'var {id}_grad_b = [{ls}]\n')
+        stmts.append(Decl(f'{id}_grad_pos', ArrayLit([ Num(val) for val in posls ])))
+        stmts.append(Decl(f'{id}_grad_r', ArrayLit([ Num(val) for val in colrs ])))
+        stmts.append(Decl(f'{id}_grad_g', ArrayLit([ Num(val) for val in colgs ])))
+        stmts.append(Decl(f'{id}_grad_b', ArrayLit([ Num(val) for val in colbs ])))
+        stmts.extend(gradient_lut_statics(self, self.args.stops, 'rgb'))
+        return stmts
         
     def generateexpr(self, ctx, component=None):
+        res = generate_gradient_lut(self, ctx, self.args.stops, component)
+        if res is not None:
+            return res
         id = self.id
         count = len(self.args.stops)
+        if self.fusecolor and not self.lutsize:
+            # One search through the stops gives a fractional index,
+            # which serves all three components.
+            ctx.note_fused(self)
+            posval = ctx.find_val(self, 'gradpos')
+            if posval is None:
+                argdata = self.args.arg.generatedata(ctx=ctx)
+                posval = ctx.store_val(self, 'gradpos', Call('gradientPos', [ argdata, Name(f'{id}_grad_pos'), Num(count) ]), depend=self.args.arg.depend)
+            return mixindexed(Name(f'{id}_grad_{component}'), posval)
         argdata = self.args.arg.generatedata(ctx=ctx)
-        return f'evalGradient({argdata}, {id}_grad_pos, {id}_grad_{component}, {count})'
+        return Call('evalGradient', [ argdata, Name(f'{id}_grad_pos'), Name(f'{id}_grad_{component}'), Num(count) ])
     
 class NodeNGradient(Node):
     classname = 'ngradient'
+    __slots__ = ('lutsize', 'lutlerp')
 
     usesimplicit = False
     argformat = [
@@ -734,17 +1033,26 @@ class NodeNGradient(Node):
         ArgFormat('arg', Node),
     ]
 
-    def parseargs(self, args, defmap):
+    def __init__(self, ctx):
+        Node.__init__(self, ctx)
+        # Set by Program.post() when gradients are baked into tables
+        self.lutsize = 0
+        self.lutlerp = False
+
+    def argimplicits(self, args):
+        return [ (arg, self.implicit) for arg in args ]
+
+    def parseargs(self, args, defmap, memo=None):
         nstops = []
         mainval = None
         for arg in args:
             if arg.tok.val == 'nstop':
-                stop = compile(arg, implicit=self.implicit, defmap=defmap)
+                stop = compile(arg, implicit=self.implicit, defmap=defmap, memo=memo)
                 nstops.append( (stop.args.pos, stop.args.value) )
                 continue
             if mainval is not None:
                 raise Exception('%s: duplicate arg' % (self.classname,))
-            mainval = compile(arg, implicit=self.implicit, defmap=defmap)
+            mainval = compile(arg, implicit=self.implicit, defmap=defmap, memo=memo)
         if not nstops:
             raise Exception('%s: missing nstops' % (self.classname,))
         nstops.sort()
@@ -754,34 +1062,41 @@ class NodeNGradient(Node):
         assert self.args.arg.dim is Dim.ONE
         return Dim.ONE
 
-    def isclamped(self):
-        for pos, val in self.args.nstops:
-            if val < 0 or val > 1:
-                return False
-        return True
+    def findbounds(self):
+        return bounds_hull([ (val, val) for pos, val in self.args.nstops ])
+
+    def foldconst(self):
+        val = constvalue(self.args.arg)
+        if val is not None:
+            return makeconst(self.implicit, eval_gradient(val, self.args.nstops))
 
-    def printstaticvars(self, outfl, first=False):
+    def generatestaticvars(self, first=False):
+        stmts = []
         if first:
-            outfl.write(eval_gradient_func)
+            stmts.append(Raw(eval_gradient_func))
         id = self.id
         posls = []
         cols = []
         for pos, val in self.args.nstops:
             posls.append(pos)
             cols.append(val)
-        ls = ', '.join([ str(val) for val in posls ])
-        outfl.write(f'var {id}_grad_pos = [{ls}]\n')
-        ls = ', '.join([ str(val) for val in cols ])
-        outfl.write(f'var {id}_grad_v = [{ls}]\n')
+        stmts.append(Decl(f'{id}_grad_pos', ArrayLit([ Num(val) for val in posls ])))
+        stmts.append(Decl(f'{id}_grad_v', ArrayLit([ Num(val) for val in cols ])))
+        stmts.extend(gradient_lut_statics(self, self.args.nstops, 'v'))
+        return stmts
         
     def generateexpr(self, ctx, component=None):
+        res = generate_gradient_lut(self, ctx, self.args.nstops, 'v')
+        if res is not None:
+            return res
         id = self.id
         count = len(self.args.nstops)
         argdata = self.args.arg.generatedata(ctx=ctx)
-        return f'evalGradient({argdata}, {id}_grad_pos, {id}_grad_v, {count})'
+        return Call('evalGradient', [ argdata, Name(f'{id}_grad_pos'), Name(f'{id}_grad_v'), Num(count) ])
     
 class NodeStop(Node):
     classname = 'stop'
+    __slots__ = ()
     
     argformat = [
         ArgFormat('pos', float),
@@ -793,6 +1108,7 @@ class NodeStop(Node):
 
 class NodeNStop(Node):
     classname = 'nstop'
+    __slots__ = ()
     
     argformat = [
         ArgFormat('pos', float),
@@ -805,6 +1121,7 @@ class NodeNStop(Node):
 
 class NodeDecay(Node):
     classname = 'decay'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -815,6 +1132,12 @@ class NodeDecay(Node):
     def finddim(self):
         return self.args.arg.dim
 
+    def findbounds(self):
+        # The buffer starts at zero, and each frame is max(last*factor, arg)
+        # with 0 < factor <= 1, so it never goes negative.
+        (lo, hi) = self.args.arg.getbounds()
+        return (max(0, lo), max(0, hi))
+
     def generateexpr(self, ctx, component=None):
         assert self.buffered
         halflife = self.args.halflife
@@ -822,18 +1145,20 @@ class NodeDecay(Node):
         id = self.id
         if self.dim is Dim.ONE:
             if not (self.depend & AxisDep.SPACE):
-                last = f'{id}_scalar'
+                last = Name(f'{id}_scalar')
             else:
-                last = f'{id}_vector[ix]'
+                last = Index(Name(f'{id}_vector'), IX)
         elif self.dim is Dim.THREE:
             if not (self.depend & AxisDep.SPACE):
-                last = f'{id}_scalar_{component}'
+                last = Name(f'{id}_scalar_{component}')
             else:
-                last = f'{id}_vector_{component}[ix]'
-        return f'max({last}*pow(2, -delta/{1000*halflife}), {argdata})'
+                last = Index(Name(f'{id}_vector_{component}'), IX)
+        factor = ctx.decay_factor(halflife)
+        return Call('max', [ Op('*', [ last, factor ]), argdata ])
 
 class NodeDiff(Node):
     classname = 'diff'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -843,6 +1168,11 @@ class NodeDiff(Node):
     def finddim(self):
         return self.args.arg.dim
 
+    def foldconst(self):
+        val = constvalue(self.args.arg)
+        if val is not None:
+            return foldvalues(self, [ self.args.arg ], lambda ls: 0)
+
     def generateexpr(self, ctx, component=None):
         assert self.buffered
         assert self.args.arg.buffered
@@ -850,16 +1180,22 @@ class NodeDiff(Node):
         arg = self.args.arg
         assert self.dim is arg.dim
         if not (arg.depend & AxisDep.SPACE):
-            return '0'
+            return Num(0)
+        ctx.note_read(arg)
         suffix = '_'+component if self.dim is Dim.THREE else ''
-        ctx.instead('var diffratio = pixelCount/2')
-        ctx.instead('for (var ix=1; ix<pixelCount-1; ix++) {')
-        ctx.instead(f'  {self.id}_vector{suffix}[ix] = diffratio*({arg.id}_vector{suffix}[ix+1] - {arg.id}_vector{suffix}[ix-1])')
-        ctx.instead('}')
+        ix = Name('ix')
+        vec = Name(f'{self.id}_vector{suffix}')
+        argvec = Name(f'{arg.id}_vector{suffix}')
+        slope = Op('-', [ Index(argvec, Op('+', [ ix, Num(1) ])), Index(argvec, Op('-', [ ix, Num(1) ])) ], spaced=True)
+        ctx.instead(Decl('diffratio', Op('/', [ PIXELCOUNT, Num(2) ])))
+        ctx.instead(For('ix', Num(1), Op('-', [ PIXELCOUNT, Num(1) ]), [
+            Assign(Index(vec, ix), Op('*', [ Name('diffratio'), Paren(slope) ])),
+        ]))
         return None
         
 class NodeShift(Node):
     classname = 'shift'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -871,8 +1207,12 @@ class NodeShift(Node):
         assert self.args.by.dim is Dim.ONE
         return self.args.arg.dim
 
-    def isclamped(self):
-        return self.args.arg.isclamped()
+    def findbounds(self):
+        return self.args.arg.getbounds()
+
+    def foldconst(self):
+        if self.args.arg.isconstant():
+            return self.args.arg
 
     def generateexpr(self, ctx, component=None):
         assert self.buffered
@@ -884,21 +1224,22 @@ class NodeShift(Node):
             argdata = self.args.arg.generatedata(ctx=ctx, component=component)
             return argdata
         bydata = self.args.by.generatedata(ctx=ctx, component=component)
+        ctx.note_read(arg)
         suffix = '_'+component if self.dim is Dim.THREE else ''
-        ctx.instead('for (var ix=0; ix<pixelCount; ix++) {')
-        ctx.instead(f'  var shiftpos = ix - {bydata} * pixelCount')
-        ctx.instead('  if (shiftpos <= 0) {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = {arg.id}_vector{suffix}[0]')
-        ctx.instead('  } else if (shiftpos >= pixelCount-1) {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = {arg.id}_vector{suffix}[pixelCount-1]')
-        ctx.instead('  } else {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = mix({arg.id}_vector{suffix}[floor(shiftpos)], {arg.id}_vector{suffix}[floor(shiftpos)+1], frac(shiftpos))')
-        ctx.instead('  }')
-        ctx.instead('}')
+        ix = Name('ix')
+        pixelcount = Name('pixelCount')
+        dest = Index(Name(f'{self.id}_vector{suffix}'), ix)
+        argvec = Name(f'{arg.id}_vector{suffix}')
+        shiftpos = Op('-', [ ix, Op('*', [ bydata, pixelcount ], spaced=True) ], spaced=True)
+        ctx.instead(For('ix', Num(0), pixelcount, [
+            Decl('shiftpos', shiftpos),
+            shiftedge(dest, argvec),
+        ]))
         return None
         
 class NodeShiftDecay(Node):
     classname = 'shiftdecay'
+    __slots__ = ()
 
     usesimplicit = False
     argformat = [
@@ -911,12 +1252,14 @@ class NodeShiftDecay(Node):
         assert self.args.by.dim is Dim.ONE
         return self.args.arg.dim
 
-    def isclamped(self):
-        return self.args.arg.isclamped()
+    def findbounds(self):
+        # As for decay
+        (lo, hi) = self.args.arg.getbounds()
+        return (max(0, lo), max(0, hi))
 
-    def printstaticvars(self, outfl, first=False):
+    def generatestaticvars(self, first=False):
         id = self.id
-        outfl.write(f'var {id}_previous = array(pixelCount)\n')
+        return [ Decl(f'{id}_previous', Call('array', [ PIXELCOUNT ])) ]
         
     def generateexpr(self, ctx, component=None):
         assert self.buffered
@@ -927,28 +1270,50 @@ class NodeShiftDecay(Node):
         arg = self.args.arg
         assert self.dim is arg.dim
         bydata = self.args.by.generatedata(ctx=ctx, component=component)
+        ctx.note_read(arg)
+        factor = ctx.decay_factor(halflife)
         suffix = '_'+component if self.dim is Dim.THREE else ''
-        ctx.instead('for (var ix=0; ix<pixelCount; ix++) {')
-        ctx.instead(f'  {self.id}_previous{suffix}[ix] = {self.id}_vector{suffix}[ix] * pow(2, -delta/{1000*halflife})')
-        ctx.instead('}')
-        ctx.instead('for (var ix=0; ix<pixelCount; ix++) {')
-        ctx.instead(f'  var shiftpos = ix - {bydata} * (delta/1000) * pixelCount')
+        ix = Name('ix')
+        pixelcount = Name('pixelCount')
+        dest = Index(Name(f'{self.id}_vector{suffix}'), ix)
+        previous = Name(f'{self.id}_previous{suffix}')
+        ctx.instead(For('ix', Num(0), pixelcount, [
+            Assign(Index(previous, ix), Op('*', [ dest, factor ], spaced=True)),
+        ]))
+        frametime = Paren(Op('/', [ Name('delta'), Num(1000) ]))
+        shiftpos = Op('-', [ ix, Op('*', [ bydata, frametime, pixelcount ], spaced=True) ], spaced=True)
         if not (arg.depend & AxisDep.SPACE):
-            ctx.instead(f'  var argval = {arg.id}_scalar{suffix}')
+            argval = Name(f'{arg.id}_scalar{suffix}')
         else:
-            ctx.instead(f'  var argval = {arg.id}_vector{suffix}[ix]')
-        ctx.instead('  if (shiftpos <= 0) {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = max(argval, {self.id}_previous{suffix}[0])')
-        ctx.instead('  } else if (shiftpos >= pixelCount-1) {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = max(argval, {self.id}_previous{suffix}[pixelCount-1])')
-        ctx.instead('  } else {')
-        ctx.instead(f'    {self.id}_vector{suffix}[ix] = max(argval, mix({self.id}_previous{suffix}[floor(shiftpos)], {self.id}_previous{suffix}[floor(shiftpos)+1], frac(shiftpos)))')
-        ctx.instead('  }')
-        ctx.instead('}')
+            argval = Index(Name(f'{arg.id}_vector{suffix}'), ix)
+        ctx.instead(For('ix', Num(0), pixelcount, [
+            Decl('shiftpos', shiftpos),
+            Decl('argval', argval),
+            shiftedge(dest, previous, wrap=lambda val: Call('max', [ Name('argval'), val ])),
+        ]))
         return None
         
+def shiftedge(dest, arr, wrap=None):
+    # Set dest to arr sampled at shiftpos: interpolated between pixels,
+    # and clamped to the ends of the strip. If wrap is given, it's applied
+    # to the sampled value.
+    if wrap is None:
+        wrap = lambda val: val
+    shiftpos = Name('shiftpos')
+    lastpixel = Op('-', [ PIXELCOUNT, Num(1) ])
+    floorpos = Call('floor', [ shiftpos ])
+    between = Call('mix', [ Index(arr, floorpos), Index(arr, Op('+', [ floorpos, Num(1) ])), Call('frac', [ shiftpos ]) ])
+    return If(Op('<=', [ shiftpos, Num(0) ], spaced=True), [
+        Assign(dest, wrap(Index(arr, Num(0)))),
+    ], [ If(Op('>=', [ shiftpos, lastpixel ], spaced=True), [
+        Assign(dest, wrap(Index(arr, lastpixel))),
+    ], [
+        Assign(dest, wrap(between)),
+    ]) ])
+
 class NodeNoise(Node):
     classname = 'noise'
+    __slots__ = ()
 
     usesimplicit = True
     argformat = [
@@ -961,10 +1326,15 @@ class NodeNoise(Node):
     def finddim(self):
         return Dim.ONE
 
-    def printstaticvars(self, outfl, first=False):
+    def findbounds(self):
+        # Turbulence is a sum of absolute values
+        return (0, math.inf)
+
+    def generatestaticvars(self, first=False):
         if first:
             grain = self.args.grain
-            outfl.write(f'setPerlinWrap({grain}, {grain}, {grain})\n')
+            return [ ExprStmt(Call('setPerlinWrap', [ Num(grain), Num(grain), Num(grain) ])) ]
+        return []
             
     def generateexpr(self, ctx, component=None):
         grain = self.args.grain
@@ -973,13 +1343,15 @@ class NodeNoise(Node):
         param = self.generateimplicit(ctx)
         shiftdata = self.args.shift.generatedata(ctx=ctx)
         morphdata = self.args.morph.generatedata(ctx=ctx)
-        return f'perlinTurbulence(({param}-{shiftdata})*{grain}, {morphdata}, 0, 2, 0.5, {octaves})'
+        pos = Op('*', [ Paren(Op('-', [ param, shiftdata ])), Num(grain) ])
+        return Call('perlinTurbulence', [ pos, morphdata, Num(0), Num(2), Num(0.5), Num(octaves) ])
     
 ### NodePulse?
 ### with spaceshape, pos, width
 
 class NodePulser(Node):
     classname = 'pulser'
+    __slots__ = ('unquotedargs',)
     
     usesimplicit = False
     argformat = [
@@ -992,9 +1364,15 @@ class NodePulser(Node):
         ArgFormat('width', Implicit.TIME, default=0.5),
     ]
 
-    def parseargs(self, args, defmap):
-        Node.parseargs(self, args, defmap)
+    def parseargs(self, args, defmap, memo=None):
+        Node.parseargs(self, args, defmap, memo)
+        self.findunquotedargs()
+
+    def mapargs(self, func):
+        Node.mapargs(self, func)
+        self.findunquotedargs()
 
+    def findunquotedargs(self):
         self.unquotedargs = {}
         for key in ['pos', 'width', 'duration']:
             ls = find_unquoted_children(getattr(self.args, key))
@@ -1002,107 +1380,140 @@ class NodePulser(Node):
     
     def finddim(self):
         return Dim.ONE
+
+    def findbounds(self):
+        # Each live pulse adds timeval*spaceval, both of which are in
+        # [0, 1].
+        return (0, self.args.maxcount)
     
-    def printstaticvars(self, outfl, first=False):
+    def generatestaticvars(self, first=False):
         id = self.id
         maxcount = self.args.maxcount
-        outfl.write(f'var {id}_live = array({maxcount})\n')
-        outfl.write(f'var {id}_birth = array({maxcount})\n')
-        outfl.write(f'var {id}_livecount = 0\n')
-        outfl.write(f'var {id}_nextstart = 0\n')
+        stmts = [
+            Decl(f'{id}_live', Call('array', [ Num(maxcount) ])),
+            Decl(f'{id}_birth', Call('array', [ Num(maxcount) ])),
+            Decl(f'{id}_livecount', Num(0)),
+            Decl(f'{id}_nextstart', Num(0)),
+        ]
         for key in ['pos', 'width', 'duration']:
             for nod in self.unquotedargs[key]:
-                outfl.write(f'var {id}_{key}_{nod.id} = array({maxcount})\n')
+                stmts.append(Decl(f'{id}_{key}_{nod.id}', Call('array', [ Num(maxcount) ])))
+        return stmts
     
     def generateexpr(self, ctx, component=None):
         assert self.buffered
         assert component is None
         id = self.id
         maxcount = self.args.maxcount
-        ctx.after('if (clock >= %s_nextstart && %s_livecount < %d) {' % (self.id, self.id, maxcount,))
-        ctx.after('  for (var px=0; px<%d; px++) {' % (maxcount,))
-        ctx.after('    if (!%s_live[px]) { break }' % (self.id,))
-        ctx.after('  }')
-        ctx.after('  if (px < %d) {' % (maxcount,))
-        ctx.after('    %s_live[px] = 1' % (self.id,))
-        ctx.after('    livecount += 1')
-        for nod in self.unquotedargs['pos']:
-            qctx = Stanza(self)
-            unqdata = nod.generatedata(ctx=qctx)
-            qctx.transfer(ctx, indent=2)
-            ctx.after('    %s_pos_%s[px] = %s' % (self.id, nod.id, unqdata))
-        for nod in self.unquotedargs['width']:
-            qctx = Stanza(self)
-            unqdata = nod.generatedata(ctx=qctx)
-            qctx.transfer(ctx, indent=2)
-            ctx.after('    %s_width_%s[px] = %s' % (self.id, nod.id, unqdata))
-        for nod in self.unquotedargs['duration']:
-            qctx = Stanza(self)
-            unqdata = nod.generatedata(ctx=qctx)
-            qctx.transfer(ctx, indent=2)
-            ctx.after('    %s_duration_%s[px] = %s' % (self.id, nod.id, unqdata))
+        px = Name('px')
+        clock = Name('clock')
+        live = Name(f'{id}_live')
+
+        # Start a new pulse, if it's time and there's a free slot.
+        startbody = [
+            Assign(Index(live, px), Num(1)),
+            Assign(Name('livecount'), Num(1), op='+='),
+        ]
+        for key in ['pos', 'width', 'duration']:
+            for nod in self.unquotedargs[key]:
+                qctx = Stanza(self)
+                unqdata = nod.generatedata(ctx=qctx)
+                qctx.transfer(ctx, startbody)
+                startbody.append(Assign(Index(Name(f'{id}_{key}_{nod.id}'), px), unqdata))
         qctx = Stanza(self)
         intervaldata = self.args.interval.generatedata(ctx=qctx)
-        qctx.transfer(ctx, indent=2)
-        ctx.after('    %s_nextstart = clock + %s' % (self.id, intervaldata,))
-        ctx.after('    %s_birth[px] = clock' % (self.id,))
-        ctx.after('  }')
-
-        ctx.after('}')
-        ctx.after('for (var px=0; px<%d; px++) {' % (maxcount,))
-        ctx.after('  if (!%s_live[px]) { break }' % (self.id,))
-        ctx.after('  age = clock - %s_birth[px]' % (self.id,))
+        qctx.transfer(ctx, startbody)
+        startbody.append(Assign(Name(f'{id}_nextstart'), Op('+', [ clock, intervaldata ], spaced=True)))
+        startbody.append(Assign(Index(Name(f'{id}_birth'), px), clock))
+        canstart = Op('&&', [
+            Op('>=', [ clock, Name(f'{id}_nextstart') ], spaced=True),
+            Op('<', [ Name(f'{id}_livecount'), Num(maxcount) ], spaced=True),
+        ], spaced=True)
+        ctx.after(If(canstart, [
+            For('px', Num(0), Num(maxcount), [
+                If(Unary('!', Index(live, px)), [ Break() ], inline=True),
+            ]),
+            If(Op('<', [ px, Num(maxcount) ], spaced=True), startbody),
+        ]))
+
+        # Then draw each live pulse.
+        body = [
+            If(Unary('!', Index(live, px)), [ Break() ], inline=True),
+            Assign(Name('age'), Op('-', [ clock, Index(Name(f'{id}_birth'), px) ], spaced=True)),
+        ]
         if self.args.timeshape is WaveShape.FLAT:
-            ctx.after('  timeval = 1')
+            body.append(Assign(Name('timeval'), Num(1)))
         else:
             qctx = Stanza(self, timebase='age', quoteparent=self, quotekey='duration')
             durationdata = self.args.duration.generatedata(ctx=qctx)
-            qctx.transfer(ctx, indent=1)
-            ctx.after(f'  relage = age / {durationdata}')
-            ctx.after('  if (relage > 1.0) {\n      %s_live[px] = 0\n      livecount -= 1\n      continue\n    }' % (self.id,))
-            ctx.after('  timeval = %s' % (wave_sample(self.args.timeshape, 'relage'),))
+            qctx.transfer(ctx, body)
+            body.append(Assign(Name('relage'), Op('/', [ Name('age'), durationdata ], spaced=True)))
+            body.append(If(Op('>', [ Name('relage'), Num(1.0) ], spaced=True), self.killpulse()))
+            body.append(Assign(Name('timeval'), wave_sample(self.args.timeshape, Name('relage'))))
 
         qctx = Stanza(self, timebase='age', quoteparent=self, quotekey='pos')
         posdata = self.args.pos.generatedata(ctx=qctx)
-        qctx.transfer(ctx, indent=1)
-        ctx.after(f'  ppos = {posdata}')
+        qctx.transfer(ctx, body)
+        body.append(Assign(Name('ppos'), posdata))
             
         qctx = Stanza(self, timebase='age', quoteparent=self, quotekey='width')
         widthdata = self.args.width.generatedata(ctx=qctx)
-        qctx.transfer(ctx, indent=1)
-        ctx.after(f'  pwidth = {widthdata}')
-
+        qctx.transfer(ctx, body)
+        body.append(Assign(Name('pwidth'), widthdata))
+
+        # The possible ranges of the pulse's leading and trailing edges
+        posbounds = self.args.pos.getbounds()
+        halfwidth = bounds_mul(self.args.width.getbounds(), (0.5, 0.5))
+        lowedge = bounds_add(posbounds, bounds_neg(halfwidth))
+        highedge = bounds_add(posbounds, halfwidth)
+        pixelcount = Name('pixelCount')
+        halfpwidth = Op('/', [ Name('pwidth'), Num(2) ])
+        lowpos = Op('-', [ Name('ppos'), halfpwidth ])
+        highpos = Op('+', [ Name('ppos'), halfpwidth ])
+        
         if isinstance(self.args.pos, NodeQuote):
             quotepos = self.args.pos.args.arg
             ### This is probably still wrong
-            if quotepos.isnondecreasing():
-                ctx.after('  if (ppos-pwidth/2 > 1.0) {')
-                ctx.after(f'    {id}_live[px] = 0\n      livecount -= 1\n      continue')
-                ctx.after('  }')
-            if quotepos.isnonincreasing():
-                ctx.after('  if (ppos+pwidth/2 < 0.0) {')
-                ctx.after(f'    {id}_live[px] = 0\n      livecount -= 1\n      continue')
-                ctx.after('  }')
+            if quotepos.isnondecreasing() and lowedge[1] > 1.0:
+                body.append(If(Op('>', [ lowpos, Num(1.0) ], spaced=True), self.killpulse()))
+            if quotepos.isnonincreasing() and highedge[0] < 0.0:
+                body.append(If(Op('<', [ highpos, Num(0.0) ], spaced=True), self.killpulse()))
         
         if self.args.spaceshape is WaveShape.FLAT:
-            ctx.after('  minpos = 0')
-            ctx.after('  maxpos = pixelCount')
+            body.append(Assign(Name('minpos'), Num(0)))
+            body.append(Assign(Name('maxpos'), pixelcount))
         else:
-            ctx.after('  minpos = max(0, pixelCount*(ppos-pwidth/2))')
-            ctx.after('  maxpos = min(pixelCount, pixelCount*(ppos+pwidth/2))')
-        ctx.after('  for (var ix=minpos; ix<maxpos; ix++) {')
+            minpos = Op('*', [ pixelcount, Paren(lowpos) ])
+            if lowedge[0] < 0:
+                minpos = Call('max', [ Num(0), minpos ])
+            body.append(Assign(Name('minpos'), minpos))
+            maxpos = Op('*', [ pixelcount, Paren(highpos) ])
+            if highedge[1] > 1:
+                maxpos = Call('min', [ pixelcount, maxpos ])
+            body.append(Assign(Name('maxpos'), maxpos))
+        pixelbody = []
         if self.args.spaceshape is WaveShape.FLAT:
-            ctx.after('    spaceval = 1')
+            pixelbody.append(Assign(Name('spaceval'), Num(1)))
         else:
             ### temp var for (ppos-pwidth/2)?
-            ctx.after('    relpos = ((ix/pixelCount)-(ppos-pwidth/2)) / pwidth')
-            ctx.after('    spaceval = %s' % (wave_sample(self.args.spaceshape, 'relpos'),))
-        ctx.after('    %s_vector[ix] += (timeval * spaceval)' % (self.id,))
-        ctx.after('  }')
-        ctx.after('}')
+            relpos = Op('-', [ Paren(Op('/', [ IX, pixelcount ])), Paren(lowpos) ])
+            pixelbody.append(Assign(Name('relpos'), Op('/', [ Paren(relpos), Name('pwidth') ], spaced=True)))
+            pixelbody.append(Assign(Name('spaceval'), wave_sample(self.args.spaceshape, Name('relpos'))))
+        pixelbody.append(Assign(Index(Name(f'{id}_vector'), IX), Paren(Op('*', [ Name('timeval'), Name('spaceval') ], spaced=True)), op='+='))
+        # The pulse covers at most its width (in pixels).
+        widthfrac = min(1, max(0, self.args.width.getbounds()[1]))
+        body.append(For('ix', Name('minpos'), Name('maxpos'), pixelbody, trips=Op('*', [ pixelcount, Num(widthfrac) ])))
+        ctx.after(For('px', Num(0), Num(maxcount), body))
         
         # This is just the initial buffer-clear.
-        return '0'
+        return Num(0)
+
+    def killpulse(self):
+        return [
+            Assign(Index(Name(f'{self.id}_live'), Name('px')), Num(0)),
+            Assign(Name('livecount'), Num(1), op='-='),
+            Continue(),
+        ]
 
 nodeclasses = [
     NodeConstant,
@@ -1140,5 +1551,7 @@ nodeclasses = [
     NodePulser,
 ]
 
+Node.prepclasses(nodeclasses)
+
 
 
@@ -0,0 +1,182 @@
+from .compile import Node, AxisDep
+
+# The optimization passes, in the order they run. Each pass has the
+# lowest -O level that turns it on (None for passes which are only
+# enabled by name).
+#
+# Graph passes rewrite the node graph between compileall() and post().
+# Code passes are flags on the Program which post() and write() consult.
+# Either way, report() describes what the pass changed, once post() has
+# run.
+
+DEFAULT_LEVEL = 2
+MAX_LEVEL = 2
+
+def countnodes(program):
+    # Count the distinct nodes reachable from the root and defs. (Before
+    # post(), program.nodes is not yet filled in.)
+    seen = set()
+    todo = [ program.start ] + list(program.defs.values())
+    while todo:
+        nod = todo.pop()
+        if nod.id in seen:
+            continue
+        seen.add(nod.id)
+        for argf in nod.argformat:
+            for arg in nod.getargls(argf.name, argf.multiple):
+                if isinstance(arg, Node):
+                    todo.append(arg)
+    return len(seen)
+
+class Pass:
+    name = None
+    level = None
+    description = None
+
+    def __init__(self):
+        self.enabled = False
+        self.changed = None
+
+    def setup(self, program):
+        pass
+
+    def report(self, program):
+        return None
+
+class GraphPass(Pass):
+    def setup(self, program):
+        if not self.enabled:
+            return
+        before = countnodes(program)
+        self.rewrite(program)
+        self.changed = before - countnodes(program)
+
+class FlagPass(Pass):
+    attr = None
+
+    def setup(self, program):
+        setattr(program, self.attr, self.enabled)
+
+class PassFold(GraphPass):
+    name = 'fold'
+    level = 1
+    description = 'constant-fold the node graph'
+    def rewrite(self, program):
+        program.fold()
+    def report(self, program):
+        return f'{self.changed} nodes removed'
+
+class PassShare(GraphPass):
+    name = 'share'
+    level = 1
+    description = 'merge identical subtrees'
+    def rewrite(self, program):
+        program.share()
+    def report(self, program):
+        return f'{self.changed} nodes merged'
+
+class PassFuseLoops(FlagPass):
+    name = 'fuseloops'
+    attr = 'fuseloops'
+    level = 1
+    description = 'merge consecutive per-pixel loops'
+    def report(self, program):
+        count = 0
+        for stanzas in program.startgroups + program.framegroups:
+            count += len(stanzas) - 1
+        return f'{count} loops merged'
+
+class PassReuseBuffers(FlagPass):
+    name = 'reusebuffers'
+    attr = 'reusebuffers'
+    level = 1
+    description = 'share pixel arrays between vectors with disjoint lifetimes'
+    def report(self, program):
+        arraymap = program.allocbuffers()
+        saved = len(arraymap) - len(set(arraymap.values()))
+        return f'{saved} arrays saved'
+
+class PassHoistVals(FlagPass):
+    name = 'hoistvals'
+    attr = 'hoistvals'
+    level = 2
+    description = 'move invariant values out of pixel loops'
+    def report(self, program):
+        count = 0
+        for stanza in program.stanzas:
+            if (stanza.depend & AxisDep.SPACE):
+                count += len(stanza.invariantvals(AxisDep.SPACE))
+        if program.rootstanza:
+            count += len(program.rootstanza.invariantvals(AxisDep.SPACE))
+        return f'{count} values hoisted ({len(program.startupvals())} to startup)'
+
+class PassFuseColors(FlagPass):
+    name = 'fusecolors'
+    attr = 'fusecolors'
+    level = 2
+    description = 'share scalar work across color components'
+    def report(self, program):
+        fused = set()
+        stanzas = list(program.stanzas)
+        if program.rootstanza:
+            stanzas.append(program.rootstanza)
+        for stanza in stanzas:
+            fused.update(stanza.fused)
+        return f'{len(fused)} color nodes fused'
+
+class PassInlineRoot(FlagPass):
+    name = 'inlineroot'
+    attr = 'inlineroot'
+    level = None
+    description = 'compute the root in render() rather than buffering it'
+    def report(self, program):
+        if program.rootstanza:
+            return 'root inlined'
+        return 'root buffered (not inlinable)'
+
+passclasses = [
+    PassFold,
+    PassShare,
+    PassFuseLoops,
+    PassReuseBuffers,
+    PassHoistVals,
+    PassFuseColors,
+    PassInlineRoot,
+]
+
+passnames = [ cla.name for cla in passclasses ]
+
+class PassManager:
+    def __init__(self, level=DEFAULT_LEVEL, enable=(), disable=()):
+        if level < 0 or level > MAX_LEVEL:
+            raise Exception(f'bad optimization level: {level}')
+        for name in list(enable) + list(disable):
+            if name not in passnames:
+                raise Exception(f'unknown pass: {name}')
+        self.level = level
+        self.passes = []
+        for cla in passclasses:
+            pss = cla()
+            pss.enabled = (cla.level is not None and cla.level <= level)
+            if cla.name in enable:
+                pss.enabled = True
+            if cla.name in disable:
+                pss.enabled = False
+            self.passes.append(pss)
+
+    def prepare(self, program):
+        # Run the graph passes and set the code flags, but don't post().
+        for pss in self.passes:
+            pss.setup(program)
+
+    def run(self, program):
+        self.prepare(program)
+        program.post()
+
+    def report(self, program, outfl):
+        outfl.write(f'optimization level {self.level}:\n')
+        for pss in self.passes:
+            if pss.enabled:
+                outfl.write(f'  {pss.name}: {pss.report(program)}\n')
+            else:
+                outfl.write(f'  {pss.name}: disabled\n')
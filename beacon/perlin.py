@@ -0,0 +1,89 @@
+import random
+
+import numpy as np
+
+# Improved Perlin noise, as used by the noise node. The Pixelblaze has its
+# own noise function, which this doesn't try to match; but the two
+# renderers (interp.py and sim.py) both use this one, so they agree with
+# each other on noise scripts.
+#
+# Positions may be floats or numpy arrays (which broadcast against each
+# other); the simulator passes a whole frame of pixels at once.
+
+def perlin_permutation():
+    # Doubled, so that perm[perm[x] + y] needs no masking.
+    ls = list(range(256))
+    random.Random(0).shuffle(ls)
+    return np.array(ls + ls)
+
+PERLIN_PERM = perlin_permutation()
+
+def perlin_gradients():
+    # The twelve edge directions of improved Perlin noise (padded to
+    # sixteen), as x, y, z coefficient tables. These are indexed by the
+    # last permutation lookup's input rather than by hash.
+    ls = []
+    for hash in range(16):
+        grad = [ 0, 0, 0 ]
+        u = 0 if hash < 8 else 1
+        v = 1 if hash < 4 else (0 if hash in (12, 14) else 2)
+        grad[u] += (-1 if hash & 1 else 1)
+        grad[v] += (-1 if hash & 2 else 1)
+        ls.append(grad)
+    grads = np.array(ls, dtype=float).T
+    return grads[:, PERLIN_PERM & 15]
+
+(PERLIN_GX, PERLIN_GY, PERLIN_GZ) = perlin_gradients()
+
+# The steps to the far corner along z, y, x (the first three axes of
+# the corner arrays)
+PERLIN_STEPS = [ np.array([ 0, 1 ]).reshape(shape) for shape in [ (2, 1, 1), (1, 2, 1), (1, 1, 2) ] ]
+
+def perlin_fade(t):
+    return t*t*t*(t*(t*6-15)+10)
+
+def perlin_corners(val, wrap, ndim, axis):
+    # The lattice coordinates and offsets of the two corners along one
+    # axis, and the fractional position.
+    step = PERLIN_STEPS[axis]
+    step = step.reshape(step.shape + (1,) * ndim)
+    base = np.floor(val)
+    frac = val - base
+    lattice = base.astype(np.int64) + step
+    if wrap:
+        lattice %= wrap
+    lattice &= 255
+    return lattice, frac - step, frac
+
+def perlin_noise(x, y, z, wrap, seed=0):
+    # Wrapping the lattice at wrap (if nonzero). All eight corners are
+    # computed at once, as arrays of shape (2, 2, 2, ...).
+    perm = PERLIN_PERM
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.add(z, seed, dtype=float)
+    ndim = max(x.ndim, y.ndim, z.ndim)
+    xi, xd, xf = perlin_corners(x, wrap, ndim, 2)
+    yi, yd, yf = perlin_corners(y, wrap, ndim, 1)
+    zi, zd, zf = perlin_corners(z, wrap, ndim, 0)
+    hash = perm[perm[xi] + yi] + zi
+    grads = PERLIN_GX[hash]*xd + PERLIN_GY[hash]*yd + PERLIN_GZ[hash]*zd
+    (u, v, w) = (perlin_fade(xf), perlin_fade(yf), perlin_fade(zf))
+    # Collapse along x, then y, then z
+    grads = grads[:, :, 0] + (grads[:, :, 1] - grads[:, :, 0]) * u
+    grads = grads[:, 0] + (grads[:, 1] - grads[:, 0]) * v
+    return grads[0] + (grads[1] - grads[0]) * w
+
+def perlin_turbulence(x, y, z, lacunarity, gain, octaves, wrap):
+    # The Pixelblaze's perlinTurbulence(), given the wrap that
+    # setPerlinWrap() set. The octaves are stacked along a new first
+    # axis, so that one perlin_noise() call does them all.
+    octaves = int(octaves)
+    if octaves <= 0:
+        return 0.0
+    shape = (octaves,) + (1,) * max(np.ndim(x), np.ndim(y), np.ndim(z))
+    octave = np.arange(octaves)
+    freq = np.power(float(lacunarity), octave).reshape(shape)
+    amp = np.power(float(gain), octave).reshape(shape)
+    noise = perlin_noise(np.multiply(x, freq), np.multiply(y, freq), np.multiply(z, freq), wrap, seed=octave.reshape(shape))
+    return (np.abs(noise) * amp).sum(axis=0)
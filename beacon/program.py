@@ -1,7 +1,13 @@
 import sys
+import math
 
 from .defs import Implicit, AxisDep, Dim
-from .compile import Node
+from .compile import Node, postorder
+from .ir import Num, Name, Index, Call, Op, Unary, Paren, IX, PIXELCOUNT
+from .ir import Raw, Blank, Comment, Decl, Assign, ExprStmt, For, Function, exprnames, formatstmts
+
+# The deepest expression which post() will generate inline.
+MAX_EXPR_DEPTH = 32
 
 class Stanza:
     def __init__(self, nod, timebase=None, quoteparent=None, quotekey=None):
@@ -9,34 +15,98 @@ class Stanza:
         self.depend = nod.depend
         self.storedvals = []
         self.storedvalkeys = {}
+        self.storeddepends = {}
+        self.reads = set()
+        self.decayfactors = {}    # halflife in ms -> variable name
         self.bottomline = None
-        self.afterlines = []
-        self.insteadlines = []
+        # Most stanzas never use these, so they start as empty tuples
+        # and become a set or lists on first use. (There are a lot of
+        # stanzas.)
+        self.fused = ()
+        self.afterstmts = ()
+        self.insteadstmts = ()
         self.timebase = timebase
         self.quoteparent = quoteparent
         self.quotekey = quotekey
     
-    def store_val(self, nod, key, expr):
+    def store_val(self, nod, key, expr, depend=None):
+        # If the caller knows what expr depends on, it passes depend;
+        # the value can then be hoisted out of the pixel loop (or out of
+        # beforeRender) when it's invariant.
         varname = f'{nod.id}_val_{key}'
+        if varname in self.storedvalkeys:
+            # A shared node generated twice in this stanza
+            return Name(varname)
+        if depend is None:
+            depend = self.depend
         self.storedvals.append( (varname, expr) )
         self.storedvalkeys[varname] = expr
-        return varname
+        self.storeddepends[varname] = depend
+        return Name(varname)
 
     def find_val(self, nod, key):
         varname = f'{nod.id}_val_{key}'
         if varname in self.storedvalkeys:
-            return varname
+            return Name(varname)
+
+    def invariantvals(self, axes):
+        # The stored values which don't vary along axes (and don't refer
+        # to a stored value that does).
+        if self.insteadstmts:
+            return []
+        res = []
+        varying = set()
+        for varname, expr in self.storedvals:
+            if (self.storeddepends[varname] & axes) or not varying.isdisjoint(exprnames(expr)):
+                varying.add(varname)
+            else:
+                res.append( (varname, expr) )
+        return res
+
+    def note_read(self, nod):
+        # This stanza reads nod's buffer.
+        self.reads.add(nod.id)
 
-    def after(self, ln):
-        self.afterlines.append(ln)
+    def note_fused(self, nod):
+        # nod shared scalar work across its color components here.
+        if not self.fused:
+            self.fused = set()
+        self.fused.add(nod.id)
 
-    def instead(self, ln):
-        self.insteadlines.append(ln)
+    def decay_factor(self, halflife):
+        # The per-frame decay multiplier for this halflife. It's computed
+        # once at the top of beforeRender, and shared by every node with
+        # the same halflife.
+        # The name spells out the exact halflife in ms (repr() reads back
+        # as the same float), so different halflives never share a name.
+        ms = 1000*halflife
+        varname = self.decayfactors.get(ms)
+        if varname is None:
+            text = repr(abs(ms)).removesuffix('.0')
+            suffix = text.replace('.', '_').replace('e-', 'em').replace('e+', 'ep')
+            varname = 'decayfactor_' + ('neg' if math.copysign(1, ms) < 0 else '') + suffix
+            self.decayfactors[ms] = varname
+        return Name(varname)
 
-    def transfer(self, other, indent=0):
-        indentstr = indent * '  '
+    def after(self, stmt):
+        if not self.afterstmts:
+            self.afterstmts = []
+        self.afterstmts.append(stmt)
+
+    def instead(self, stmt):
+        if not self.insteadstmts:
+            self.insteadstmts = []
+        self.insteadstmts.append(stmt)
+
+    def transfer(self, other, body):
+        # Merge this stanza into other, with the stored values assigned
+        # at the end of body (a statement list in other).
+        other.reads.update(self.reads)
+        if self.fused:
+            other.fused = set(other.fused) | self.fused
+        other.decayfactors.update(self.decayfactors)
         for varname, expr in self.storedvals:
-            other.after('%s%s = %s' % (indentstr, varname, expr,))
+            body.append(Assign(Name(varname), expr))
 
     def generatebuffer(self):
         if self.nod.dim is Dim.ONE:
@@ -50,45 +120,75 @@ class Stanza:
         else:
             raise Exception('bad dim')
 
-    def printlines(self, outfl, indent=0):
-        indentstr = indent * '  '
+    def isfusable(self):
+        # A plain per-pixel loop, which only reads buffers at [ix]. (The
+        # stanzas for diff, shift, and shiftdecay read neighboring pixels;
+        # they use insteadstmts, so they are never fused.)
+        if self.insteadstmts or self.afterstmts:
+            return False
+        return bool(self.depend & AxisDep.SPACE)
+
+    def generatebody(self, body, declared=None):
+        # The stored values and buffer assignments, without the loop.
+        # If declared is a set, stored values already in it are skipped.
         id = self.nod.id
-        if self.insteadlines:
-            ### do these need to be in the instead loop sometimes?
-            for varname, expr in self.storedvals:
-                outfl.write(f'{indentstr}var {varname} = {expr}  // for {id}\n')
-            for ln in self.insteadlines:
-                outfl.write(f'{indentstr}{ln}\n')
-        elif self.nod.dim is Dim.ONE:
-            if not (self.depend & AxisDep.SPACE):
-                for varname, expr in self.storedvals:
-                    outfl.write(f'{indentstr}var {varname} = {expr}  // for {id}\n')
-                outfl.write(f'{indentstr}{id}_scalar = ({self.bottomline})\n')
-            else:
-                outfl.write(f'{indentstr}for (var ix=0; ix<pixelCount; ix++) {{\n')
-                for varname, expr in self.storedvals:
-                    outfl.write(f'{indentstr}  var {varname} = {expr}  // for {id}\n')
-                outfl.write(f'{indentstr}  {id}_vector[ix] = ({self.bottomline})\n')
-                outfl.write(f'{indentstr}}}\n')
+        for varname, expr in self.storedvals:
+            if declared is not None:
+                if varname in declared:
+                    continue
+                declared.add(varname)
+            body.append(Decl(varname, expr, comment=f'for {id}'))
+        if not (self.depend & AxisDep.SPACE):
+            target = lambda suffix: Name(f'{id}_scalar{suffix}')
+        else:
+            target = lambda suffix: Index(Name(f'{id}_vector{suffix}'), IX)
+        if self.nod.dim is Dim.ONE:
+            body.append(Assign(target(''), Paren(self.bottomline)))
         elif self.nod.dim is Dim.THREE:
-            if not (self.depend & AxisDep.SPACE):
-                for varname, expr in self.storedvals:
-                    outfl.write(f'{indentstr}var {varname} = {expr}  // for {id}\n')
-                outfl.write(f'{indentstr}{id}_scalar_r = ({self.bottomline[0]})\n')
-                outfl.write(f'{indentstr}{id}_scalar_g = ({self.bottomline[1]})\n')
-                outfl.write(f'{indentstr}{id}_scalar_b = ({self.bottomline[2]})\n')
-            else:
-                outfl.write(f'{indentstr}for (var ix=0; ix<pixelCount; ix++) {{\n')
-                for varname, expr in self.storedvals:
-                    outfl.write(f'{indentstr}  var {varname} = {expr}  // for {id}\n')
-                outfl.write(f'{indentstr}  {id}_vector_r[ix] = ({self.bottomline[0]})\n')
-                outfl.write(f'{indentstr}  {id}_vector_g[ix] = ({self.bottomline[1]})\n')
-                outfl.write(f'{indentstr}  {id}_vector_b[ix] = ({self.bottomline[2]})\n')
-                outfl.write(f'{indentstr}}}\n')
+            body.append(Assign(target('_r'), Paren(self.bottomline[0])))
+            body.append(Assign(target('_g'), Paren(self.bottomline[1])))
+            body.append(Assign(target('_b'), Paren(self.bottomline[2])))
+        else:
+            raise Exception('bad dim')
+
+    def generateinvariant(self, body, declared=None):
+        # The pixel-invariant stored values, to go before the loop.
+        id = self.nod.id
+        for varname, expr in self.invariantvals(AxisDep.SPACE):
+            if declared is not None:
+                if varname in declared:
+                    continue
+                declared.add(varname)
+            body.append(Decl(varname, expr, comment=f'for {id}'))
+
+    def vectornames(self):
+        id = self.nod.id
+        if self.nod.dim is Dim.ONE:
+            return [ f'{id}_vector' ]
+        elif self.nod.dim is Dim.THREE:
+            return [ f'{id}_vector_r', f'{id}_vector_g', f'{id}_vector_b' ]
         else:
             raise Exception('bad dim')
-        for ln in self.afterlines:
-            outfl.write(f'{indentstr}{ln}\n')
+
+    def generatestmts(self, body, hoisted=None):
+        # If hoisted is a set (of stored values already computed at
+        # startup), pixel-invariant values are moved out of the loop.
+        id = self.nod.id
+        declared = set(hoisted) if hoisted is not None else None
+        if self.insteadstmts:
+            ### do these need to be in the instead loop sometimes?
+            for varname, expr in self.storedvals:
+                body.append(Decl(varname, expr, comment=f'for {id}'))
+            body.extend(self.insteadstmts)
+        elif not (self.depend & AxisDep.SPACE):
+            self.generatebody(body, declared=declared)
+        else:
+            if hoisted is not None:
+                self.generateinvariant(body, declared=declared)
+            loopbody = []
+            self.generatebody(loopbody, declared=declared)
+            body.append(pixelloop(loopbody))
+        body.extend(self.afterstmts)
 
 class Program:
     def __init__(self, start, defs, srclines=None):
@@ -102,6 +202,83 @@ class Program:
         self.classset = set()
 
         self.stanzas = []
+        # Lists of stanzas which share a loop, startup and per-frame
+        self.startgroups = []
+        self.framegroups = []
+
+        # Merge consecutive per-pixel stanzas into a single loop
+        self.fuseloops = True
+        # Let per-frame vectors share arrays when their lifetimes don't
+        # overlap
+        self.reusebuffers = True
+        # Compute the root in render() rather than buffering it
+        self.inlineroot = False
+        self.rootstanza = None
+        # Move stored values out of the pixel loop (or to startup) when
+        # they don't vary there
+        self.hoistvals = True
+        # Bake gradients into lookup tables of this size (0 for no tables),
+        # interpolating between entries if gradientlerp is set
+        self.gradientlut = 0
+        self.gradientlerp = False
+        # Compute the shared scalar inputs of color nodes once per pixel,
+        # rather than once per component
+        self.fusecolors = True
+
+    def fold(self):
+        # Constant-folding. This runs before post(), so the dim and depend
+        # fields are not yet set.
+        if self.start is None:
+            raise Exception('no root')
+        
+        memo = {}
+        self.start = self.folditer(self.start, memo)
+        for key, nod in self.defs.items():
+            self.defs[key] = self.folditer(nod, memo)
+
+    def folditer(self, root, memo):
+        for nod in postorder(root, memo):
+            nod.mapargs(lambda arg: memo[arg.id])
+            res = nod.foldconst()
+            if res is None:
+                res = nod
+            memo[nod.id] = res
+        return memo[root.id]
+
+    def share(self):
+        # Common-subexpression elimination: nodes with the same sharekey()
+        # are merged, so that the subtree is generated once. This runs
+        # before post(), which will buffer the merged nodes.
+        if self.start is None:
+            raise Exception('no root')
+        
+        memo = {}
+        canon = {}
+        self.start = self.shareiter(self.start, memo, canon)
+        for key, nod in self.defs.items():
+            self.defs[key] = self.shareiter(nod, memo, canon)
+
+    def shareiter(self, root, memo, canon):
+        for nod in postorder(root, memo, argsof=shareargs):
+            if isinstance(nod, NodeQuote):
+                # The quoted node is generated in its pulser's context, so
+                # it must stay private. Its (unquoted) children can be
+                # shared.
+                qnod = nod.args.arg
+                qnod.mapargs(lambda arg: memo[arg.id])
+                memo[qnod.id] = qnod
+                memo[nod.id] = nod
+                continue
+            nod.mapargs(lambda arg: memo[arg.id])
+            res = nod
+            key = nod.sharekey()
+            if key is not None:
+                if key in canon:
+                    res = canon[key]
+                else:
+                    canon[key] = nod
+            memo[nod.id] = res
+        return memo[root.id]
 
     def post(self):
         if self.start is None:
@@ -109,23 +286,77 @@ class Program:
         
         self.postiter(self.start)
         assert(self.start is self.nodes[-1])
-        self.start.buffered = True
         for key, nod in self.defs.items():
             if not nod.isconstant():
                 nod.buffered = True
 
+        # A node with several parents (a def, or a node merged by share())
+        # is buffered so that it is only computed once.
+        refcount = {}
+        for nod in self.nodes:
+            for argf in nod.argformat:
+                for arg in nod.getargls(argf.name, argf.multiple):
+                    if isinstance(arg, Node):
+                        refcount[arg.id] = refcount.get(arg.id, 0) + 1
+        for nod in self.nodes:
+            if refcount.get(nod.id, 0) > 1 and not nod.isconstant():
+                nod.buffered = True
+
+        # An unbuffered node is generated inline in its parent's
+        # expression. Break up very deep expressions by buffering, so that
+        # generatedata() doesn't recurse too far (and the generated lines
+        # stay a sane length).
+        private = set([ nod.args.arg.id for nod in self.nodes if isinstance(nod, NodeQuote) ])
+        depth = {}
+        for nod in self.nodes:
+            val = 1
+            for arg in nod.argnodes():
+                if not arg.buffered:
+                    val = max(val, depth[arg.id]+1)
+            if val > MAX_EXPR_DEPTH and not nod.isconstant() and not isinstance(nod, NodeQuote) and nod.id not in private:
+                nod.buffered = True
+                val = 0
+            depth[nod.id] = val
+
+        for nod in self.nodes:
+            if nod.dim is Dim.THREE:
+                nod.fusecolor = self.fusecolors
+        if self.gradientlut:
+            for nod in self.nodes:
+                if isinstance(nod, NodeGradient) or isinstance(nod, NodeNGradient):
+                    nod.lutsize = self.gradientlut
+                    nod.lutlerp = self.gradientlerp
+
+        self.rootstanza = None
+        if self.inlineroot and not self.start.buffered and (self.start.depend & AxisDep.SPACE) and (self.start.depend & AxisDep.TIME):
+            # The root is a plain per-pixel expression, so render() can
+            # compute it directly rather than reading it from a buffer.
+            # (A root which doesn't vary over time stays in its startup
+            # buffer; render() would recompute it every frame.)
+            self.rootstanza = Stanza(self.start)
+        else:
+            self.start.buffered = True
+
         for nod in self.nodes:
             if nod.buffered:
                 stanza = Stanza(nod)
                 self.stanzas.append(stanza)
                 stanza.generatebuffer()
+        if self.rootstanza:
+            self.rootstanza.generatebuffer()
+        self.startgroups = self.loopgroups([ stanza for stanza in self.stanzas if not (stanza.depend & AxisDep.TIME) ])
+        self.framegroups = self.loopgroups([ stanza for stanza in self.stanzas if (stanza.depend & AxisDep.TIME) ])
 
-    def postiter(self, nod):
-        if nod.id in self.nodeidset:
-            return
-        self.nodes.insert(0, nod)
-        self.nodeidset.add(nod.id)
+    def postiter(self, root):
+        # Build self.nodes in dependency order: every node comes after its
+        # arguments. (Arguments are visited last-first, which keeps
+        # siblings in the traditional order.)
+        walk = postorder(root, self.nodeidset, argsof=lambda nod: list(reversed(nod.argnodes())), previsit=self.previsit)
+        for nod in walk:
+            self.nodeidset.add(nod.id)
+            self.postvisit(nod)
 
+    def previsit(self, nod):
         if nod.classname not in self.classset:
             self.classes.append(nod.classname)
             self.classset.add(nod.classname)
@@ -145,14 +376,10 @@ class Program:
             nod.buffered = True
             nod.args.arg.buffered = True
 
+    def postvisit(self, nod):
         subdeps = AxisDep.NONE
-        
-        for argf in nod.argformat:
-            argls = nod.getargls(argf.name, argf.multiple)
-            for arg in argls:
-                if isinstance(arg, Node):
-                    self.postiter(arg)
-                    subdeps |= arg.depend
+        for arg in nod.argnodes():
+            subdeps |= arg.depend
 
         if nod.usesimplicit:
             if nod.implicit == Implicit.TIME:
@@ -173,107 +400,271 @@ class Program:
                         arg.buffered = True
 
         nod.dim = nod.finddim()
+        nod.bounds = nod.findbounds()
+        self.nodes.append(nod)
         
     def dump(self):
         for name in self.defs:
             self.defs[name].dump(name=name)
         self.start.dump()
 
+    def startupvals(self):
+        # Stored values in per-frame stanzas (and render) which are
+        # constant over time and space, so they can be computed once at
+        # startup.
+        res = []
+        if not self.hoistvals:
+            return res
+        stanzas = [ stanza for stanza in self.stanzas if (stanza.depend & AxisDep.TIME) ]
+        if self.rootstanza:
+            stanzas.append(self.rootstanza)
+        for stanza in stanzas:
+            for varname, expr in stanza.invariantvals(AxisDep.SPACETIME):
+                res.append( (stanza, varname, expr) )
+        return res
+
+    def loopgroups(self, stanzas):
+        # Split stanzas into runs which share a loop. A run has more than
+        # one stanza only if we're fusing loops.
+        res = []
+        pos = 0
+        while pos < len(stanzas):
+            end = pos+1
+            if self.fuseloops and stanzas[pos].isfusable():
+                while end < len(stanzas) and stanzas[end].isfusable():
+                    end += 1
+            res.append(stanzas[ pos : end ])
+            pos = end
+        return res
+
+    def generatestanzas(self, groups, hoisted=None):
+        # Yields the statements for each group in turn. hoisted is the
+        # set of stored values which were moved to startup, or None if
+        # we're not hoisting.
+        for stanzas in groups:
+            body = []
+            if len(stanzas) == 1:
+                stanzas[0].generatestmts(body, hoisted=hoisted)
+            else:
+                # Several per-pixel stanzas in one loop. Each one only
+                # reads earlier buffers at [ix], so this is safe.
+                group = set(hoisted) if hoisted is not None else set()
+                if hoisted is not None:
+                    for stanza in stanzas:
+                        stanza.generateinvariant(body, declared=group)
+                loopbody = []
+                for stanza in stanzas:
+                    stanza.generatebody(loopbody, declared=group)
+                body.append(pixelloop(loopbody))
+            yield from body
+
+    def allocbuffers(self):
+        # Liveness analysis for the vectors. Returns a map from each
+        # vector name to the name of the array it should use.
+        #
+        # Startup vectors are computed once and persist. A vector computed
+        # in beforeRender is dead once its last reader in that frame has
+        # run; a later stanza can then write into the same array. The
+        # root (read by render) and decay-style vectors (which read their
+        # own previous frame) never give up their arrays. A diff vector
+        # never takes over an array, since it leaves the end pixels as
+        # they were.
+        arraymap = {}
+        frame = []
+        for stanza in self.stanzas:
+            if not (stanza.depend & AxisDep.SPACE):
+                continue
+            for name in stanza.vectornames():
+                arraymap[name] = name
+            if (stanza.depend & AxisDep.TIME):
+                frame.append(stanza)
+        if not self.reusebuffers:
+            return arraymap
+
+        lastread = {}
+        for pos, stanza in enumerate(frame):
+            lastread[stanza.nod.id] = pos
+        for pos, stanza in enumerate(frame):
+            for id in stanza.reads:
+                if id in lastread:
+                    lastread[id] = max(lastread[id], pos)
+        if self.rootstanza:
+            # Read by render(), after the whole frame
+            for id in self.rootstanza.reads:
+                if id in lastread:
+                    lastread[id] = len(frame)
+
+        free = []    # (pos of last reader, array name)
+        for pos, stanza in enumerate(frame):
+            nod = stanza.nod
+            if isinstance(nod, NodeDecay) or isinstance(nod, NodeShiftDecay):
+                continue
+            # A plain per-pixel stanza with one output may take over an
+            # array that it reads itself, since it reads each [ix] before
+            # writing it. (A color stanza writes [ix] of its red array
+            # before the green and blue expressions read their inputs.)
+            if isinstance(nod, NodeDiff):
+                limit = -1
+            elif stanza.isfusable() and nod.dim is Dim.ONE:
+                limit = pos
+            else:
+                limit = pos-1
+            names = stanza.vectornames()
+            avail = [ ent for ent in free if ent[0] <= limit ]
+            if len(avail) >= len(names):
+                for name, ent in zip(names, avail):
+                    arraymap[name] = ent[1]
+                    free.remove(ent)
+            if nod is self.start:
+                continue
+            last = lastread[nod.id]
+            for name in names:
+                free.append( (last, arraymap[name]) )
+            
+        return arraymap
+
     def write(self, outfl=None):
         if outfl is None:
             outfl = sys.stdout
-            
-        outfl.write('var clock = 0   // seconds\n')
-        outfl.write('\n')
+        outfl.write(formatstmts(self.generate()))
+
+    def generate(self):
+        # The whole program, as a series of statements. They're generated
+        # as they're consumed (and so are the function bodies), so the
+        # statements for each stanza can be freed once they're printed.
+        yield Raw('var clock = 0   // seconds\n')
+        yield Blank()
 
         classes = set()
         for nod in self.nodes:
             first = (nod.classname not in classes)
             classes.add(nod.classname)
-            nod.printstaticvars(outfl, first=first)
+            yield from nod.generatestaticvars(first=first)
 
-        outfl.write('// stanza buffers:\n')
+        arraymap = self.allocbuffers()
+        peak = len(set(arraymap.values()))
+        yield Comment(f'stanza buffers: {peak} pixel arrays ({len(arraymap)} without reuse)')
         for stanza in self.stanzas:
             id = stanza.nod.id
-            if stanza.nod.dim is Dim.ONE:
-                if not (stanza.depend & AxisDep.SPACE):
-                    outfl.write(f'var {id}_scalar\n')
+            if not (stanza.depend & AxisDep.SPACE):
+                if stanza.nod.dim is Dim.ONE:
+                    yield Decl(f'{id}_scalar')
+                elif stanza.nod.dim is Dim.THREE:
+                    yield Decl(f'{id}_scalar_r')
+                    yield Decl(f'{id}_scalar_g')
+                    yield Decl(f'{id}_scalar_b')
                 else:
-                    outfl.write(f'var {id}_vector = array(pixelCount)\n')
-            elif stanza.nod.dim is Dim.THREE:
-                if not (stanza.depend & AxisDep.SPACE):
-                    outfl.write(f'var {id}_scalar_r\n')
-                    outfl.write(f'var {id}_scalar_g\n')
-                    outfl.write(f'var {id}_scalar_b\n')
-                else:
-                    outfl.write(f'var {id}_vector_r = array(pixelCount)\n')
-                    outfl.write(f'var {id}_vector_g = array(pixelCount)\n')
-                    outfl.write(f'var {id}_vector_b = array(pixelCount)\n')
+                    raise Exception('bad dim')
             else:
-                raise Exception('bad dim')
-        outfl.write('\n')
+                for name in stanza.vectornames():
+                    if arraymap[name] == name:
+                        yield Decl(name, Call('array', [ PIXELCOUNT ]))
+                    else:
+                        yield Decl(name, Name(arraymap[name]), comment='reused')
+        yield Blank()
 
-        outfl.write('// startup calculations:\n')
-        for stanza in self.stanzas:
-            if not (stanza.depend & AxisDep.TIME):
-                stanza.printlines(outfl=outfl, indent=0)
-        outfl.write('\n')
+        hoisted = None
+        rootvals = []
+        if self.hoistvals:
+            hoisted = set()
+        
+        yield Comment('startup calculations:')
+        yield from self.generatestanzas(self.startgroups, hoisted=hoisted)
+        if self.hoistvals:
+            for stanza, varname, expr in self.startupvals():
+                yield Decl(varname, expr, comment=f'for {stanza.nod.id}')
+                hoisted.add(varname)
+            if self.rootstanza:
+                # Per-frame values for render() live in globals.
+                for varname, expr in self.rootstanza.invariantvals(AxisDep.SPACE):
+                    if varname not in hoisted:
+                        rootvals.append( (varname, expr) )
+                        yield Decl(varname, comment=f'for {self.start.id}')
+        yield Blank()
         
-        outfl.write('export function beforeRender(delta) {\n')
+        yield Function('beforeRender', [ 'delta' ], self.generateframe(hoisted, rootvals), export=True)
+        yield Blank()
+
+        yield self.generaterender(hoisted, rootvals)
+        yield Blank()
+
+    def generateframe(self, hoisted, rootvals):
+        # The body of beforeRender().
         # delta is ms since last call
         # we could accumulate the low-end bits, I suppose
-        outfl.write('  clock += (delta / 1000)\n')
-        
+        yield Assign(Name('clock'), Paren(Op('/', [ Name('delta'), Num(1000) ], spaced=True)), op='+=')
+        decayfactors = {}
         for stanza in self.stanzas:
-            if stanza.depend & AxisDep.TIME:
-                stanza.printlines(outfl=outfl, indent=1)
-        outfl.write('}\n')
-        outfl.write('\n')
+            decayfactors.update(stanza.decayfactors)
+        for ms, varname in decayfactors.items():
+            yield Decl(varname, Call('pow', [ Num(2), Op('/', [ Unary('-', Name('delta')), Num(ms) ]) ]))
+        
+        yield from self.generatestanzas(self.framegroups, hoisted=hoisted)
+        for varname, expr in rootvals:
+            yield Assign(Name(varname), expr)
 
+    def generaterender(self, hoisted, rootvals):
+        # The render() function.
         id = self.start.id
-        clamped = self.start.isclamped()
-        
-        outfl.write('export function render(index) {\n')
-        if self.start.dim is Dim.ONE:
-            if not (self.start.depend & AxisDep.SPACE):
-                if clamped:
-                    outfl.write(f'  var val = {id}_scalar\n')
-                else:
-                    outfl.write(f'  var val = clamp({id}_scalar, 0, 1)\n')
+        (lo, hi) = self.start.getbounds()
+
+        body = []
+        if self.rootstanza:
+            stanza = self.rootstanza
+            param = 'ix'
+            for varname, expr in stanza.storedvals:
+                if hoisted and varname in hoisted:
+                    continue
+                if any(varname == name for name, _ in rootvals):
+                    continue
+                body.append(Decl(varname, expr, comment=f'for {id}'))
+            if self.start.dim is Dim.ONE:
+                vals = [ Paren(stanza.bottomline) ]
             else:
-                if clamped:
-                    outfl.write(f'  var val = {id}_vector[index]\n')
-                else:
-                    outfl.write(f'  var val = clamp({id}_vector[index], 0, 1)\n')
-            outfl.write('  rgb(val*val, val*val, val*val)\n')
-        elif self.start.dim is Dim.THREE:
+                vals = [ Paren(line) for line in stanza.bottomline ]
+        else:
+            param = 'index'
             if not (self.start.depend & AxisDep.SPACE):
-                if clamped:
-                    outfl.write(f'  var valr = {id}_scalar_r\n')
-                    outfl.write(f'  var valg = {id}_scalar_g\n')
-                    outfl.write(f'  var valb = {id}_scalar_b\n')
-                else:
-                    outfl.write(f'  var valr = clamp({id}_scalar_r, 0, 1)\n')
-                    outfl.write(f'  var valg = clamp({id}_scalar_g, 0, 1)\n')
-                    outfl.write(f'  var valb = clamp({id}_scalar_b, 0, 1)\n')
+                buf = lambda suffix: Name(f'{id}_scalar{suffix}')
             else:
-                if clamped:
-                    outfl.write(f'  var valr = {id}_vector_r[index]\n')
-                    outfl.write(f'  var valg = {id}_vector_g[index]\n')
-                    outfl.write(f'  var valb = {id}_vector_b[index]\n')
-                else:
-                    outfl.write(f'  var valr = clamp({id}_vector_r[index], 0, 1)\n')
-                    outfl.write(f'  var valg = clamp({id}_vector_g[index], 0, 1)\n')
-                    outfl.write(f'  var valb = clamp({id}_vector_b[index], 0, 1)\n')
-            outfl.write('  rgb(valr*valr, valg*valg, valb*valb)\n')
+                buf = lambda suffix: Index(Name(f'{id}_vector{suffix}'), Name('index'))
+            if self.start.dim is Dim.ONE:
+                vals = [ buf('') ]
+            else:
+                vals = [ buf('_'+comp) for comp in 'rgb' ]
+        if lo < 0 and hi > 1:
+            vals = [ Call('clamp', [ val, Num(0), Num(1) ]) for val in vals ]
+        elif lo < 0:
+            vals = [ Call('max', [ val, Num(0) ]) for val in vals ]
+        elif hi > 1:
+            vals = [ Call('min', [ val, Num(1) ]) for val in vals ]
+            
+        if self.start.dim is Dim.ONE:
+            names = [ 'val', 'val', 'val' ]
+            body.append(Decl('val', vals[0]))
+        elif self.start.dim is Dim.THREE:
+            names = [ 'valr', 'valg', 'valb' ]
+            for name, val in zip(names, vals):
+                body.append(Decl(name, val))
         else:
             raise Exception('bad dim')
-        outfl.write('}\n')
-        outfl.write('\n')
+        body.append(ExprStmt(Call('rgb', [ Op('*', [ Name(name), Name(name) ]) for name in names ])))
+        return Function('render', [ param ], body, export=True)
         
 
 
+def pixelloop(body):
+    return For('ix', Num(0), PIXELCOUNT, body)
+
+def shareargs(nod):
+    # The args which share() walks. A quote's own arg stays private, so
+    # we walk the args under it instead.
+    if isinstance(nod, NodeQuote):
+        return nod.args.arg.argnodes()
+    return nod.argnodes()
+
 # Late imports
-from .nodes import NodeConstant, NodePulser, NodeDecay, NodeDiff, NodeShift, NodeShiftDecay
+from .nodes import NodeConstant, NodeQuote, NodePulser, NodeDecay, NodeDiff, NodeShift, NodeShiftDecay
+from .nodes import NodeGradient, NodeNGradient
 
 
@@ -0,0 +1,128 @@
+import os
+import re
+import sys
+import stat
+import json
+import time
+import signal
+import socket
+import socketserver
+
+from .api import compile_source
+
+# Support for --serve: a compile server on a Unix socket, so that editors
+# and tools don't pay for interpreter startup on every compile.
+#
+# The protocol is one JSON object per line, in each direction. A client
+# may send any number of requests on a connection. A request is
+#
+#   {"source": "wave: sine\n", "filename": "x.pbb", "options": {"level": 1}}
+#
+# where only "source" is required. The options are those of
+# compile_source(), over the defaults given on the command line. If the
+# request has an "id", the response repeats it. A response is either
+#
+#   {"ok": true, "code": "...", "ms": 1.2}
+#   {"ok": false, "error": {"type": "Exception", "message": "...", "line": 3, "col": 7}}
+#
+# where "line" and "col" are present when the error has a position.
+
+# Lexing errors start with "line N:" or "line N, col C:".
+pat_errorpos = re.compile(r'^line ([0-9]+)(?:, col ([0-9]+))?: ')
+
+def errorinfo(ex):
+    res = { 'type': ex.__class__.__name__, 'message': str(ex) }
+    match = pat_errorpos.match(str(ex))
+    if match:
+        res['line'] = int(match.group(1))
+        if match.group(2):
+            res['col'] = int(match.group(2))
+    return res
+
+def handlerequest(line, defaults):
+    # Returns the response object for one request line.
+    start = time.perf_counter()
+    try:
+        req = json.loads(line)
+    except ValueError as ex:
+        return { 'ok': False, 'error': { 'type': 'BadRequest', 'message': f'invalid JSON: {ex}' } }
+    if not isinstance(req, dict) or not isinstance(req.get('source'), str):
+        return { 'ok': False, 'error': { 'type': 'BadRequest', 'message': 'request needs a "source" string' } }
+    options = dict(defaults)
+    try:
+        options.update(req.get('options') or {})
+        res = compile_source(req['source'], filename=req.get('filename'), **options)
+        resp = { 'ok': True, 'code': res.code }
+    except Exception as ex:
+        resp = { 'ok': False, 'error': errorinfo(ex) }
+    resp['ms'] = round(1000 * (time.perf_counter() - start), 3)
+    if 'id' in req:
+        resp['id'] = req['id']
+    return resp
+
+class CompileHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            resp = handlerequest(line, self.server.defaults)
+            self.wfile.write(json.dumps(resp).encode() + b'\n')
+            self.wfile.flush()
+
+class CompileServer(socketserver.ThreadingUnixStreamServer):
+    # Each connection gets a thread; compiles don't share any state, so
+    # they need no locking.
+    daemon_threads = True
+
+    def __init__(self, path, defaults=None):
+        self.defaults = defaults or {}
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, CompileHandler)
+
+def clearsocket(path):
+    # Remove a stale socket file, left by a server which didn't shut down
+    # cleanly. A live server keeps its socket.
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise Exception(f'{path}: not a socket')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise Exception(f'{path}: a server is already running')
+
+def serve(path, defaults=None):
+    # Runs until interrupted (or terminated).
+    clearsocket(path)
+    # Compile once up front, so the first request doesn't pay for
+    # anything left to warm up.
+    compile_source('wave: sine\n', **(defaults or {}))
+    server = CompileServer(path, defaults=defaults)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write(f'serving on {path}\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def request(path, req):
+    # Send one request to a server and return the response. (A client
+    # which compiles often should keep its connection open instead.)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        fl = sock.makefile('rwb')
+        fl.write(json.dumps(req).encode() + b'\n')
+        fl.flush()
+        line = fl.readline()
+        fl.close()
+    finally:
+        sock.close()
+    return json.loads(line)
@@ -0,0 +1,456 @@
+import math
+
+import numpy as np
+
+from .defs import Implicit, Dim, WaveShape, AxisDep
+from .compile import Node, find_unquoted_children
+from .compile import bounds_add, bounds_neg, bounds_mul
+from .nodes import NodeQuote, NodeNoise
+from .perlin import perlin_turbulence
+
+# A reference renderer: evaluate the node graph directly, one frame at a
+# time, with numpy arrays over all the pixels.
+#
+# Scalar values are floats; per-pixel values are arrays of shape
+# (pixels,). Colors are arrays of shape (3, 1) or (3, pixels). These all
+# broadcast against each other the way the generated code mixes scalars
+# and colors.
+#
+# This follows the generated Pixelblaze code, quirks and all (e.g. the
+# way pulser slots are scanned), except that it computes in floating
+# point rather than 16.16 fixed point, and the noise function is the
+# Perlin noise in perlin.py (shared with interp.py) rather than the
+# Pixelblaze's own.
+
+def sample_shape(shape, var):
+    # The numpy equivalent of wave_sample().
+    match shape:
+        case WaveShape.FLAT | WaveShape.SQUARE:
+            return np.ones_like(var)
+        case WaveShape.HALFSQUARE:
+            return np.where(var < 0.5, 1.0, 0.0)
+        case WaveShape.SAWTOOTH:
+            return var
+        case WaveShape.SAWDECAY:
+            return 1-var
+        case WaveShape.SQRTOOTH:
+            return var*var
+        case WaveShape.SQRDECAY:
+            return (1-var)*(1-var)
+        case WaveShape.TRIANGLE:
+            return triangle(var)
+        case WaveShape.TRAPEZOID:
+            return np.minimum(1, 2*triangle(var))
+        case WaveShape.SINE:
+            return np.sin(var*math.pi)
+        case _:
+            raise NotImplementedError('sample_shape: %s' % (shape,))
+
+def triangle(val):
+    return 1 - np.abs(2*np.mod(val, 1) - 1)
+
+def color3(vals):
+    # Stack three scalar-or-vector values into a color.
+    arrs = [ np.atleast_1d(np.asarray(val, dtype=float)) for val in vals ]
+    return np.stack(np.broadcast_arrays(*arrs))
+
+def shiftvector(vec, shiftpos):
+    # Sample vec at fractional positions, clamping at the ends.
+    pixels = np.arange(vec.shape[-1])
+    if vec.ndim == 1:
+        return np.interp(shiftpos, pixels, vec)
+    return np.stack([ np.interp(shiftpos, pixels, row) for row in vec ])
+
+class Simulator:
+    def __init__(self, program, pixels=240, seed=None):
+        if program.start is None:
+            raise Exception('no root')
+        if not program.nodes:
+            raise Exception('program has not been post-processed')
+        self.program = program
+        self.pixels = pixels
+        self.random = np.random.default_rng(seed)
+        self.space = np.arange(pixels) / pixels
+        self.clock = 0.0
+        self.delta = 0.0
+
+        self.state = {}
+        self.values = {}
+        self.static = {}
+
+        # Perlin noise wraps where the first noise node sets it (as
+        # setPerlinWrap() does).
+        self.noisewrap = 0
+        for nod in program.nodes:
+            if isinstance(nod, NodeNoise):
+                self.noisewrap = int(nod.args.grain)
+                break
+
+        # The nodes to evaluate each frame, in dependency order. Nodes
+        # inside a quote are evaluated per pulse instead; only their
+        # unquoted children (captured at pulse birth) are needed here.
+        reached = set()
+        todo = [ program.start ]
+        while todo:
+            nod = todo.pop()
+            if nod.id in reached:
+                continue
+            if isinstance(nod, NodeQuote):
+                todo.extend(find_unquoted_children(nod))
+                continue
+            reached.add(nod.id)
+            for argf in nod.argformat:
+                for arg in nod.getargls(argf.name, argf.multiple):
+                    if isinstance(arg, Node):
+                        todo.append(arg)
+        self.plan = []
+        for nod in program.nodes:
+            if nod.id in reached:
+                func = getattr(self, 'eval_'+nod.classname)
+                self.plan.append( (nod, func, bool(nod.depend & AxisDep.TIME)) )
+
+    def frame(self, delta):
+        # Advance the clock by delta seconds, and return the pixel colors
+        # (after gamma) as an array of shape (pixels, 3).
+        self.delta = delta
+        self.clock += delta
+        values = self.values
+        val = self.value
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for nod, func, timed in self.plan:
+                if not timed:
+                    # Computed once, like the startup code
+                    if nod.id not in self.static:
+                        self.static[nod.id] = func(nod, val, self.clock)
+                    values[nod.id] = self.static[nod.id]
+                else:
+                    values[nod.id] = func(nod, val, self.clock)
+        return self.output(values[self.program.start.id])
+
+    def frames(self, count, delta, out=None):
+        # Render count frames into an array of shape (count, pixels, 3).
+        # If out is given, frames are written into it one at a time; an
+        # integer array gets values scaled to 0-255.
+        if out is None:
+            out = np.empty((count, self.pixels, 3))
+        scaled = None
+        if np.issubdtype(out.dtype, np.integer):
+            scaled = np.empty((self.pixels, 3))
+        for ix in range(count):
+            val = self.frame(delta)
+            if scaled is not None:
+                np.multiply(val, 255, out=scaled)
+                np.rint(scaled, out=scaled)
+                val = scaled
+            out[ix] = val
+        return out
+
+    def value(self, nod):
+        return self.values[nod.id]
+
+    def output(self, val):
+        nod = self.program.start
+        if nod.dim is Dim.ONE:
+            val = np.clip(np.broadcast_to(val, (self.pixels,)), 0, 1)
+            val = val * val
+            return np.repeat(val[:, np.newaxis], 3, axis=1)
+        elif nod.dim is Dim.THREE:
+            val = np.clip(np.broadcast_to(val, (3, self.pixels)), 0, 1)
+            return (val * val).T
+        else:
+            raise Exception('bad dim')
+
+    def implicit(self, nod, t):
+        if nod.implicit is Implicit.TIME:
+            return t
+        if nod.implicit is Implicit.SPACE:
+            return self.space
+        raise Exception('implicit not set')
+
+    def randsize(self, nod):
+        return self.pixels if (nod.depend & AxisDep.SPACE) else None
+
+    def decayfactor(self, halflife):
+        return 2 ** (-self.delta / halflife)
+
+    def eval_constant(self, nod, val, t):
+        return nod.args.value
+
+    def eval_color(self, nod, val, t):
+        col = nod.args.value
+        return color3([ col.red, col.green, col.blue ])
+
+    def eval_quote(self, nod, val, t):
+        raise Exception('cannot use quote directly')
+
+    def eval_time(self, nod, val, t):
+        return val(nod.args.arg)
+
+    def eval_space(self, nod, val, t):
+        return val(nod.args.arg)
+
+    def eval_linear(self, nod, val, t):
+        param = self.implicit(nod, t)
+        return val(nod.args.start) + param * val(nod.args.velocity)
+
+    def eval_changing(self, nod, val, t):
+        if nod.implicit is Implicit.SPACE:
+            raise Exception('changing cannot be SPACE')
+        accum = self.state.get(nod.id, 0.0) + self.delta * val(nod.args.velocity)
+        self.state[nod.id] = accum
+        return val(nod.args.start) + accum
+
+    def eval_randflat(self, nod, val, t):
+        minval = val(nod.args.min)
+        diff = val(nod.args.max) - minval
+        return self.random.random(self.randsize(nod)) * diff + minval
+
+    def eval_randnorm(self, nod, val, t):
+        size = self.randsize(nod)
+        total = self.random.random(size) + self.random.random(size) + self.random.random(size)
+        return (total - 1.5) * (val(nod.args.stdev) / 0.522) + val(nod.args.mean)
+
+    def eval_clamp(self, nod, val, t):
+        return np.minimum(np.maximum(val(nod.args.arg), val(nod.args.min)), val(nod.args.max))
+
+    def eval_lerp(self, nod, val, t):
+        arg1 = val(nod.args.arg1)
+        return arg1 + (val(nod.args.arg2) - arg1) * val(nod.args.weight)
+
+    def eval_sum(self, nod, val, t):
+        res = val(nod.args.arg[0])
+        for arg in nod.args.arg[ 1 : ]:
+            res = res + val(arg)
+        return res
+
+    def eval_mean(self, nod, val, t):
+        return self.eval_sum(nod, val, t) / len(nod.args.arg)
+
+    def eval_mul(self, nod, val, t):
+        res = val(nod.args.arg[0])
+        for arg in nod.args.arg[ 1 : ]:
+            res = res * val(arg)
+        return res
+
+    def eval_max(self, nod, val, t):
+        res = val(nod.args.arg[0])
+        for arg in nod.args.arg[ 1 : ]:
+            res = np.maximum(res, val(arg))
+        return res
+
+    def eval_min(self, nod, val, t):
+        res = val(nod.args.arg[0])
+        for arg in nod.args.arg[ 1 : ]:
+            res = np.minimum(res, val(arg))
+        return res
+
+    def eval_mod(self, nod, val, t):
+        return np.mod(val(nod.args.arg1), val(nod.args.arg2))
+
+    def eval_wave(self, nod, val, t):
+        shape = nod.args.shape
+        maxval = val(nod.args.max)
+        if shape in (WaveShape.FLAT, WaveShape.SQUARE):
+            return maxval
+        minval = val(nod.args.min)
+        param = self.implicit(nod, t)
+        period = val(nod.args.period)
+        shift = val(nod.args.shift)
+        if nod.implicit is Implicit.SPACE:
+            theta = (param - (0.5+shift)) / period + 0.5
+        else:
+            theta = (param - shift) / period
+        match shape:
+            case WaveShape.SAWTOOTH:
+                res = np.mod(theta, 1)
+            case WaveShape.SAWDECAY:
+                res = 1 - np.mod(theta, 1)
+            case WaveShape.SQRTOOTH:
+                res = np.mod(theta, 1) ** 2
+            case WaveShape.SQRDECAY:
+                res = (1 - np.mod(theta, 1)) ** 2
+            case WaveShape.TRIANGLE:
+                res = triangle(theta)
+            case WaveShape.HALFSQUARE:
+                res = np.where(np.mod(theta, 1) < 0.5, 1.0, 0.0)
+            case WaveShape.SINE:
+                res = 0.5 * (1 - np.cos(2*math.pi*theta))
+            case _:
+                raise Exception('unimplemented WaveShape')
+        return minval + (maxval - minval) * res
+
+    def eval_rgb(self, nod, val, t):
+        return color3([ val(nod.args.r), val(nod.args.g), val(nod.args.b) ])
+
+    def eval_brightness(self, nod, val, t):
+        col = val(nod.args.value)
+        return 0.299 * col[0] + 0.587 * col[1] + 0.114 * col[2]
+
+    def eval_red(self, nod, val, t):
+        return val(nod.args.value)[0]
+
+    def eval_green(self, nod, val, t):
+        return val(nod.args.value)[1]
+
+    def eval_blue(self, nod, val, t):
+        return val(nod.args.value)[2]
+
+    def eval_gradient(self, nod, val, t):
+        arg = val(nod.args.arg)
+        posls = [ pos for pos, col in nod.args.stops ]
+        res = []
+        for key in ('red', 'green', 'blue'):
+            res.append(np.interp(arg, posls, [ getattr(col, key) for pos, col in nod.args.stops ]))
+        return color3(res)
+
+    def eval_ngradient(self, nod, val, t):
+        arg = val(nod.args.arg)
+        posls = [ pos for pos, stopval in nod.args.nstops ]
+        return np.interp(arg, posls, [ stopval for pos, stopval in nod.args.nstops ])
+
+    def eval_stop(self, nod, val, t):
+        raise Exception('stop can only be used in a gradient')
+
+    def eval_nstop(self, nod, val, t):
+        raise Exception('nstop can only be used in an ngradient')
+
+    def emptybuffer(self, nod):
+        if nod.dim is Dim.THREE:
+            return np.zeros((3, self.pixels))
+        return np.zeros(self.pixels)
+
+    def eval_decay(self, nod, val, t):
+        last = self.state.get(nod.id, 0.0)
+        res = np.maximum(last * self.decayfactor(nod.args.halflife), val(nod.args.arg))
+        self.state[nod.id] = res
+        return res
+
+    def eval_diff(self, nod, val, t):
+        arg = nod.args.arg
+        if not (arg.depend & AxisDep.SPACE):
+            return 0.0
+        argval = val(arg)
+        res = self.emptybuffer(nod)
+        res[..., 1:-1] = (self.pixels/2) * (argval[..., 2:] - argval[..., :-2])
+        return res
+
+    def eval_shift(self, nod, val, t):
+        arg = nod.args.arg
+        if not (arg.depend & AxisDep.SPACE):
+            return val(arg)
+        shiftpos = np.arange(self.pixels) - val(nod.args.by) * self.pixels
+        return shiftvector(val(arg), shiftpos)
+
+    def eval_shiftdecay(self, nod, val, t):
+        last = self.state.get(nod.id)
+        if last is None:
+            last = self.emptybuffer(nod)
+        previous = last * self.decayfactor(nod.args.halflife)
+        shiftpos = np.arange(self.pixels) - val(nod.args.by) * self.delta * self.pixels
+        res = np.maximum(val(nod.args.arg), shiftvector(previous, shiftpos))
+        self.state[nod.id] = res
+        return res
+
+    def eval_noise(self, nod, val, t):
+        param = self.implicit(nod, t)
+        x = (param - val(nod.args.shift)) * nod.args.grain
+        y = val(nod.args.morph)
+        return perlin_turbulence(x, y, 0.0, 2, 0.5, nod.args.octaves, self.noisewrap)
+
+    def pulseval(self, nod, captured, age):
+        # The value of a pulser arg for one pulse: constants inline,
+        # quoted nodes are evaluated at the pulse's age, and anything
+        # else was captured when the pulse began.
+        if nod.isconstant():
+            return self.eval_constant(nod, None, age)
+        if not isinstance(nod, NodeQuote):
+            return captured[nod.id]
+        qnod = nod.args.arg
+        func = getattr(self, 'eval_'+qnod.classname)
+        return func(qnod, lambda arg: self.pulseval(arg, captured, age), age)
+
+    def eval_pulser(self, nod, val, t):
+        args = nod.args
+        maxcount = args.maxcount
+        state = self.state.get(nod.id)
+        if state is None:
+            state = {
+                'live': [ False ] * maxcount,
+                'birth': [ 0.0 ] * maxcount,
+                'captured': [ None ] * maxcount,
+                'nextstart': 0.0,
+            }
+            self.state[nod.id] = state
+        live = state['live']
+        birth = state['birth']
+        captured = state['captured']
+        clock = self.clock
+
+        # (The generated code never increments its livecount, so only the
+        # free slots limit new pulses.)
+        if clock >= state['nextstart']:
+            if not all(live):
+                px = live.index(False)
+                live[px] = True
+                capture = {}
+                for key in ['pos', 'width', 'duration']:
+                    for unq in nod.unquotedargs[key]:
+                        capture[unq.id] = val(unq)
+                captured[px] = capture
+                state['nextstart'] = clock + val(args.interval)
+                birth[px] = clock
+
+        # The possible ranges of the pulse's edges, as in generateexpr().
+        posbounds = args.pos.getbounds()
+        halfwidth = bounds_mul(args.width.getbounds(), (0.5, 0.5))
+        lowedge = bounds_add(posbounds, bounds_neg(halfwidth))
+        highedge = bounds_add(posbounds, halfwidth)
+        killhigh = killlow = False
+        if isinstance(args.pos, NodeQuote):
+            quotepos = args.pos.args.arg
+            killhigh = quotepos.isnondecreasing() and lowedge[1] > 1.0
+            killlow = quotepos.isnonincreasing() and highedge[0] < 0.0
+
+        pixels = self.pixels
+        res = np.zeros(pixels)
+        for px in range(maxcount):
+            # The generated code stops at the first free slot.
+            if not live[px]:
+                break
+            age = clock - birth[px]
+            if args.timeshape is WaveShape.FLAT:
+                timeval = 1.0
+            else:
+                relage = age / self.pulseval(args.duration, captured[px], age)
+                if relage > 1.0:
+                    live[px] = False
+                    continue
+                timeval = float(sample_shape(args.timeshape, relage))
+            ppos = self.pulseval(args.pos, captured[px], age)
+            pwidth = self.pulseval(args.width, captured[px], age)
+            if killhigh and ppos-pwidth/2 > 1.0:
+                live[px] = False
+                continue
+            if killlow and ppos+pwidth/2 < 0.0:
+                live[px] = False
+                continue
+            if args.spaceshape is WaveShape.FLAT:
+                res += timeval
+                continue
+            minpos = max(0, pixels*(ppos-pwidth/2))
+            maxpos = min(pixels, pixels*(ppos+pwidth/2))
+            if maxpos <= minpos:
+                continue
+            ix = minpos + np.arange(math.ceil(maxpos-minpos))
+            relpos = ((ix/pixels)-(ppos-pwidth/2)) / pwidth
+            res[ix.astype(int)] += timeval * sample_shape(args.spaceshape, relpos)
+        return res
+
+def record(program, filename, frames, fps=40, pixels=240, dtype='uint8', seed=None):
+    # Render frames straight into a memory-mapped .npy file of shape
+    # (frames, pixels, 3), so that long recordings never sit in memory.
+    sim = Simulator(program, pixels=pixels, seed=seed)
+    res = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(frames, pixels, 3))
+    sim.frames(frames, 1/fps, out=res)
+    res.flush()
+    return res
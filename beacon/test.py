@@ -5,6 +5,14 @@ from io import StringIO
 
 from .lex import parselines
 from .compile import compileall
+from .cost import estimate
+from .passes import PassManager
+from .interp import Interpreter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 pat_indent = re.compile('^[ ]*')
 
@@ -39,7 +47,7 @@ def stripdown(text):
 
 class TestCompile(unittest.TestCase):
 
-    def checkfile(self, filename):
+    def checkfile(self, filename, **options):
         path = os.path.join(os.path.dirname(__file__), 'testfiles', filename)
         
         srcls = []
@@ -59,7 +67,7 @@ class TestCompile(unittest.TestCase):
         res = '\n'.join(resls)
         src = deindent('\n'.join(srcls))
 
-        program = self.compile(src)
+        program = self.compile(src, **options)
 
         outfl = StringIO()
         program.write(outfl)
@@ -67,12 +75,16 @@ class TestCompile(unittest.TestCase):
 
         self.assertEqual(output, res)
 
-    def compile(self, src):
+    def compile(self, src, **options):
         fl = StringIO(src)
         parsetrees, srclines = parselines(fl)
         fl.close()
 
         program = compileall(parsetrees, srclines=srclines)
+        for key, val in options.items():
+            setattr(program, key, val)
+        program.fold()
+        program.share()
         program.post()
         return program
 
@@ -127,6 +139,622 @@ class TestCompile(unittest.TestCase):
     def test_sumgradient(self):
         self.checkfile('sumgradient.pbb')
         
+    def test_constantfold(self):
+        self.checkfile('constantfold.pbb')
+        
+    def test_sharenodes(self):
+        self.checkfile('sharenodes.pbb')
+        
+    def test_fuseloops(self):
+        self.checkfile('fuseloops.pbb')
+        
+    def test_reusebuffers(self):
+        self.checkfile('reusebuffers.pbb')
+        
+    def test_inlineroot(self):
+        self.checkfile('inlineroot.pbb', inlineroot=True)
+        
+    def test_hoistvals(self):
+        self.checkfile('hoistvals.pbb', inlineroot=True)
+        
+    def test_decayfactor(self):
+        self.checkfile('decayfactor.pbb')
+
+    def test_decayfactorname(self):
+        program = self.compile(deindent('''
+            sum
+              decay: halflife=0.1
+                wave: triangle, period=time: 2
+              decay: halflife=0.0000001
+                wave: sine, period=time: 3
+              decay: halflife=0.1000000001
+                wave: sawtooth, period=time: 4
+        '''))
+        outfl = StringIO()
+        program.write(outfl)
+        names = re.findall('var (decayfactor_[^ ]*) =', outfl.getvalue())
+        self.assertEqual(sorted(names), [ 'decayfactor_100', 'decayfactor_100_0000001', 'decayfactor_9_999999999999999em05' ])
+        
+    def test_gradientlut(self):
+        self.checkfile('gradientlut.pbb', gradientlut=16)
+        
+    def test_ngradientlut(self):
+        self.checkfile('ngradientlut.pbb', gradientlut=32, gradientlerp=True)
+        
+    def test_fusecolor(self):
+        self.checkfile('fusecolor.pbb')
+        
+    def test_bounds(self):
+        self.checkfile('bounds.pbb')
+        
+
+class TestCost(unittest.TestCase):
+
+    def estimate(self, src, pixels=100):
+        program = TestCompile().compile(deindent(src))
+        return estimate(program, pixels=pixels)
+
+    def test_spacewave(self):
+        report = self.estimate('''
+            wave: sine
+        ''')
+        # Computed once at startup
+        self.assertEqual(report.calls, {})
+        self.assertEqual(report.pixelarrays, 1)
+        self.assertGreater(report.startupops, 0)
+
+    def test_timespacewave(self):
+        report = self.estimate('''
+            wave: sine, period=time: wave: triangle, min=0.5, max=2
+        ''', pixels=100)
+        self.assertEqual(report.calls, { 'cos': 100 })
+        report2 = self.estimate('''
+            wave: sine, period=time: wave: triangle, min=0.5, max=2
+        ''', pixels=200)
+        self.assertEqual(report2.calls, { 'cos': 200 })
+        self.assertGreater(report.fps(), report2.fps())
+
+    def test_decay(self):
+        report = self.estimate('''
+            decay: halflife=0.5
+              wave: triangle, period=time: 2
+        ''')
+        self.assertEqual(report.calls, { 'pow': 1 })
+
+    def test_pulser(self):
+        # The pulse loop only covers the pulse's width.
+        src = '''
+            pulser: maxcount=4, spaceshape=sine, timeshape=sawdecay, interval=1, width=%s
+        '''
+        report = self.estimate(src % (0.1,))
+        report2 = self.estimate(src % (0.4,))
+        self.assertLess(report.pixelops, report2.pixelops)
+        self.assertEqual(report.pixelarrays, 1)
+        self.assertEqual(report.otherarrays, 2)
+
+class TestPasses(unittest.TestCase):
+
+    def compile(self, src, **options):
+        fl = StringIO(deindent(src))
+        parsetrees, srclines = parselines(fl)
+        fl.close()
+        program = compileall(parsetrees, srclines=srclines)
+        passes = PassManager(**options)
+        passes.run(program)
+        return program, passes
+
+    def write(self, program):
+        outfl = StringIO()
+        program.write(outfl)
+        return outfl.getvalue()
+
+    def test_levels(self):
+        src = '''
+            sum: 0.1, 0.2, mul: 0.5, 0.5
+        '''
+        program0, passes0 = self.compile(src, level=0)
+        program2, passes2 = self.compile(src, level=2)
+        self.assertGreater(len(program0.nodes), len(program2.nodes))
+        self.assertFalse(program0.hoistvals)
+        self.assertTrue(program2.hoistvals)
+        self.assertEqual(passes2.passes[0].name, 'fold')
+        self.assertEqual(passes2.passes[0].changed, 5)
+        self.assertIsNone(passes0.passes[0].changed)
+
+    def test_levelsquare(self):
+        # Every level accepts the same scripts, whether or not the fold
+        # pass gets to them first.
+        src = '''
+            mul: wave: sine, wave: square, min=0.2, max=0.7
+        '''
+        outputs = []
+        for level in (0, 1, 2):
+            program, passes = self.compile(src, level=level)
+            interp = Interpreter(self.write(program), pixels=10)
+            outputs.append(interp.frame(0.05))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def test_disable(self):
+        src = '''
+            a=wave: triangle, period=0.5
+            sum: a, mul: a, a
+        '''
+        program, passes = self.compile(src, disable=['fuseloops'])
+        program2 = TestCompile().compile(deindent(src), fuseloops=False)
+        self.assertEqual(self.write(program), self.write(program2))
+        program3, passes3 = self.compile(src, level=0, enable=['fuseloops'])
+        self.assertTrue(program3.fuseloops)
+        self.assertFalse(program3.reusebuffers)
+
+    def test_report(self):
+        program, passes = self.compile('''
+            sum: 0.1, 0.2, mul: 0.5, 0.5
+        ''', level=1)
+        outfl = StringIO()
+        passes.report(program, outfl)
+        self.assertEqual(outfl.getvalue().split('\n')[ : 3 ], [
+            'optimization level 1:',
+            '  fold: 5 nodes removed',
+            '  share: 0 nodes merged',
+        ])
+
+    def test_reportfuse(self):
+        # Only what the passes actually changed is counted: three loops
+        # become one, and one color node is fused (rgb has no shared
+        # work to fuse).
+        src = '''
+            a=wave: sine, period=time: 2
+            b=wave: triangle, period=time: 3
+            sum
+              rgb: a, b, 0.5
+              lerp: $F00, $00F, a
+        '''
+        program, passes = self.compile(src, level=2)
+        outfl = StringIO()
+        passes.report(program, outfl)
+        lines = outfl.getvalue().split('\n')
+        self.assertIn('  fuseloops: 2 loops merged', lines)
+        self.assertEqual(self.write(program).count('for (var ix'), 1)
+        self.assertIn('  fusecolors: 1 color nodes fused', lines)
+
+    def test_unknown(self):
+        with self.assertRaises(Exception):
+            PassManager(enable=['nosuchpass'])
+        with self.assertRaises(Exception):
+            PassManager(level=5)
+        
+
+class TestInterp(unittest.TestCase):
+
+    def interpreter(self, src, pixels=24, **options):
+        program = TestCompile().compile(deindent(src), **options)
+        outfl = StringIO()
+        program.write(outfl)
+        return Interpreter(outfl.getvalue(), pixels=pixels, seed=1)
+
+    def test_basic(self):
+        interp = Interpreter(deindent('''
+            var count = 0
+            var buf = array(pixelCount)
+            function half(val) {
+              return val / 2
+            }
+            export function beforeRender(delta) {
+              count += 1
+              for (var ix=0; ix<pixelCount; ix++) {
+                if (ix < 2) { continue } else if (ix >= 3) { break }
+                buf[ix] = half(delta)
+              }
+            }
+            export function render(index) {
+              rgb(count, buf[index], index > 1 ? 1 : 0)
+            }
+        '''), pixels=4)
+        self.assertEqual(interp.frame(0.5), [ (1, 0, 0), (1, 0, 0), (1, 250, 1), (1, 0, 1) ])
+        self.assertEqual(interp.calls, { 'half': 1, 'rgb': 4 })
+        self.assertEqual(interp.funcops['half'], 1)
+
+    def test_spacewave(self):
+        interp = self.interpreter('''
+            wave: sine
+        ''', pixels=4)
+        res = interp.frame(0.025)
+        self.assertAlmostEqual(res[0][0], 0)
+        self.assertAlmostEqual(res[1][1], 0.25)
+        self.assertAlmostEqual(res[2][2], 1)
+        # The wave is computed at startup; each frame just renders it.
+        self.assertEqual(interp.funcops, { 'beforeRender': 2, 'render': 4*5 })
+        self.assertEqual(interp.stanzaops, { None: 18, 'wave_0': 4 })
+
+    def test_stanzas(self):
+        interp = self.interpreter('''
+            a=wave: triangle, shift=time: wave: sawtooth, period=4
+            sum: a, shift: a, by=0.1
+        ''')
+        interp.frame(0.025)
+        self.assertEqual(set(interp.stanzaops), set([ None, 'time_1', 'wave_0', 'shift_11', 'sum_10' ]))
+
+    def test_hoistvals(self):
+        src = '''
+            a=wave: sine, period=time: wave: triangle, min=0.5, max=2
+            b=mul: a, wave: triangle, period=0.5
+            lerp: a, b, wave: halfsquare, min=time: wave: sine, max=0.3, period=0.25
+        '''
+        interp1 = self.interpreter(src, hoistvals=False)
+        interp2 = self.interpreter(src, hoistvals=True)
+        res1 = interp1.frame(0.025)
+        res2 = interp2.frame(0.025)
+        for val1, val2 in zip(res1, res2):
+            self.assertAlmostEqual(val1[0], val2[0])
+        self.assertLess(sum(interp2.funcops.values()), sum(interp1.funcops.values()))
+
+    def test_inlinestatic(self):
+        # A root which doesn't change over time is not inlined, so it is
+        # computed once rather than every frame.
+        src = '''
+            space: randflat: 0, 1
+        '''
+        program = TestCompile().compile(deindent(src), inlineroot=True)
+        self.assertIsNone(program.rootstanza)
+        interp = self.interpreter(src, inlineroot=True)
+        res = interp.frame(0.025)
+        for ix in range(3):
+            self.assertEqual(interp.frame(0.025), res)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_sim(self):
+        from .sim import Simulator
+        src = '''
+            gradient:
+              stop: 0, $08F
+              stop: 1, $0C4
+              mul
+                time: wave: shape=sine, period=8
+                pulser:
+                    maxcount = 3
+                    interval = 0.7
+                    pos = quote: linear: 0.1, 0.3
+                    spaceshape = sine
+                    width = 0.3
+                    duration = 1.5
+        '''
+        interp = self.interpreter(src, pixels=30)
+        program = TestCompile().compile(deindent(src))
+        sim = Simulator(program, pixels=30)
+        for ix in range(40):
+            res1 = numpy.array(interp.frame(0.05))
+            res2 = sim.frame(0.05)
+            self.assertTrue(numpy.allclose(res1, res2))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_simnoise(self):
+        # Both renderers use the same Perlin noise.
+        from .sim import Simulator
+        src = '''
+            noise: grain=4, octaves=3
+              shift=linear: 0, 0.2
+              morph=linear: 0, 0.7
+        '''
+        interp = self.interpreter(src, pixels=30)
+        program = TestCompile().compile(deindent(src))
+        sim = Simulator(program, pixels=30)
+        for ix in range(10):
+            res1 = numpy.array(interp.frame(0.05))
+            res2 = sim.frame(0.05)
+            self.assertTrue(numpy.allclose(res1, res2))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_reusecolor(self):
+        # Each color component reads the arrays of the others; none of
+        # them may be reused for the color's own output.
+        from .sim import Simulator
+        src = '''
+            a=wave: sine, period=time: wave: triangle, min=0.5, max=2
+            b=wave: triangle, period=time: wave: sawtooth, min=0.3, max=1
+            c=wave: sawtooth, period=time: wave: sine, min=0.7, max=3
+            rgb
+              mul: a, b
+              mul: b, c
+              mul: c, a
+        '''
+        for level in (1, 2):
+            program, passes = TestPasses().compile(src, level=level)
+            outfl = StringIO()
+            program.write(outfl)
+            interp = Interpreter(outfl.getvalue(), pixels=30, seed=1)
+            sim = Simulator(program, pixels=30)
+            for ix in range(10):
+                res1 = numpy.array(interp.frame(0.05))
+                res2 = sim.frame(0.05)
+                self.assertTrue(numpy.allclose(res1, res2), level)
+
+    def test_reusediff(self):
+        # A diff vector doesn't write its end pixels, so it may not take
+        # over an array that held something else.
+        from .sim import Simulator
+        src = '''
+            a=wave: sine, period=time: wave: triangle, min=0.5, max=2
+            b=shift: a, by=0.2
+            diff: b
+        '''
+        for level in (1, 2):
+            program, passes = TestPasses().compile(src, level=level)
+            outfl = StringIO()
+            program.write(outfl)
+            interp = Interpreter(outfl.getvalue(), pixels=20, seed=1)
+            sim = Simulator(program, pixels=20)
+            for ix in range(10):
+                res1 = numpy.array(interp.frame(0.05))
+                res2 = sim.frame(0.05)
+                self.assertTrue(numpy.allclose(res1, res2), level)
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestSim(unittest.TestCase):
+
+    def simulator(self, src, pixels=240):
+        from .sim import Simulator
+        program = TestCompile().compile(deindent(src))
+        return Simulator(program, pixels=pixels, seed=1)
+
+    def test_spacewave(self):
+        sim = self.simulator('''
+            wave: sine
+        ''')
+        res = sim.frame(0.025)
+        self.assertEqual(res.shape, (240, 3))
+        xs = numpy.arange(240) / 240
+        val = 0.5 * (1 - numpy.cos(2*numpy.pi*xs))
+        self.assertTrue(numpy.allclose(res[:, 0], val*val))
+        self.assertTrue(numpy.allclose(res[:, 2], val*val))
+
+    def test_color(self):
+        sim = self.simulator('''
+            rgb: 1, 0.5, 0
+        ''', pixels=10)
+        res = sim.frame(0.025)
+        self.assertTrue(numpy.allclose(res, [ 1, 0.25, 0 ]))
+
+    def test_shift(self):
+        sim = self.simulator('''
+            w=wave: sawtooth
+            shift: w, by=0.25
+        ''')
+        res = sim.frame(0.025)
+        val = numpy.maximum(numpy.arange(240) - 60, 0) / 240
+        self.assertTrue(numpy.allclose(res[:, 1], val*val))
+
+    def test_decay(self):
+        sim = self.simulator('''
+            decay: 0.5
+              time: wave: halfsquare, period=2
+        ''', pixels=4)
+        vals = [ sim.frame(0.5)[0, 0] for ix in range(3) ]
+        self.assertTrue(numpy.allclose(vals, [ 1, 0.25, 0.0625 ]))
+
+    def test_pulser(self):
+        sim = self.simulator('''
+            pulser: maxcount=1, spaceshape=flat, timeshape=sawdecay, interval=10
+        ''', pixels=4)
+        vals = [ sim.frame(0.25)[0, 0] for ix in range(5) ]
+        self.assertTrue(numpy.allclose(vals, [ 1, 0.5625, 0.25, 0.0625, 0 ]))
+
+    def test_record(self):
+        import tempfile
+        from .sim import Simulator, record
+        src = '''
+            wave: sine, period=time: wave: triangle, min=0.5, max=2
+        '''
+        program = TestCompile().compile(deindent(src))
+        expected = Simulator(program, pixels=16).frames(12, 0.025)
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'out.npy')
+            record(program, path, 12, fps=40, pixels=16, dtype='float32')
+            res = numpy.load(path, mmap_mode='r')
+            self.assertEqual(res.shape, (12, 16, 3))
+            self.assertEqual(res.dtype, numpy.float32)
+            self.assertTrue(numpy.allclose(res, expected, atol=1e-6))
+            del res
+            record(program, path, 12, fps=40, pixels=16, dtype='uint8')
+            res = numpy.load(path, mmap_mode='r')
+            self.assertEqual(res.dtype, numpy.uint8)
+            self.assertTrue(numpy.array_equal(res, numpy.rint(expected*255)))
+            del res
+
+    def test_scripts(self):
+        from .sim import Simulator
+        dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts')
+        if not os.path.isdir(dir):
+            self.skipTest('no scripts directory')
+        for filename in sorted(os.listdir(dir)):
+            if not filename.endswith('.pbb'):
+                continue
+            fl = open(os.path.join(dir, filename))
+            parsetrees, srclines = parselines(fl)
+            fl.close()
+            program = compileall(parsetrees, srclines=srclines)
+            PassManager().run(program)
+            res = Simulator(program, pixels=60, seed=1).frames(20, 0.05)
+            self.assertEqual(res.shape, (20, 60, 3))
+            self.assertTrue(numpy.all((res >= 0) & (res <= 1)), filename)
+        
+
+class TestBench(unittest.TestCase):
+
+    def test_synthetic(self):
+        from .bench import SYNTHETIC, STAGES, bench
+        for name, func, size in SYNTHETIC:
+            res = bench(func(10), repeat=1)
+            self.assertEqual(sorted(res.keys()), sorted(STAGES + [ 'peak' ]), name)
+
+class TestCache(unittest.TestCase):
+
+    def test_cache(self):
+        import tempfile
+        from .cache import Cache
+        with tempfile.TemporaryDirectory() as dir:
+            cache = Cache(dir, maxsize=2500)
+            key = cache.key('wave: sine\n', { 'source': False })
+            self.assertNotEqual(key, cache.key('wave: sine\n', { 'source': True }))
+            self.assertNotEqual(key, cache.key('wave: square\n', { 'source': False }))
+            self.assertIsNone(cache.get(key))
+            cache.put(key, 'x' * 1000)
+            self.assertEqual(cache.get(key), 'x' * 1000)
+
+            key2 = cache.key('2', {})
+            key3 = cache.key('3', {})
+            cache.put(key2, 'y' * 1000)
+            os.utime(cache.path(key), (1, 1))
+            cache.put(key3, 'z' * 1000)
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(cache.get(key2), 'y' * 1000)
+            self.assertEqual(cache.get(key3), 'z' * 1000)
+
+class TestWatch(unittest.TestCase):
+
+    def test_blockparser(self):
+        from .watch import BlockParser
+        text = '# comment\nfoo=wave: sine\n  period=2\n\n# more\nmul\n  foo\n  0.5\n'
+        parser = BlockParser()
+        trees, lines = parser.parse(text)
+        expected = parselines(StringIO(text))
+        self.assertEqual(repr(trees), repr(expected[0]))
+        self.assertEqual(lines, expected[1])
+        self.assertEqual((parser.reparsed, parser.blockcount), (3, 3))
+
+        text = text.replace('0.5', '0.25')
+        trees, lines = parser.parse(text)
+        expected = parselines(StringIO(text))
+        self.assertEqual(repr(trees), repr(expected[0]))
+        self.assertEqual(lines, expected[1])
+        self.assertEqual((parser.reparsed, parser.blockcount), (1, 3))
+
+class TestLex(unittest.TestCase):
+
+    def test_positions(self):
+        fl = StringIO('# comment\nfoo=wave: sine\n\tperiod = $F80,  -0.5\n')
+        trees, lines = parselines(fl)
+        term = trees[0]
+        self.assertEqual((term.tok.val, term.tok.line, term.tok.col), ('wave', 2, 5))
+        ls = [ (arg.tok.val, arg.tok.line, arg.tok.col) for arg in term.args ]
+        self.assertEqual(ls, [ ('sine', 2, 11), ('$F80', 3, 11), (-0.5, 3, 18) ])
+        self.assertEqual(lines, [ '# comment', 'foo=wave: sine', '\tperiod = $F80,  -0.5' ])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(Exception, 'line 2, col 7: invalid character: @x'):
+            parselines(StringIO('foo\n  bar @x\n'))
+        with self.assertRaisesRegex(Exception, 'line 1, col 6: invalid color length'):
+            parselines(StringIO('foo: $ff\n'))
+        with self.assertRaisesRegex(Exception, 'line 3: indent mismatch'):
+            parselines(StringIO('x\n    a\n  b\n'))
+
+class TestIR(unittest.TestCase):
+
+    def test_format(self):
+        from .ir import Num, Name, Index, Call, Op, Unary, Cond, Paren, ArrayLit, Decl, Assign, If, For, Break, formatexpr, formatstmts
+        expr = Paren(Op('+', [ Name('a'), Op('*', [ Num(2), Call('mod', [ Name('b'), Num(1) ]) ]) ], spaced=True))
+        self.assertEqual(formatexpr(expr), '(a + 2*mod(b, 1))')
+        expr = Cond(Unary('!', Index(Name('v'), Num(0))), ArrayLit([ Num(1), Name('c') ]), Call('f', []))
+        self.assertEqual(formatexpr(expr), '!v[0] ? [1, c] : f()')
+        ix = Name('ix')
+        stmts = [
+            Decl('x', Num(0.5), comment='for y'),
+            For('ix', Num(0), Name('pixelCount'), [
+                If(Op('<', [ ix, Num(3) ]), [ Break() ], inline=True),
+                If(Op('<', [ ix, Num(5) ]), [ Assign(Name('x'), Num(1), op='+=') ], [
+                    If(Op('<', [ ix, Num(7) ]), [ Assign(Index(Name('v'), ix), Name('x')) ], [ Break() ]),
+                ]),
+            ]),
+        ]
+        self.assertEqual(formatstmts(stmts), '''var x = 0.5  // for y
+for (var ix=0; ix<pixelCount; ix++) {
+  if (ix<3) { break }
+  if (ix<5) {
+    x += 1
+  } else if (ix<7) {
+    v[ix] = x
+  } else {
+    break
+  }
+}
+''')
+
+    def test_names(self):
+        from .ir import Num, Name, Index, Call, Op, exprnames
+        expr = Call('max', [ Op('*', [ Index(Name('wave_12_vector'), Name('ix')), Name('wave_1_val_min') ]), Num(1) ])
+        self.assertEqual(exprnames(expr), set([ 'wave_12_vector', 'ix', 'wave_1_val_min' ]))
+
+    def test_deep(self):
+        from .ir import Name, Call, formatexpr
+        expr = Name('x0')
+        for ix in range(1, 5000):
+            expr = Call('max', [ expr, Name(f'x{ix}') ])
+        self.assertTrue(formatexpr(expr).endswith(', x4998), x4999)'))
+
+class TestAPI(unittest.TestCase):
+
+    def scripts(self):
+        dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts')
+        res = []
+        for filename in sorted(os.listdir(dir)):
+            if filename.endswith('.pbb'):
+                fl = open(os.path.join(dir, filename))
+                res.append( (os.path.join('scripts', filename), fl.read()) )
+                fl.close()
+        return res
+
+    def test_compile_source(self):
+        from . import compile_source
+        dir = os.path.dirname(os.path.dirname(__file__))
+        for filename, text in self.scripts():
+            res = compile_source(text, filename=filename, source=True)
+            fl = open(os.path.join(dir, filename[ : -4 ] + '.pat'))
+            self.assertEqual(res.code, fl.read(), filename)
+            fl.close()
+        res = compile_source('wave: sine\n', level=0, gradient_lut=16)
+        self.assertTrue(res.code.startswith('// code generated by pbbeacon'))
+        self.assertFalse(any([ pss.enabled for pss in res.passes.passes ]))
+        with self.assertRaisesRegex(Exception, 'unknown option: bogus'):
+            compile_source('wave: sine\n', bogus=1)
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from . import compile_source
+        texts = [ text for filename, text in self.scripts() ] * 4
+        expected = [ compile_source(text).code for text in texts ]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda text: compile_source(text).code, texts))
+        self.assertEqual(results, expected)
+
+class TestServe(unittest.TestCase):
+
+    def test_serve(self):
+        import tempfile
+        import threading
+        from .serve import CompileServer, request
+        from . import compile_source
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'pb.sock')
+            server = CompileServer(path, defaults={ 'level': 1 })
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                res = request(path, { 'source': 'wave: sine\n', 'filename': 'x.pbb', 'id': 3 })
+                self.assertTrue(res['ok'])
+                self.assertEqual(res['id'], 3)
+                self.assertEqual(res['code'], compile_source('wave: sine\n', filename='x.pbb', level=1).code)
+                res = request(path, { 'source': 'foo\n  bar @x\n' })
+                self.assertFalse(res['ok'])
+                self.assertEqual((res['error']['line'], res['error']['col']), (2, 7))
+                res = request(path, { 'source': 'wave: sine\n', 'options': { 'bogus': 1 } })
+                self.assertEqual(res['error']['message'], 'unknown option: bogus')
+                res = request(path, [ 'wave: sine\n' ])
+                self.assertEqual(res['error']['type'], 'BadRequest')
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
 
 if __name__ == '__main__':
     unittest.main()
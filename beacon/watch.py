@@ -0,0 +1,87 @@
+import os
+import time
+from io import StringIO
+
+from .lex import parselines
+
+# Support for --watch: poll a script for changes and rebuild it.
+#
+# A script is a series of top-level blocks: a line at indent zero plus
+# the indented lines (and blanks and comments) under it. Each block lexes
+# to its own parse trees, so we only reparse the blocks whose text has
+# changed. The node graph is rebuilt from scratch every time; the passes
+# and post() rewrite nodes in place, so a graph can't be reused.
+
+POLL_INTERVAL = 0.05
+
+def splitblocks(text):
+    blocks = []
+    cur = []
+    ls = text.split('\n')
+    if not ls[-1]:
+        ls.pop()
+    for ln in ls:
+        body = ln.strip()
+        if body and not body.startswith('#') and not ln[0].isspace():
+            if cur:
+                blocks.append(''.join(cur))
+            cur = []
+        cur.append(ln+'\n')
+    if cur:
+        blocks.append(''.join(cur))
+    if blocks and not text.endswith('\n'):
+        blocks[-1] = blocks[-1][ : -1 ]
+    return blocks
+
+class BlockParser:
+    def __init__(self):
+        self.blocks = {}
+        self.blockcount = 0
+        self.reparsed = 0
+
+    def parse(self, text):
+        # Same result as parselines(), but reusing the trees of any block
+        # which was seen last time.
+        trees = []
+        lines = []
+        newblocks = {}
+        self.reparsed = 0
+        blocks = splitblocks(text)
+        for block in blocks:
+            res = newblocks.get(block) or self.blocks.get(block)
+            if res is None:
+                # Line numbers in a reused block's tokens may be stale,
+                # but they're only used for lexing errors, which a
+                # reused block didn't have.
+                res = parselines(StringIO(block), firstline=len(lines)+1)
+                self.reparsed += 1
+            newblocks[block] = res
+            trees.extend(res[0])
+            lines.extend(res[1])
+        self.blocks = newblocks
+        self.blockcount = len(blocks)
+        return (trees, lines)
+
+def writeatomic(filename, text):
+    # Readers of the output never see a half-written file.
+    tmpfilename = filename + '.tmp'
+    fl = open(tmpfilename, 'w')
+    fl.write(text)
+    fl.close()
+    os.replace(tmpfilename, filename)
+
+def watch(filename, rebuild, interval=POLL_INTERVAL):
+    # Call rebuild() at startup and whenever the file's mtime or size
+    # changes. Runs until interrupted.
+    laststat = None
+    while True:
+        try:
+            stat = os.stat(filename)
+            curstat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            curstat = None
+        if curstat != laststat:
+            laststat = curstat
+            if curstat is not None:
+                rebuild()
+        time.sleep(interval)